@@ -170,18 +170,13 @@ def PositiveEL( embedding_basename,
                            shuffle_needed = False, 
                            overlap_rate = 0, 
                            disjoint_rate = 0, 
-                           feature_choice = 7  ).next()[:9]
-    l1 = csr_matrix( ( l1v, ( l1i[:,0].reshape([-1]), l1i[:,1].reshape([-1]) ) ),
-                     shape = [len(bc.positive), n_word] ).astype( numpy.float32 )
-    l2 = csr_matrix( ( l2v, ( l2i[:,0].reshape([-1]), l2i[:,1].reshape([-1]) ) ),
-                     shape = [len(bc.positive), n_word] ).astype( numpy.float32 )
-    r1 = csr_matrix( ( r1v, ( r1i[:,0].reshape([-1]), r1i[:,1].reshape([-1]) ) ),
-                     shape = [len(bc.positive), n_word] ).astype( numpy.float32 )
-    r2 = csr_matrix( ( r2v, ( r2i[:,0].reshape([-1]), r2i[:,1].reshape([-1]) ) ),
-                     shape = [len(bc.positive), n_word] ).astype( numpy.float32 )
-    bow = csr_matrix( ( numpy.ones( bow.shape[0] ),
-                        ( bow[:,0].reshape([-1]), bow[:,1].reshape([-1]) ) ),
-                      shape = [len(bc.positive), n_word] ).astype( numpy.float32 )
+                           feature_choice = 7,
+                           csr = True ).next()[:9]
+    l1 = csr_to_scipy( l1v, l1i, n_word )
+    l2 = csr_to_scipy( l2v, l2i, n_word )
+    r1 = csr_to_scipy( r1v, r1i, n_word )
+    r2 = csr_to_scipy( r2v, r2i, n_word )
+    bow = csr_to_scipy( None, bow, n_word )
     return list(mid_itr), mention, l1, l2, r1, r2, bow
 
     
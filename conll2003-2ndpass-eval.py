@@ -24,6 +24,8 @@ if __name__ == '__main__':
                          help = 'load 5 models for 1st pass if set' )
     parser.add_argument( '--nfold2nd', action = 'store_true', default = False,
                          help = 'load 5 models for 2nd pass if set' )
+    parser.add_argument( '--dataset_cache', type = str, default = None,
+                         help = 'constructed data sets are saved to and loaded from this directory; None means not used' )
 
     args = parser.parse_args()
     logger.info( str(args) + '\n' )
@@ -47,6 +49,12 @@ if __name__ == '__main__':
                                    'conll2003-model', 'ner-list' )
     conll2003_gazetteer = gazetteer( gazetteer_path )
 
+    # what a constructed data set depends on besides the corpus, see --dataset_cache
+    dependency = [ gazetteer_path ] + \
+                 [ os.path.join( os.path.dirname(__file__), 'conll2003-model', 
+                                 'reuters256-case-%s.wordlist' % case )
+                   for case in [ 'insensitive', 'sensitive' ] ]
+
     ################################################################################
     ########## compute 1st-past result
     ################################################################################
@@ -86,11 +94,23 @@ if __name__ == '__main__':
 
         ################################################################################
 
-        test  = batch_constructor( CoNLL2003( args.testb ), 
-                                   numericizer1, numericizer2, 
-                                   gazetteer = conll2003_gazetteer, 
-                                   alpha = config1.word_alpha, 
-                                   window = config1.n_window )
+        test  = cached_dataset( args.dataset_cache,
+                                lambda : batch_constructor( CoNLL2003( args.testb ), 
+                                                            numericizer1, numericizer2, 
+                                                            gazetteer = conll2003_gazetteer, 
+                                                            alpha = config1.word_alpha, 
+                                                            fofe_epsilon = getattr( config1, 'fofe_epsilon', 0 ),
+                                                            fofe_max_length = getattr( config1, 'fofe_max_length', 0 ),
+                                                            window = config1.n_window ),
+                                [ args.testb ] + dependency,
+                                numericizer1, numericizer2,
+                                version = 1,
+                                vocabulary_label_type = 0,
+                                alpha = config1.word_alpha,
+                                fofe_epsilon = getattr( config1, 'fofe_epsilon', 0 ),
+                                fofe_max_length = getattr( config1, 'fofe_max_length', 0 ),
+                                window = config1.n_window,
+                                is2ndPass = False )
         logger.info( 'test: ' + str(test) )
         logger.info( 'data set loaded' )
 
@@ -194,12 +214,24 @@ if __name__ == '__main__':
 
         ################################################################################
 
-        test  = batch_constructor( CoNLL2003( output1st ), 
-                                   numericizer1, numericizer2, 
-                                   gazetteer = conll2003_gazetteer, 
-                                   alpha = config2.word_alpha, 
-                                   window = config2.n_window,
-                                   is2ndPass = True )
+        test  = cached_dataset( args.dataset_cache,
+                                lambda : batch_constructor( CoNLL2003( output1st ), 
+                                                            numericizer1, numericizer2, 
+                                                            gazetteer = conll2003_gazetteer, 
+                                                            alpha = config2.word_alpha, 
+                                                            fofe_epsilon = getattr( config2, 'fofe_epsilon', 0 ),
+                                                            fofe_max_length = getattr( config2, 'fofe_max_length', 0 ),
+                                                            window = config2.n_window,
+                                                            is2ndPass = True ),
+                                [ output1st ] + dependency,
+                                numericizer1, numericizer2,
+                                version = 1,
+                                vocabulary_label_type = config2.n_label_type,
+                                alpha = config2.word_alpha,
+                                fofe_epsilon = getattr( config2, 'fofe_epsilon', 0 ),
+                                fofe_max_length = getattr( config2, 'fofe_max_length', 0 ),
+                                window = config2.n_window,
+                                is2ndPass = True )
         logger.info( 'test: ' + str(test) )
         logger.info( 'data set loaded' )
 
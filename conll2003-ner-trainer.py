@@ -63,6 +63,10 @@ if __name__ == '__main__':
                          help = 'if nn output is less than threshold, it is still considered as O' )
     parser.add_argument( '--n_window', type = int, default = 7,
                          help = 'maximum length of NER candidate' )
+    parser.add_argument( '--fofe_epsilon', type = float, default = 0,
+                         help = 'word-level fofe drops words whose weight is less than it; 0 means not used' )
+    parser.add_argument( '--fofe_max_length', type = int, default = 0,
+                         help = 'word-level fofe covers at most this many words; 0 means not used' )
     parser.add_argument( '--strictly_one_hot', action = 'store_true', default = False,
                          help = 'when gazetteer is used, True if 4-bit match or False 5-bit match' )
     parser.add_argument( '--hope_out', type = int, default = 0,
@@ -86,6 +90,25 @@ if __name__ == '__main__':
     parser.add_argument( '--l1', type = float, default = 0 )
     parser.add_argument( '--l2', type = float, default = 0 )
     parser.add_argument( '--n_pattern', type = int, default = 0 )
+    parser.add_argument( '--n_batch_buffer', type = int, default = 0,
+                         help = 'training mini-batches are filled into this many reusable buffers; 0 means not used' )
+    parser.add_argument( '--n_batch_worker', type = int, default = 0,
+                         help = 'training mini-batches are prepared by this many processes; 0 means a background thread' )
+    parser.add_argument( '--n_batch_thread', type = int, default = 0,
+                         help = 'training mini-batches are assembled by this many threads without the GIL; ' + \
+                                'ignored if --n_batch_worker is set' )
+    parser.add_argument( '--n_stream_sentence', type = int, default = 4096,
+                         help = 'machine-labeled data is streamed this many sentences at a time; ' + \
+                                '0 means each file is loaded as a whole' )
+    parser.add_argument( '--prefetch_chunk', action = 'store_true', default = False,
+                         help = 'the machine-labeled file of the next epoch is loaded by a ' + \
+                                'background process while the current one is trained on; ' + \
+                                'it supersedes --n_stream_sentence' )
+    parser.add_argument( '--pipeline', action = 'store_true', default = False,
+                         help = 'mini-batches are enqueued into the input queue of the model by a ' + \
+                                'background thread instead of being fed step by step' )
+    parser.add_argument( '--dataset_cache', type = str, default = None,
+                         help = 'constructed data sets are saved to and loaded from this directory; None means not used' )
     parser.add_argument( '--logfile', type = str, default = None )
 
     # TODO
@@ -159,50 +182,75 @@ if __name__ == '__main__':
 
     ################################################################################
 
-    mention_net = fofe_mention_net( config, args.gpu_fraction )
+    mention_net = fofe_mention_net( config, args.gpu_fraction, pipeline = args.pipeline )
     mention_net.tofile( args.model )
 
     ########################################################################
 
     # there are 2 sets of vocabulary, case-insensitive and case sensitive
     nt = config.n_label_type if config.is_2nd_pass else 0
+    # both vocabularies memorize token indices in a same cache
+    cache = token_cache()
     numericizer1 = vocabulary( config.word_embedding + '-case-insensitive.wordlist', 
                                config.char_alpha, False,
-                               n_label_type = nt )
+                               n_label_type = nt, cache = cache )
     numericizer2 = vocabulary( config.word_embedding + '-case-sensitive.wordlist', 
                                config.char_alpha, True,
-                               n_label_type = nt )
+                               n_label_type = nt, cache = cache )
 
     if args.feature_choice & 256 > 0:
         conll2003_gazetteer = gazetteer( args.data_path + '/ner-lst' )
     else:
         conll2003_gazetteer = [ set() for _ in xrange( args.n_label_type ) ]
-
-    train = batch_constructor( CoNLL2003( args.data_path + '/eng.train' ), 
-                               numericizer1, numericizer2, 
-                               gazetteer = conll2003_gazetteer, 
+    conll2003_gazetteer = gazetteer_index( conll2003_gazetteer )
+
+    def LoadDataset( filename ):
+        # keyed by everything the constructed data set depends on
+        return cached_dataset( args.dataset_cache,
+                               lambda : batch_constructor( CoNLL2003( filename ), 
+                                                           numericizer1, numericizer2, 
+                                                           gazetteer = conll2003_gazetteer, 
+                                                           alpha = config.word_alpha, 
+                                                           fofe_epsilon = config.fofe_epsilon,
+                                                           fofe_max_length = config.fofe_max_length,
+                                                           window = config.n_window,
+                                                           is2ndPass = args.is_2nd_pass,
+                                                           feature_choice = config.feature_choice ),
+                               [ filename, 
+                                 config.word_embedding + '-case-insensitive.wordlist',
+                                 config.word_embedding + '-case-sensitive.wordlist' ] + \
+                               ([ args.data_path + '/ner-lst' ] if args.feature_choice & 256 > 0 else []),
+                               numericizer1, numericizer2,
+                               version = 1,
+                               gazetteer = args.feature_choice & 256 > 0,
+                               n_gazetteer_type = args.n_label_type,
+                               vocabulary_label_type = nt,
                                alpha = config.word_alpha, 
+                               fofe_epsilon = config.fofe_epsilon,
+                               fofe_max_length = config.fofe_max_length,
                                window = config.n_window,
-                               is2ndPass = args.is_2nd_pass )
+                               is2ndPass = args.is_2nd_pass,
+                               feature_choice = config.feature_choice )
+
+    def Evaluate( batch_generator ):
+        # (cost, predicted indices, predicted values, target) of each mini-batch
+        if args.pipeline:
+            return mention_net.eval_pipelined( (example, example[-1]) 
+                                               for example in batch_generator )
+        return ( mention_net.eval( example ) + (example[-1],) 
+                 for example in batch_generator )
+
+    train = LoadDataset( args.data_path + '/eng.train' )
     logger.info( 'train: ' + str(train) )
 
-    valid = batch_constructor( CoNLL2003( args.data_path + '/eng.testa' ), 
-                               numericizer1, numericizer2, 
-                               gazetteer = conll2003_gazetteer, 
-                               alpha = config.word_alpha, 
-                               window = config.n_window,
-                               is2ndPass = args.is_2nd_pass )
+    valid = LoadDataset( args.data_path + '/eng.testa' )
     logger.info( 'valid: ' + str(valid) )
 
-    test  = batch_constructor( CoNLL2003( args.data_path + '/eng.testb' ), 
-                               numericizer1, numericizer2, 
-                               gazetteer = conll2003_gazetteer, 
-                               alpha = config.word_alpha, 
-                               window = config.n_window,
-                               is2ndPass = args.is_2nd_pass )
+    test  = LoadDataset( args.data_path + '/eng.testb' )
     logger.info( 'test: ' + str(test) )
 
     logger.info( 'data set loaded' )
+    logger.info( 'token cache: ' + str(cache) )
 
 
     ################### let's compute ####################
@@ -212,6 +260,18 @@ if __name__ == '__main__':
 
     if config.enable_distant_supervision:
         machine = train
+        if args.prefetch_chunk:
+            prefetch = chunk_prefetcher( 
+                lambda k : batch_constructor( CoNLL2003( os.path.join(folder, filelist[k]) ), 
+                                              numericizer1, numericizer2, 
+                                              gazetteer = conll2003_gazetteer, 
+                                              alpha = config.word_alpha, 
+                                              fofe_epsilon = config.fofe_epsilon,
+                                              fofe_max_length = config.fofe_max_length,
+                                              window = config.n_window,
+                                              is2ndPass = args.is_2nd_pass,
+                                              feature_choice = config.feature_choice ),
+                config.max_iter, numericizer1, numericizer2, args.buffer_dir )
         infinite = machine.infinite_mini_batch_multi_thread( 
                             config.n_batch_size, True, 
                             config.overlap_rate, config.disjoint_rate, 
@@ -229,39 +289,115 @@ if __name__ == '__main__':
         # phar is used to observe training progress
         logger.info( 'epoch %2d, learning-rate: %f' % \
                         (n_epoch + 1, mention_net.config.learning_rate) )
-        if config.enable_distant_supervision:
+        if config.enable_distant_supervision and args.prefetch_chunk:
+            train = prefetch.next()
+            logger.info( 'train: ' + str(train) )
+        elif config.enable_distant_supervision and args.n_stream_sentence > 0:
+            train = batch_constructor_stream( CoNLL2003( os.path.join(folder, filelist[n_epoch]) ), 
+                                              numericizer1, numericizer2, 
+                                              n_sentence = args.n_stream_sentence,
+                                              gazetteer = conll2003_gazetteer, 
+                                              alpha = config.word_alpha, 
+                                              fofe_epsilon = config.fofe_epsilon,
+                                              fofe_max_length = config.fofe_max_length,
+                                              window = config.n_window,
+                                              is2ndPass = args.is_2nd_pass,
+                                              feature_choice = config.feature_choice )
+        elif config.enable_distant_supervision:
             train = batch_constructor( # gigaword( 'gigaword/' + filelist[n_epoch] ), 
                                        CoNLL2003( os.path.join(folder, filelist[n_epoch]) ), 
                                        numericizer1, numericizer2, 
                                        gazetteer = conll2003_gazetteer, 
                                        alpha = config.word_alpha, 
+                                       fofe_epsilon = config.fofe_epsilon,
+                                       fofe_max_length = config.fofe_max_length,
                                        window = config.n_window,
-                                       is2ndPass = args.is_2nd_pass )
+                                       is2ndPass = args.is_2nd_pass,
+                                       feature_choice = config.feature_choice )
             logger.info( 'train: ' + str(train) )
 
-        pbar = tqdm( total = len(train.positive) + 
+        # the size of a stream is not known in advance
+        streamed = isinstance( train, batch_constructor_stream )
+        pbar = tqdm( total = None if streamed else 
+                             len(train.positive) + 
                              int(len(train.overlap) * config.overlap_rate) +
                              int(len(train.disjoint) * config.disjoint_rate) )
 
         cost, cnt = 0, 0
         
-        for example in ifilter( lambda x : x[-1].shape[0] == config.n_batch_size,
-                                train.mini_batch_multi_thread( config.n_batch_size, 
-                                                               True, 
-                                                               config.overlap_rate, 
-                                                               config.disjoint_rate, 
-                                                               config.feature_choice ) ):
+        pool = batch_pool( args.n_batch_buffer ) if args.n_batch_buffer > 0 else None
+
+        if args.n_batch_worker > 0 and not streamed:
+            batch_generator = train.mini_batch_multi_process( config.n_batch_size, 
+                                                              True, 
+                                                              config.overlap_rate, 
+                                                              config.disjoint_rate, 
+                                                              config.feature_choice,
+                                                              n_worker = args.n_batch_worker,
+                                                              pool = pool )
+        elif args.n_batch_thread > 0 and not streamed:
+            batch_generator = train.mini_batch_thread_pool( config.n_batch_size, 
+                                                            True, 
+                                                            config.overlap_rate, 
+                                                            config.disjoint_rate, 
+                                                            config.feature_choice,
+                                                            n_thread = args.n_batch_thread,
+                                                            pool = pool )
+        else:
+            batch_generator = train.mini_batch_multi_thread( config.n_batch_size, 
+                                                             True, 
+                                                             config.overlap_rate, 
+                                                             config.disjoint_rate, 
+                                                             config.feature_choice,
+                                                             pool = pool )
+
+        if args.pipeline:
+            # a pooled mini-batch is tagged with itself and released once it 
+            # is trained on; machine-labeled ones are tagged with None
+            def Steps():
+                for example in batch_generator:
+                    if example[-1].shape[0] != config.n_batch_size:
+                        if pool is not None:
+                            pool.release( example )
+                        continue
+                    yield example, example
+                    if config.enable_distant_supervision:
+                        yield infinite.next(), None
+
+            for c, example in mention_net.train_pipelined( Steps() ):
+                if example is None:
+                    continue
+
+                cost += c * example[-1].shape[0]
+                cnt += example[-1].shape[0]
+                pbar.update( example[-1].shape[0] )
+
+                if pool is not None:
+                    pool.release( example )
 
-            c = mention_net.train( example )
+        else:
+            for example in batch_generator:
 
-            cost += c * example[-1].shape[0]
-            cnt += example[-1].shape[0]
-            pbar.update( example[-1].shape[0] )
+                if example[-1].shape[0] != config.n_batch_size:
+                    if pool is not None:
+                        pool.release( example )
+                    continue
 
-            if config.enable_distant_supervision:
-                mention_net.train( infinite.next() )
+                c = mention_net.train( example )
+
+                cost += c * example[-1].shape[0]
+                cnt += example[-1].shape[0]
+                pbar.update( example[-1].shape[0] )
+
+                if pool is not None:
+                    pool.release( example )
+
+                if config.enable_distant_supervision:
+                    mention_net.train( infinite.next() )
 
         pbar.close()
+        if streamed:
+            logger.info( 'train: ' + str(train) )
         train_cost = cost / cnt 
         logger.info( 'training set iterated, %f' % train_cost )
 
@@ -280,16 +416,14 @@ if __name__ == '__main__':
         cost, cnt = 0, 0
         to_print = [] 
 
-        for example in valid.mini_batch_multi_thread( 
+        for c, pi, pv, target in Evaluate( valid.mini_batch_multi_thread( 
                             512 if config.feature_choice & (1 << 9) > 0 else 1024, 
-                            False, 1, 1, config.feature_choice ):
+                            False, 1, 1, config.feature_choice ) ):
 
-            c, pi, pv = mention_net.eval( example )
+            cost += c * target.shape[0]
+            cnt += target.shape[0]
 
-            cost += c * example[-1].shape[0]
-            cnt += example[-1].shape[0]
-
-            for exp, est, prob in zip( example[-1], pi, pv ):
+            for exp, est, prob in zip( target, pi, pv ):
                 to_print.append( '%d  %d  %s' % \
                         (exp, est, '  '.join( [('%f' % x) for x in prob.tolist()] )) )
         
@@ -313,16 +447,14 @@ if __name__ == '__main__':
             cost, cnt= 0, 0
             to_print = []
 
-            for example in test.mini_batch_multi_thread( 
+            for c, pi, pv, target in Evaluate( test.mini_batch_multi_thread( 
                                 512 if config.feature_choice & (1 << 9) > 0 else 1024, 
-                                False, 1, 1, config.feature_choice ):
+                                False, 1, 1, config.feature_choice ) ):
 
-                c, pi, pv = mention_net.eval( example )
+                cost += c * target.shape[0]
+                cnt += target.shape[0]
 
-                cost += c * example[-1].shape[0]
-                cnt += example[-1].shape[0]
-
-                for exp, est, prob in zip( example[-1], pi, pv ):
+                for exp, est, prob in zip( target, pi, pv ):
                     to_print.append( '%d  %d  %s' % \
                             (exp, est, '  '.join( [('%f' % x) for x in prob.tolist()] )) )
                 
@@ -428,5 +560,8 @@ if __name__ == '__main__':
         if config.drop_rate > 0:
             mention_net.config.drop_rate *= 0.5 ** (2./ config.max_iter)
 
+    if config.enable_distant_supervision and args.prefetch_chunk:
+        prefetch.close()
+
     logger.info( 'results are written in conll2003-{valid,test}.predicted' )
 
@@ -12,7 +12,7 @@ License: MIT License (see ./LICENSE)
 """
 
 
-import numpy, logging, time, copy, os, cPickle
+import numpy, logging, time, copy, os, cPickle, traceback
 
 import tensorflow as tf
 tf.logging.set_verbosity(tf.logging.ERROR)
@@ -24,6 +24,8 @@ from LinkingUtil import *
 from tqdm import tqdm
 from itertools import ifilter, izip, imap, product
 from random import choice
+from Queue import Queue
+from threading import Thread, Event
 
 logger = logging.getLogger( __name__ )
 
@@ -73,6 +75,8 @@ class mention_config( object ):
         self.char_alpha = 0.8
         self.word_alpha = 0.5
         self.n_window = 7
+        self.fofe_epsilon = 0
+        self.fofe_max_length = 0
         self.strictly_one_hot = True
         self.hope_out = 0
         self.n_label_type = 4
@@ -267,15 +271,57 @@ class mention_net_base( object ):
         raise NotImplementedError('mention_net_base::tofile')
 
 
+    def numpy_param( self ):
+        """
+        Returns
+        -------
+            param : dict
+                the weights as ndarrays, named and laid out as 
+                fofe_mention_numpy expects, whatever the backend is
+        """
+        raise NotImplementedError('mention_net_base::numpy_param')
+
+
+    def tonpz( self, filename ):
+        """
+        Parameters
+        ----------
+            filename : str
+                The weights and the config are exported to this .npz file, 
+                which fofe_mention_numpy runs without TensorFlow or PyTorch.
+                It is written to a temporary file first and renamed, so that
+                an interrupted or concurrent export never leaves it truncated.
+        """
+        param = self.numpy_param()
+        param['pad'] = numpy.asarray( [ self.pad1, self.pad2 ], dtype = numpy.int64 )
+        # protocol 0 is plain text, which fits in a numpy string
+        param['config'] = numpy.asarray( cPickle.dumps( self.config.__dict__, 0 ) )
+
+        # same directory, so that the rename is atomic
+        tmp_path = '%s.%d.tmp' % (filename, os.getpid())
+        fp = open( tmp_path, 'wb' )
+        try:
+            with fp:
+                numpy.savez( fp, **param )
+            os.rename( tmp_path, filename )
+        except:
+            os.remove( tmp_path )
+            raise
+
+
 ########################################################################
 
 
 class fofe_mention_net( mention_net_base ):
-    def __init__( self, config = None, gpu_option = 0.96 ):
+    def __init__( self, config = None, gpu_option = 0.96, pipeline = False ):
         """
         Parameters
         ----------
             config : mention_config
+            pipeline : bool
+                If True, the inputs can also be fed from a queue, which 
+                train_pipelined and eval_pipelined need. Otherwise they are 
+                plain placeholders, which train and eval must feed. 
         """
 
         super(fofe_mention_net, self).__init__( 
@@ -315,6 +361,9 @@ class fofe_mention_net( mention_net_base ):
 
         with self.graph.as_default():
             self.__InitPlaceHolder()
+            self.pipeline = pipeline
+            if pipeline:
+                self.__InitInputQueue()
             logger.info( 'placeholder defined' )
 
             self.__InitVariable( projection1, projection2, n_in, n_out, hope_in, hope_out )
@@ -484,6 +533,73 @@ class fofe_mention_net( mention_net_base ):
 
 
 
+    def __InitInputQueue( self ):
+        """
+        Only built if the constructor is asked to. 
+        Every input of a mini-batch is rewired to a placeholder_with_default on 
+        the head of a FIFOQueue. train and eval keep feeding them as before; 
+        train_pipelined and eval_pipelined leave them unfed, so that a background 
+        thread enqueues mini-batch N + 1 while mini-batch N is being computed. 
+        The bow values and the SparseTensor shapes are derived in-graph.
+        """
+        # in the order of what batch_constructor.mini_batch yields
+        self.staged_names = [ 
+            'lw1_values', 'rw1_values', 'lw1_indices', 'rw1_indices',
+            'lw2_values', 'rw2_values', 'lw2_indices', 'rw2_indices', 
+            'bow1_indices',
+            'lw3_values', 'rw3_values', 'lw3_indices', 'rw3_indices',
+            'lw4_values', 'rw4_values', 'lw4_indices', 'rw4_indices', 
+            'bow2_indices',
+            'dense_feature',
+            'char_idx',
+            'lbc_values', 'lbc_indices', 'rbc_values', 'rbc_indices',
+            'label'
+        ]
+
+        # the original placeholders are what enqueue_input is fed
+        self.dense_feature = tf.placeholder( tf.float32, [None, None], name = 'dense-feature' )
+        self.staged = [ getattr( self, name ) for name in self.staged_names ]
+
+        self.input_queue = tf.FIFOQueue( 
+            4, 
+            [ p.dtype for p in self.staged ], 
+            name = 'input-queue' 
+        )
+        self.enqueue_input = self.input_queue.enqueue( self.staged )
+        self.input_size = self.input_queue.size()
+
+        head = dict( zip( self.staged_names, self.input_queue.dequeue() ) )
+        self.dequeue_input = head['label']
+
+        for name in self.staged_names:
+            if name != 'dense_feature':
+                p = getattr( self, name )
+                setattr( self, name, tf.placeholder_with_default( head[name], p.get_shape() ) )
+
+        dense_feature = head['dense_feature']
+        for name, begin, end in [ ('lc_fofe', 0, 128), ('rc_fofe', 128, 256),
+                                  ('li_fofe', 256, 384), ('ri_fofe', 384, 512), 
+                                  ('ner_cls_match', 512, None) ]:
+            p = getattr( self, name )
+            setattr( self, name, 
+                     tf.placeholder_with_default( dense_feature[:,begin:end], p.get_shape() ) )
+
+        self.bow1_values = tf.placeholder_with_default( 
+            tf.ones( tf.shape( head['bow1_indices'] )[:1], dtype = tf.float32 ), [None] 
+        )
+        self.bow2_values = tf.placeholder_with_default( 
+            tf.ones( tf.shape( head['bow2_indices'] )[:1], dtype = tf.float32 ), [None] 
+        )
+
+        n_row = tf.cast( tf.shape( head['label'] )[0], tf.int64 )
+        for name, n_col in [ ('shape1', self.n_word1), ('shape2', self.n_word2), 
+                             ('shape3', 96 * 96) ]:
+            setattr( self, name, 
+                     tf.placeholder_with_default( 
+                        tf.stack( [ n_row, tf.constant( n_col, dtype = tf.int64 ) ] ), [2] ) )
+
+
+
     def __InitVariable( self, projection1, projection2, n_in, n_out, hope_in, hope_out ):
         self.word_embedding_1 = tf.Variable( projection1 )
         self.word_embedding_2 = tf.Variable( projection2 )
@@ -1039,6 +1155,7 @@ class fofe_mention_net( mention_net_base ):
         -------
             c : float
         """ 
+        # SparseTensor placeholders are fed (row, column) indices
         l1_values, r1_values, l1_indices, r1_indices, \
         l2_values, r2_values, l2_indices, r2_indices, \
         bow1i, \
@@ -1048,7 +1165,7 @@ class fofe_mention_net( mention_net_base ):
         dense_feature,\
         conv_idx,\
         l5_values, l5_indices, r5_values, r5_indices, \
-        target = mini_batch
+        target = coo_batch( mini_batch )
 
         if not self.config.strictly_one_hot:
             dense_feature[:,-1] = 0
@@ -1125,6 +1242,7 @@ class fofe_mention_net( mention_net_base ):
             pi : numpy.ndarray
             pv : numpy.ndarray
         """
+        # SparseTensor placeholders are fed (row, column) indices
         l1_values, r1_values, l1_indices, r1_indices, \
         l2_values, r2_values, l2_indices, r2_indices, \
         bow1i, \
@@ -1134,7 +1252,7 @@ class fofe_mention_net( mention_net_base ):
         dense_feature,\
         conv_idx,\
         l5_values, l5_indices, r5_values, r5_indices, \
-        target = mini_batch
+        target = coo_batch( mini_batch )
 
         if not self.config.strictly_one_hot:
             dense_feature[:,-1] = 0
@@ -1183,6 +1301,127 @@ class fofe_mention_net( mention_net_base ):
         return c, pi, pv
 
 
+
+    def enqueue_mini_batch( self, steps, tags, stopped ):
+        """
+        Thread body of pipelined: each mini-batch of 'steps' is enqueued into 
+        input_queue and then its tag is put into 'tags'; None is put when 
+        'steps' is exhausted and (False, traceback) when something goes wrong. 
+        """
+        try:
+            options = tf.RunOptions( timeout_in_ms = 256 )
+            for mini_batch, tag in steps:
+                mini_batch = coo_batch( mini_batch )
+                if not self.config.strictly_one_hot:
+                    mini_batch[18][:,-1] = 0
+                feed_dict = dict( zip( self.staged, mini_batch ) )
+
+                # time out periodically so that an abandoned pipeline can stop
+                while True:
+                    if stopped.is_set():
+                        return
+                    try:
+                        self.session.run( self.enqueue_input, 
+                                          feed_dict = feed_dict, 
+                                          options = options )
+                        break
+                    except tf.errors.DeadlineExceededError:
+                        pass
+                tags.put( (True, tag) )
+            tags.put( None )
+        except:
+            tags.put( (False, traceback.format_exc()) )
+
+
+
+    def pipelined( self, steps, fetches, feed ):
+        """
+        Parameters
+        ----------
+            steps : iterable
+                (mini_batch, tag) pairs, e.g. from mini_batch_multi_thread
+            fetches : list
+                what session.run evaluates for each mini-batch
+            feed : callable
+                returns the feed_dict of the non-input placeholders
+
+        Yields
+        ------
+            result : list
+                what session.run returns
+            tag : object
+                the tag of the mini-batch it is computed on
+        """
+        assert self.pipeline, 'fofe_mention_net is constructed without pipeline'
+        tags, stopped = Queue(), Event()
+        producer = Thread( target = self.enqueue_mini_batch, 
+                           args = ( steps, tags, stopped ) )
+        producer.daemon = True
+        producer.start()
+
+        try:
+            while True:
+                item = tags.get()
+                if item is None:
+                    break
+                succeeded, tag = item
+                if not succeeded:
+                    raise RuntimeError( 'mini-batch cannot be enqueued\n%s' % tag )
+                yield self.session.run( fetches, feed_dict = feed() ), tag
+        finally:
+            stopped.set()
+            producer.join()
+            # leave nothing behind for the next pipeline
+            for _ in xrange( self.session.run( self.input_size ) ):
+                self.session.run( self.dequeue_input )
+
+
+
+    def train_pipelined( self, steps ):
+        """
+        Same as train, except that mini-batch N + 1 is enqueued while 
+        mini-batch N is being computed. 
+
+        Parameters
+        ----------
+            steps : iterable
+                (mini_batch, tag) pairs
+
+        Yields
+        ------
+            c : float
+            tag : object
+        """
+        feed = lambda : { self.lr: self.config.learning_rate, 
+                          self.keep_prob: 1 - self.config.drop_rate }
+        for result, tag in self.pipelined( steps, self.train_step + [ self.xent ], feed ):
+            yield result[-1], tag
+
+
+
+    def eval_pipelined( self, steps ):
+        """
+        Same as eval, except that mini-batch N + 1 is enqueued while 
+        mini-batch N is being computed. 
+
+        Parameters
+        ----------
+            steps : iterable
+                (mini_batch, tag) pairs
+
+        Yields
+        ------
+            c : float
+            pi : numpy.ndarray
+            pv : numpy.ndarray
+            tag : object
+        """
+        fetches = [ self.xent, self.predicted_indices, self.predicted_values ]
+        feed = lambda : { self.keep_prob: 1 }
+        for (c, pi, pv), tag in self.pipelined( steps, fetches, feed ):
+            yield c, pi, pv, tag
+
+
     def tofile( self, filename ):
         """
         Parameters
@@ -1203,6 +1442,32 @@ class fofe_mention_net( mention_net_base ):
         self.saver.restore( self.session, filename )
 
 
+    def numpy_param( self ):
+        if self.config.n_pattern > 0:
+            raise NotImplementedError( 'sparse fofe patterns cannot be exported' )
+
+        variables = { 'word_embed1': self.word_embedding_1, 
+                      'word_embed2': self.word_embedding_2,
+                      'char_embed': self.char_embedding,
+                      'conv_embed': self.conv_embedding,
+                      'ner_embed': self.ner_embedding,
+                      'bigram_embed': self.bigram_embedding }
+        if self.config.hope_out > 0:
+            variables['U'] = self.U
+        for i, (kk, bb) in enumerate( zip( self.kernels, self.kernel_bias ) ):
+            variables['kernel_%d' % i] = kk
+            variables['kernel_bias_%d' % i] = bb
+        for i, (W, b) in enumerate( zip( self.W, self.b ) ):
+            variables['W_%d' % i] = W
+            variables['b_%d' % i] = b
+
+        param = self.session.run( variables )
+        # [height, n_char_embedding, 1, depth] -> [height, n_char_embedding, depth]
+        for i in xrange( len(self.kernels) ):
+            param['kernel_%d' % i] = param['kernel_%d' % i][:,:,0,:]
+        return param
+
+
     def __del__( self ):
         self.session.close()
 
@@ -1658,6 +1923,26 @@ class fofe_mention_net_v2( mention_net_base ):
         self.saver.restore( self.session, filename )
 
 
+    def numpy_param( self ):
+        variables = { 'word_embed1': self.word_embed1, 
+                      'word_embed2': self.word_embed2,
+                      'char_embed': self.char_embed,
+                      'conv_embed': self.conv_embed,
+                      'ner_embed': self.ner_embed }
+        for i, (kk, bb) in enumerate( zip( self.kernels, self.bias_k ) ):
+            variables['kernel_%d' % i] = kk
+            variables['kernel_bias_%d' % i] = bb
+        for i, (W, b) in enumerate( zip( self.W, self.bias_w ) ):
+            variables['W_%d' % i] = W
+            variables['b_%d' % i] = b
+
+        param = self.session.run( variables )
+        # [height, n_char_embedding, 1, depth] -> [height, n_char_embedding, depth]
+        for i in xrange( len(self.kernels) ):
+            param['kernel_%d' % i] = param['kernel_%d' % i][:,:,0,:]
+        return param
+
+
 
 ########################################################################
 
@@ -2121,6 +2406,32 @@ class fofe_mention_net_v3( mention_net_base ):
             self.network.cuda()
 
 
+    def numpy_param( self ):
+        state = dict( (k, v.cpu().numpy()) for k, v in self.network.state_dict().items() )
+
+        param = { 'word_embed1': state['word_embed1.weight'],
+                  'word_embed2': state['word_embed2.weight'],
+                  'char_embed': state['char_embed.weight'],
+                  'conv_embed': state['conv_embed.weight'] }
+
+        # nn.Linear keeps the transpose; the last gazetteer column is dropped by 
+        # eval, which is the same as a zero row
+        ner_embed = state['ner_embed.weight'].T
+        param['ner_embed'] = numpy.vstack( [ ner_embed, 
+                                             numpy.zeros_like( ner_embed[:1] ) ] )
+
+        # [depth, 1, height, n_char_embedding] -> [height, n_char_embedding, depth]
+        for i in xrange( len(self.network.conv) ):
+            param['kernel_%d' % i] = state['conv.%d.weight' % i][:,0].transpose( 1, 2, 0 )
+            param['kernel_bias_%d' % i] = state['conv.%d.bias' % i]
+
+        for i in xrange( len(self.network.linears) ):
+            param['W_%d' % i] = state['linears.%d.weight' % i].T
+            param['b_%d' % i] = state['linears.%d.bias' % i]
+
+        return param
+
+
 ######################################################################
 
 
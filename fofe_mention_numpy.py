@@ -0,0 +1,649 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Filename    : fofe_mention_numpy.py
+Description : Inference of a trained fofe_mention_net, fofe_mention_net_v2 or
+              fofe_mention_net_v3 with NumPy and SciPy only, from the .npz file
+              mention_net_base.tonpz exports. Neither TensorFlow nor PyTorch is
+              imported unless a model has to be exported first.
+
+License: MIT License (see ./LICENSE)
+"""
+
+
+import numpy, logging, os, cPickle
+
+from gigaword2feature import *
+from LinkingUtil import *
+
+from scipy.sparse import csr_matrix
+from itertools import ifilter, izip, imap, product, chain
+
+logger = logging.getLogger( __name__ )
+
+
+
+########################################################################
+
+
+class exported_config( object ):
+    """
+    The config of an exported model, i.e. mention_config without its defaults.
+    """
+    def __init__( self, entries ):
+        self.__dict__.update( entries )
+
+
+
+def fofe_scan( token, link, embed, alpha, window = -1, weight = None ):
+    """
+    Word-level fofe is linear, so the projected context of a position is alpha
+    times that of the position it extends plus the embedding of its own word.
+    The projected contexts of a whole sentence follow from one scan by pointer 
+    jumping, i.e. O(log n) vectorized steps instead of one sum per span. 
+
+    Parameters
+    ----------
+        token : ndarray
+            the word each position absorbs
+        link : ndarray
+            the position whose context it extends, negative if none; i - 1 
+            (or i + 1 on the right) except where a 2nd-pass mention rolls back
+        embed : ndarray
+            projection of the words
+        alpha : float
+            forgetting factor
+        window : int
+            if non-negative, only the last 'window' positions of a context are
+            kept, as processed_sentence and batch_constructor_v2 truncate it
+        weight : ndarray
+            if given, each position's word is scaled by it, e.g. 0 for padding
+
+    Returns
+    -------
+        table : ndarray
+            [n + 2, d] float32, where row i + 1 is the projected context of
+            position i, and row 0 and row n + 1 are the empty context
+    """
+    n = len(token)
+    table = numpy.zeros( (n + 2, embed.shape[1]), dtype = numpy.float32 )
+
+    # row 0 is the empty context, where every link ends and stays
+    span = table[:n + 1].copy()
+    span[1:] = embed[token]
+    if weight is not None:
+        span[1:] *= weight[:,None]
+    link = numpy.concatenate( [ [ 0 ], numpy.maximum( link, -1 ) + 1 ] )
+
+    # after k steps, span is the fofe of the last 2 ** k positions and link 
+    # jumps over them; the context is the sum of the spans of the binary 
+    # digits of its length, the nearest one first
+    result, cursor = table[:n + 1], numpy.arange( n + 1 )
+    power, decay = numpy.float32( alpha ), numpy.float32( 1 )
+    length = window if 0 <= window < n else n
+    while length > 0:
+        if length & 1:
+            result += decay * span[cursor]
+            cursor = link[cursor]
+            decay *= power
+        length >>= 1
+        if length > 0:
+            span = span + power * span[link]
+            link = link[link]
+            power *= power
+
+    return table
+
+
+
+########################################################################
+
+
+class numpy_mention_net( object ):
+    def __init__( self, filename ):
+        """
+        Parameters
+        ----------
+            filename : str
+                what mention_net_base.tonpz writes
+        """
+        with numpy.load( filename ) as npz:
+            self.param = dict( (name, npz[name]) for name in npz.files
+                               if name not in [ 'config', 'pad' ] )
+            self.config = exported_config( cPickle.loads( npz['config'].item() ) )
+            self.pad1, self.pad2 = npz['pad'].tolist()
+
+        n_kernel = len( [ name for name in self.param if name.startswith( 'kernel_bias_' ) ] )
+        self.kernels = [ self.param['kernel_%d' % i] for i in xrange( n_kernel ) ]
+        self.kernel_bias = [ self.param['kernel_bias_%d' % i] for i in xrange( n_kernel ) ]
+
+        n_layer = len( [ name for name in self.param if name.startswith( 'W_' ) ] )
+        self.W = [ self.param['W_%d' % i] for i in xrange( n_layer ) ]
+        self.b = [ self.param['b_%d' % i] for i in xrange( n_layer ) ]
+
+        self.version = getattr( self.config, 'version', 1 )
+        logger.info( 'version-%d model loaded from %s' % (self.version, filename) )
+
+
+
+    def char_conv( self, char_idx, activation ):
+        """
+        Parameters
+        ----------
+            char_idx : ndarray
+                [batch, length] character indices
+            activation : callable
+                applied after max-pooling, which is the same as before
+                for a monotonic function
+
+        Returns
+        -------
+            conv : list
+                [batch, depth] of each kernel
+        """
+        cube = self.param['conv_embed'][char_idx]
+        result = []
+        for kernel, bias in zip( self.kernels, self.kernel_bias ):
+            height = kernel.shape[0]
+            n_step = cube.shape[1] - height + 1
+            conv = sum( numpy.dot( cube[:,k:k + n_step], kernel[k] ) for k in xrange( height ) )
+            result.append( activation( conv.max( axis = 1 ) + bias ) )
+        return result
+
+
+
+    def project_v1( self, mini_batch ):
+        """
+        Returns
+        -------
+            project : callable
+                maps (values, indices) of a sparse feature of 'mini_batch' and
+                an embedding to the projected feature
+        """
+        n_row = mini_batch[-1].shape[0]
+
+        def project( values, index, embed ):
+            if isinstance( index, tuple ):
+                matrix = csr_to_scipy( values, index, embed.shape[0] )
+            else:
+                if values is None:
+                    values = numpy.ones( index.shape[0], dtype = numpy.float32 )
+                # duplicated (row, column) pairs are summed, as in a SparseTensor
+                matrix = csr_matrix( (values, (index[:,0], index[:,1])),
+                                     shape = (n_row, embed.shape[0]),
+                                     dtype = numpy.float32 )
+            return numpy.asarray( matrix.dot( embed ), dtype = numpy.float32 )
+
+        return project
+
+
+
+    def context_v1( self, mini_batch ):
+        """
+        Returns
+        -------
+            context : dict
+                the projected fofe, e.g. 'l1' and 'r1', of each word-level
+                context feature chosen, what feature_v1 takes
+        """
+        project = self.project_v1( mini_batch )
+        embed = [ self.param['word_embed1'], self.param['word_embed2'] ]
+        context = {}
+        for k, (bit, left, right) in enumerate( [ (1, 0, 1), (2, 4, 5), (8, 9, 10), (16, 13, 14) ] ):
+            if self.config.feature_choice & bit > 0:
+                # the indices follow the values of the same side by 2
+                context['l%d' % (k + 1)] = project( mini_batch[left], mini_batch[left + 2], embed[k // 2] )
+                context['r%d' % (k + 1)] = project( mini_batch[right], mini_batch[right + 2], embed[k // 2] )
+        return context
+
+
+
+    def feature_v1( self, mini_batch, context = None ):
+        """
+        Parameters
+        ----------
+            context : dict
+                what context_v1 returns, computed from 'mini_batch' if None
+        """
+        l1_values, r1_values, l1_indices, r1_indices, \
+        l2_values, r2_values, l2_indices, r2_indices, \
+        bow1i, \
+        l3_values, r3_values, l3_indices, r3_indices, \
+        l4_values, r4_values, l4_indices, r4_indices, \
+        bow2i, \
+        dense_feature,\
+        conv_idx,\
+        l5_values, l5_indices, r5_values, r5_indices, \
+        target = mini_batch
+
+        if context is None:
+            context = self.context_v1( mini_batch )
+        feature_choice = self.config.feature_choice
+        project = self.project_v1( mini_batch )
+
+        embed1, embed2 = self.param['word_embed1'], self.param['word_embed2']
+        char_embed = self.param['char_embed']
+        n_char = char_embed.shape[0]
+
+        feature = []
+        if feature_choice & 1 > 0:
+            feature += [ context['l1'], context['r1'] ]
+        if feature_choice & 2 > 0:
+            feature += [ context['l2'], context['r2'] ]
+        if feature_choice & 4 > 0:
+            feature += [ project( None, bow1i, embed1 ) ]
+        if feature_choice & 8 > 0:
+            feature += [ context['l3'], context['r3'] ]
+        if feature_choice & 16 > 0:
+            feature += [ context['l4'], context['r4'] ]
+        if feature_choice & 32 > 0:
+            feature += [ project( None, bow2i, embed2 ) ]
+        if feature_choice & 64 > 0:
+            feature += [ numpy.dot( dense_feature[:,:n_char], char_embed ),
+                         numpy.dot( dense_feature[:,n_char:2 * n_char], char_embed ) ]
+        if feature_choice & 128 > 0:
+            feature += [ numpy.dot( dense_feature[:,2 * n_char:3 * n_char], char_embed ),
+                         numpy.dot( dense_feature[:,3 * n_char:4 * n_char], char_embed ) ]
+        if feature_choice & 256 > 0:
+            gazetteer = dense_feature[:,4 * n_char:]
+            if not self.config.strictly_one_hot:
+                gazetteer = gazetteer.copy()
+                gazetteer[:,-1] = 0
+            feature += [ numpy.dot( gazetteer, self.param['ner_embed'] ) ]
+        if feature_choice & 512 > 0:
+            feature += self.char_conv( conv_idx, numpy.tanh )
+        if feature_choice & 1024 > 0:
+            feature += [ project( l5_values, l5_indices, self.param['bigram_embed'] ),
+                         project( r5_values, r5_indices, self.param['bigram_embed'] ) ]
+
+        return feature, target
+
+
+
+    def padding( self, pad ):
+        """
+        fofe_mention_net_v2 masks the padding of its inputs out, but 
+        fofe_mention_net_v3 sums the padded cells as they are, whose rows 
+        xavier_uniform leaves non-zero. 
+
+        Returns
+        -------
+            pad : int
+                'pad' if it is masked out, None otherwise
+        """
+        return pad if self.version == 2 else None
+
+
+
+    @staticmethod
+    def padded_fofe( context, alpha, embed, pad ):
+        alpha = numpy.float32( alpha )
+        weight = alpha ** numpy.arange( context.shape[1], dtype = numpy.float32 )
+        if pad is None:
+            return numpy.einsum( 'j,ijk->ik', weight, embed[context] )
+        weight = (context != pad) * weight
+        return numpy.einsum( 'ij,ijk->ik', weight.astype( numpy.float32 ), embed[context] )
+
+
+
+    def context_v2( self, mini_batch ):
+        """
+        Same as context_v1, for the padded matrices of batch_constructor_v2.
+        """
+        word = mini_batch['word']
+        context = {}
+        for k, (bit, case, embed, pad, kind) in enumerate( [ 
+                (1, 'case-insensitive', 'word_embed1', self.pad1, 'incl'),
+                (2, 'case-insensitive', 'word_embed1', self.pad1, 'excl'),
+                (8, 'case-sensitive', 'word_embed2', self.pad2, 'incl'),
+                (16, 'case-sensitive', 'word_embed2', self.pad2, 'excl') ] ):
+            if self.config.feature_choice & bit > 0:
+                for side in [ 'left', 'right' ]:
+                    context['%s%d' % (side[0], k + 1)] = self.padded_fofe( 
+                            word[case]['%s-%s' % (side, kind)], self.config.word_alpha, 
+                            self.param[embed], self.padding( pad ) )
+        return context
+
+
+
+    def feature_v2( self, mini_batch, context = None ):
+        """
+        Parameters
+        ----------
+            context : dict
+                what context_v2 returns, computed from 'mini_batch' if None
+        """
+        word, char = mini_batch['word'], mini_batch['char']
+        feature_choice = self.config.feature_choice
+        char_alpha = self.config.char_alpha
+        fofe = self.padded_fofe
+
+        if context is None:
+            context = self.context_v2( mini_batch )
+
+        def bow( words, embed, pad ):
+            if pad is None:
+                return embed[words].sum( axis = 1 )
+            return numpy.einsum( 'ij,ijk->ik', (words != pad).astype( numpy.float32 ), embed[words] )
+
+        insensitive, sensitive = word['case-insensitive'], word['case-sensitive']
+        embed1, embed2 = self.param['word_embed1'], self.param['word_embed2']
+        char_embed = self.param['char_embed']
+
+        # v2 drops the first column of the right-padded characters; v3 does not
+        skip = 1 if self.version == 2 else 0
+        pad1, pad2, char_pad = [ self.padding( pad ) for pad in [ self.pad1, self.pad2, 127 ] ]
+
+        feature = []
+        if feature_choice & 1 > 0:
+            feature += [ context['l1'], context['r1'] ]
+        if feature_choice & 2 > 0:
+            feature += [ context['l2'], context['r2'] ]
+        if feature_choice & 4 > 0:
+            feature += [ bow( insensitive['bow'], embed1, pad1 ) ]
+        if feature_choice & 8 > 0:
+            feature += [ context['l3'], context['r3'] ]
+        if feature_choice & 16 > 0:
+            feature += [ context['l4'], context['r4'] ]
+        if feature_choice & 32 > 0:
+            feature += [ bow( sensitive['bow'], embed2, pad2 ) ]
+        if feature_choice & 64 > 0:
+            feature += [ fofe( char['left'][:,skip:], char_alpha, char_embed, char_pad ),
+                         fofe( char['right'][:,skip:], char_alpha, char_embed, char_pad ) ]
+        if feature_choice & 128 > 0:
+            feature += [ fofe( char['left-initial'], char_alpha, char_embed, char_pad ),
+                         fofe( char['right-initial'], char_alpha, char_embed, char_pad ) ]
+        if feature_choice & 256 > 0:
+            feature += [ numpy.dot( mini_batch['gaz'], self.param['ner_embed'] ) ]
+
+        # _FofeNet.forward runs the untanh'ed char-conv under the gazetteer bit
+        if self.version == 3:
+            if feature_choice & 256 > 0:
+                feature += self.char_conv( char['left'], lambda x : x )
+        elif feature_choice & 512 > 0:
+            feature += self.char_conv( char['left'], numpy.tanh )
+
+        return feature, mini_batch['target']
+
+
+
+    def logits( self, mini_batch, context = None ):
+        """
+        Returns
+        -------
+            logits : ndarray
+                [batch, n_label_type + 1] pre-softmax scores
+            target : ndarray
+        """
+        if self.version == 1:
+            feature, target = self.feature_v1( mini_batch, context )
+        else:
+            feature, target = self.feature_v2( mini_batch, context )
+
+        output = numpy.concatenate( feature, axis = 1 ).astype( numpy.float32 )
+        if 'U' in self.param:
+            output = numpy.dot( output, self.param['U'] )
+
+        for i, (W, b) in enumerate( zip( self.W, self.b ) ):
+            output = numpy.dot( output, W ) + b
+            if i < len(self.W) - 1:
+                numpy.maximum( output, 0, out = output )
+
+        return output, target
+
+
+
+    def predict( self, mini_batch, context = None ):
+        """
+        Parameters
+        ----------
+            mini_batch : tuple or dict
+                what batch_constructor.mini_batch or batch_constructor_v2.mini_batch
+                yields, according to the version of the model
+            context : dict
+                the word-level context features, see context_v1 and scan_context;
+                computed from 'mini_batch' if None
+
+        Returns
+        -------
+            pi : numpy.ndarray
+            pv : numpy.ndarray
+        """
+        pi, pv, _ = self.__predict( mini_batch, context )
+        return pi, pv
+
+
+
+    def eval( self, mini_batch, context = None ):
+        """
+        Same as eval of the model it is exported from, except that the cost
+        has no l1/l2 penalty and is nan if some target is out of range.
+
+        Returns
+        -------
+            c : float
+            pi : numpy.ndarray
+            pv : numpy.ndarray
+        """
+        pi, pv, log_pv = self.__predict( mini_batch, context )
+        target = numpy.asarray( mini_batch['target'] if self.version > 1 else mini_batch[-1] )
+        if numpy.all( (0 <= target) & (target < pv.shape[1]) ):
+            c = -log_pv[numpy.arange( target.shape[0] ), target].mean()
+        else:
+            c = numpy.nan
+        return c, pi, pv
+
+
+
+    def scannable( self, constructor ):
+        """
+        Whether the word-level contexts of 'constructor' follow from a scan, 
+        i.e. unless they are those of a 2nd pass that is eager or of v2, or 
+        of v3, whose unmasked padding depends on the width of a mini-batch. 
+        """
+        if self.version == 3:
+            return False
+        if not constructor.is2ndPass:
+            return True
+        return self.version == 1 and \
+               all( s.lazy for s in chain( constructor.sentence1, constructor.sentence2 ) )
+
+
+
+    def scan_sentence( self, sentence, embed, pad, context_limit ):
+        """
+        Returns
+        -------
+            left, right : ndarray
+                what fofe_scan returns for both sides of 'sentence'
+        """
+        if self.version == 1 and sentence.lazy:
+            left_token, left_next, right_token, right_next = sentence.context_chain()
+        else:
+            left_token = right_token = numpy.asarray( sentence.numeric, dtype = numpy.int32 )
+            position = numpy.arange( len(left_token), dtype = numpy.int32 )
+            left_next = position - 1
+            right_next = numpy.where( position + 1 < len(position), position + 1, -1 )
+
+        if self.version == 1:
+            alpha, window, weight = sentence.alpha, sentence.window, None
+        else:
+            alpha, window = self.config.word_alpha, context_limit
+            weight = (left_token != pad).astype( numpy.float32 )
+
+        return fofe_scan( left_token, left_next, embed, alpha, window, weight ), \
+               fofe_scan( right_token, right_next, embed, alpha, window, weight )
+
+
+
+    def scan_context( self, constructor, candidate, context_limit = 64, cache = None ):
+        """
+        Same as context_v1 or context_v2 of the mini-batch of 'candidate', 
+        except that the contexts of each sentence are scanned once instead of 
+        being summed over for each of its spans. 
+
+        Parameters
+        ----------
+            constructor : batch_constructor or batch_constructor_v2
+                one that is scannable
+            candidate : ndarray
+                examples of the mini-batch
+            context_limit : int
+                that of batch_constructor_v2.mini_batch
+            cache : dict
+                if given, scanned sentences are looked up and stored in it
+
+        Returns
+        -------
+            context : dict
+        """
+        if cache is None:
+            cache = {}
+        sentence_id = constructor.example_sentence_id[candidate]
+        begin = constructor.example_begin[candidate]
+        end = constructor.example_end[candidate]
+        unique, inverse = numpy.unique( sentence_id, return_inverse = True )
+
+        context = {}
+        for k, (bits, sentences, embed, pad) in enumerate( [ 
+                (1 | 2, constructor.sentence1, 'word_embed1', self.pad1),
+                (8 | 16, constructor.sentence2, 'word_embed2', self.pad2) ] ):
+            if self.config.feature_choice & bits == 0:
+                continue
+
+            left, right = [], []
+            for i in unique:
+                if (k, i) not in cache:
+                    cache[(k, i)] = self.scan_sentence( sentences[i], self.param[embed], 
+                                                        pad, context_limit )
+                left.append( cache[(k, i)][0] )
+                right.append( cache[(k, i)][1] )
+
+            # row j + 1 of a table of sentence i is row offset[i] + j + 1 of them all
+            offset = numpy.cumsum( [ 0 ] + [ len(table) for table in left[:-1] ] )[inverse]
+            left, right = numpy.concatenate( left ), numpy.concatenate( right )
+
+            incl, excl = 2 * k + 1, 2 * k + 2
+            if self.config.feature_choice & (1 << (3 * k)) > 0:
+                context['l%d' % incl] = left[offset + end]
+                context['r%d' % incl] = right[offset + begin + 1]
+            if self.config.feature_choice & (2 << (3 * k)) > 0:
+                context['l%d' % excl] = left[offset + begin]
+                context['r%d' % excl] = right[offset + end + 1]
+        return context
+
+
+
+    def eval_scan( self, constructor, n_batch_size, context_limit = 64 ):
+        """
+        Same as eval over mini_batch( n_batch_size, False, 1, 1, feature_choice ) 
+        of 'constructor' in inference, but the word-level contexts are given 
+        by scan_context. The sparse or padded contexts are neither built nor 
+        projected span by span; a sentence with n words has O(n ^ 2) spans 
+        but only n positions to scan. Constructors that are not scannable are 
+        evaluated as usual. 
+
+        Yields
+        ------
+            example : tuple or dict
+                the mini-batch, without the word-level contexts if scanned
+            evaluation : tuple
+                c, pi, pv, what eval returns for it
+        """
+        feature_choice = self.config.feature_choice
+        kwargs = { 'context_limit' : context_limit } if self.version > 1 else {}
+
+        if not self.scannable( constructor ):
+            for example in constructor.mini_batch( n_batch_size, False, 1, 1, 
+                                                   feature_choice, **kwargs ):
+                yield example, self.eval( example )
+            return
+
+        candidate = sample_candidate( constructor, False, 1, 1 )
+        cache = {}
+        for begin in xrange( 0, len(candidate), n_batch_size ):
+            batch = candidate[begin:begin + n_batch_size]
+            # the contexts are left out of the mini-batch
+            example = next( constructor.mini_batch( n_batch_size, False, 1, 1, 
+                                                    feature_choice & ~(1 | 2 | 8 | 16), 
+                                                    candidate = batch, **kwargs ) )
+            # candidates are sorted, so a sentence spans consecutive mini-batches only
+            previous, cache = cache, {}
+            for key in previous:
+                if key[1] >= constructor.example_sentence_id[batch[0]]:
+                    cache[key] = previous[key]
+            context = self.scan_context( constructor, batch, context_limit, cache )
+            yield example, self.eval( example, context )
+
+
+
+    def __predict( self, mini_batch, context ):
+        logits, _ = self.logits( mini_batch, context )
+        log_pv = logits - logits.max( axis = 1, keepdims = True )
+        log_pv -= numpy.log( numpy.exp( log_pv ).sum( axis = 1, keepdims = True ) )
+        pv = numpy.exp( log_pv )
+        return pv.argmax( axis = 1 ), pv, log_pv
+
+
+
+########################################################################
+
+
+def load_mention_net( basename, framework = 'numpy' ):
+    """
+    Parameters
+    ----------
+        basename : str
+            what the trainer saves the model as, i.e. basename.config and
+            the TensorFlow checkpoint or PyTorch state_dict
+        framework : str
+            'numpy' reads basename.npz, which is exported first if it does not
+            exist yet, is older than basename.config, i.e. the trainer has 
+            saved a better epoch since, or cannot be read; 'native' restores 
+            the TensorFlow or PyTorch model, which is also returned if it 
+            cannot be exported, e.g. into a read-only directory
+
+    Returns
+    -------
+        config : mention_config or exported_config
+        mention_net : numpy_mention_net or fofe_mention_net{,_v2,_v3}
+    """
+    npz_path, config_path = basename + '.npz', basename + '.config'
+    if framework == 'numpy' and os.path.exists( npz_path ):
+        if not os.path.exists( config_path ) or \
+                os.path.getmtime( npz_path ) >= os.path.getmtime( config_path ):
+            try:
+                mention_net = numpy_mention_net( npz_path )
+                return mention_net.config, mention_net
+            except Exception as e:
+                logger.warning( '%s cannot be read: %s' % (npz_path, str(e)) )
+        else:
+            logger.info( '%s is older than %s' % (npz_path, config_path) )
+
+    import fofe_mention_net as native
+
+    config = native.mention_config()
+    with open( config_path, 'rb' ) as fp:
+        config.__dict__.update( cPickle.load( fp ).__dict__ )
+
+    if config.version == 2:
+        mention_net = native.fofe_mention_net_v2( config )
+    elif config.version == 3:
+        mention_net = native.fofe_mention_net_v3( config )
+    else:
+        mention_net = native.fofe_mention_net( config )
+    mention_net.fromfile( basename )
+
+    if framework == 'native':
+        return config, mention_net
+
+    try:
+        mention_net.tonpz( npz_path )
+    except (NotImplementedError, IOError, OSError) as e:
+        logger.warning( '%s is run natively: %s' % (basename, str(e)) )
+        return config, mention_net
+    logger.info( '%s exported' % npz_path )
+    del mention_net
+
+    mention_net = numpy_mention_net( npz_path )
+    return mention_net.config, mention_net
@@ -68,6 +68,10 @@ if __name__ == '__main__':
                          help = 'whether or not bow and context share a same word embedding' )
     parser.add_argument( '--n_window', type = int, default = 7,
                          help = 'maximum length of NER candidate' )
+    parser.add_argument( '--fofe_epsilon', type = float, default = 0,
+                         help = 'word-level fofe drops words whose weight is less than it; 0 means not used' )
+    parser.add_argument( '--fofe_max_length', type = int, default = 0,
+                         help = 'word-level fofe covers at most this many words; 0 means not used' )
     parser.add_argument( '--strictly_one_hot', action = 'store_true', default = False,
                          help = 'when gazetteer is used, True if 7-bit match or False 5-bit match' )
     parser.add_argument( '--hope_out', type = int, default = 0,
@@ -96,6 +100,18 @@ if __name__ == '__main__':
     parser.add_argument( '--optimizer', type = str, default = 'momentum', choices = ['momentum', 'adam'] )
     parser.add_argument( '--version', type = int, default = 1, choices = [1, 2, 3],
                          help = 'version consumes less memory' )
+    parser.add_argument( '--bucket_width', type = int, default = 0,
+                         help = 'with --version 2 or 3, mini-batches are made of examples whose ' + \
+                                'contexts are within this many words in length; 0 means not used' )
+    parser.add_argument( '--n_stream_sentence', type = int, default = 4096,
+                         help = 'distant-supervision data is streamed this many sentences at a time; ' + \
+                                '0 means each chunk is loaded as a whole' )
+    parser.add_argument( '--prefetch_chunk', action = 'store_true', default = False,
+                         help = 'the distant-supervision chunk of the next epoch is built by a ' + \
+                                'background process while the current one is trained on; ' + \
+                                'it supersedes --n_stream_sentence' )
+    parser.add_argument( '--dataset_cache', type = str, default = None,
+                         help = 'constructed data sets are saved to and loaded from this directory; None means not used' )
 
     ########################################################################
 
@@ -168,17 +184,21 @@ if __name__ == '__main__':
     # there are 2 sets of vocabulary, case-insensitive and case sensitive
     nt = config.n_label_type if config.is_2nd_pass else 0
     if config.language != 'cmn':
+        # both vocabularies memorize token indices in a same cache
+        cache = token_cache()
         numericizer1 = vocabulary( 
             config.word_embedding + '-case-insensitive.wordlist', 
             config.char_alpha, 
             False,
-            n_label_type = nt 
+            n_label_type = nt,
+            cache = cache
         )
         numericizer2 = vocabulary( 
             config.word_embedding + '-case-sensitive.wordlist', 
             config.char_alpha, 
             True,
-            n_label_type = nt 
+            n_label_type = nt,
+            cache = cache
         )
     else:
         numericizer1 = chinese_word_vocab( 
@@ -191,17 +211,35 @@ if __name__ == '__main__':
             n_label_type = nt
         )
         numericizer1.loadWubiKeyStroke( config.word_embedding + '.wubi' )
+
+    if config.language != 'cmn':
+        wordlist_files = [ config.word_embedding + '-case-insensitive.wordlist', 
+                           config.word_embedding + '-case-sensitive.wordlist' ]
+    else:
+        wordlist_files = [ config.word_embedding + '-char.wordlist', 
+                           config.word_embedding + \
+                               ('-avg.wordlist' if config.average else '-word.wordlist'),
+                           config.word_embedding + '.wubi' ]
     
 
-    try:
-        logger.info( 'Loading compressed gazetteer' )
-        pkl_path = os.path.join( config.data_path, 'kbp-gaz.pkl' )
-        with open( pkl_path, 'rb' ) as fp:
-            kbp_gazetteer = cPickle.load( fp )
-    except:
-        logger.info( 'loading text gazetteer' )
-        txt_path = os.path.join( config.data_path, 'kbp-gaz.txt' )
-        kbp_gazetteer = gazetteer( txt_path, mode = 'KBP' )
+    bin_path = os.path.join( config.data_path, 'kbp-gaz.bin' )
+    if os.path.exists( bin_path ):
+        logger.info( 'Mapping compiled gazetteer' )
+        kbp_gazetteer = compiled_gazetteer( bin_path, config.language )
+    else:
+        try:
+            logger.info( 'Loading compressed gazetteer' )
+            pkl_path = os.path.join( config.data_path, 'kbp-gaz.pkl' )
+            with open( pkl_path, 'rb' ) as fp:
+                kbp_gazetteer = cPickle.load( fp )
+        except:
+            logger.info( 'loading text gazetteer' )
+            txt_path = os.path.join( config.data_path, 'kbp-gaz.txt' )
+            kbp_gazetteer = gazetteer( txt_path, mode = 'KBP' )
+        kbp_gazetteer = gazetteer_index( kbp_gazetteer, config.language )
+    gazetteer_files = [ os.path.join( config.data_path, 'kbp-gaz' + ext ) 
+                        for ext in [ '.bin', '.pkl', '.txt' ] ]
+    gazetteer_files = [ f for f in gazetteer_files if os.path.exists( f ) ]
 
     source = imap( 
         lambda x: x[:4],
@@ -216,58 +254,68 @@ if __name__ == '__main__':
             ) 
         )
 
-    if args.version > 1:
-        human = batch_constructor_v2( 
-            source,
-            numericizer1, 
-            numericizer2, 
-            gazetteer = kbp_gazetteer,  
-            window = config.n_window, 
-            n_label_type = config.n_label_type,
-            language = config.language,
-            is_2nd_pass = args.is_2nd_pass 
-        )
-    else:
-        human = batch_constructor( 
-            source,
+    def BuildDataset( source ):
+        if args.version > 1:
+            return batch_constructor_v2( 
+                source,
+                numericizer1, 
+                numericizer2, 
+                gazetteer = kbp_gazetteer,  
+                window = config.n_window, 
+                n_label_type = config.n_label_type,
+                language = config.language,
+                is_2nd_pass = args.is_2nd_pass,
+                feature_choice = config.feature_choice 
+            )
+        else:
+            return batch_constructor( 
+                source,
+                numericizer1, 
+                numericizer2, 
+                gazetteer = kbp_gazetteer, 
+                alpha = config.word_alpha, 
+                fofe_epsilon = config.fofe_epsilon,
+                fofe_max_length = config.fofe_max_length,
+                window = config.n_window, 
+                n_label_type = config.n_label_type,
+                language = config.language,
+                is2ndPass = args.is_2nd_pass,
+                feature_choice = config.feature_choice 
+            )
+
+    def LoadDataset( source, corpus_files ):
+        # keyed by everything the constructed data set depends on
+        return cached_dataset( 
+            args.dataset_cache,
+            lambda : BuildDataset( source ),
+            corpus_files + wordlist_files + gazetteer_files,
             numericizer1, 
-            numericizer2, 
-            gazetteer = kbp_gazetteer, 
+            numericizer2,
+            version = 2 if args.version > 1 else 1,
+            vocabulary_label_type = nt,
             alpha = config.word_alpha, 
+            fofe_epsilon = config.fofe_epsilon,
+            fofe_max_length = config.fofe_max_length,
             window = config.n_window, 
             n_label_type = config.n_label_type,
             language = config.language,
-            is2ndPass = args.is_2nd_pass 
+            is2ndPass = args.is_2nd_pass,
+            feature_choice = config.feature_choice 
         )
+
+    human = LoadDataset( 
+        source, 
+        [ config.data_path + '/%s-train-parsed' % config.language ] + \
+            ([ 'iflytek-clean-%s' % config.language ] if args.iflytek else [])
+    )
     logger.info( 'human: ' + str(human) )
     
-    if args.version > 1:
-        valid = batch_constructor_v2( 
-            imap( lambda x: x[:4], 
-                  LoadED( config.data_path + '/%s-eval-parsed' % config.language ) 
-            ), 
-            numericizer1, 
-            numericizer2, 
-            gazetteer = kbp_gazetteer, 
-            window = config.n_window, 
-            n_label_type = config.n_label_type,
-            language = config.language,
-            is_2nd_pass = args.is_2nd_pass 
-        )
-    else:
-        valid = batch_constructor( 
-            imap( lambda x: x[:4], 
-                  LoadED( config.data_path + '/%s-eval-parsed' % config.language ) 
-            ), 
-            numericizer1, 
-            numericizer2, 
-            gazetteer = kbp_gazetteer, 
-            alpha = config.word_alpha, 
-            window = config.n_window, 
-            n_label_type = config.n_label_type,
-            language = config.language,
-            is2ndPass = args.is_2nd_pass 
-        )
+    valid = LoadDataset( 
+        imap( lambda x: x[:4], 
+              LoadED( config.data_path + '/%s-eval-parsed' % config.language ) 
+        ), 
+        [ config.data_path + '/%s-eval-parsed' % config.language ]
+    )
     logger.info( 'valid: ' + str(valid) )
     
     # test = batch_constructor( 
@@ -287,21 +335,56 @@ if __name__ == '__main__':
     logger.info( 'test: ' + str(test) )
 
     logger.info( 'data set loaded' )
+    if config.language != 'cmn':
+        logger.info( 'token cache: ' + str(cache) )
 
 
     ################### let's compute ####################
 
     prev_cost, decay_started = 2054, False
 
+    # length bucketing only applies to batch_constructor_v2
+    bucket = lambda data : { 'bucket_width' : args.bucket_width } \
+                           if isinstance( data, batch_constructor_v2 ) else {}
+
     infinite_human = human.infinite_mini_batch_multi_thread( 
         config.n_batch_size, 
         True, 
         config.overlap_rate, 
         config.disjoint_rate, 
         config.feature_choice, 
-        True 
+        True,
+        **bucket( human )
     )
 
+    def DistantSupervision( n_epoch ):
+        X, Y = n_epoch / 16, n_epoch % (16 if not args.iflytek else 4)
+        return distant_supervision_parser( 
+                'distant-supervision/data-chunk/sentence-%02d' % X,
+                'distant-supervision/data-chunk/labels-%02d' % X,
+                Y, None, 64 if not args.iflytek else 16  )
+
+    if config.enable_distant_supervision and args.prefetch_chunk:
+        prefetch = chunk_prefetcher( 
+            lambda n_epoch : batch_constructor( 
+                DistantSupervision( n_epoch ), 
+                numericizer1, 
+                numericizer2, 
+                gazetteer = kbp_gazetteer, 
+                alpha = config.word_alpha, 
+                fofe_epsilon = config.fofe_epsilon,
+                fofe_max_length = config.fofe_max_length,
+                window = config.n_window, 
+                n_label_type = config.n_label_type,
+                language = config.language,
+                feature_choice = config.feature_choice 
+            ),
+            config.max_iter, 
+            numericizer1, 
+            numericizer2, 
+            args.buffer_dir 
+        )
+
     if args.version > 1:
         target = lambda x : x['target']
     else:
@@ -326,35 +409,59 @@ if __name__ == '__main__':
         ########## go through training set ##########
         #############################################
 
-        if config.enable_distant_supervision:
-            X, Y = n_epoch / 16, n_epoch % (16 if not args.iflytek else 4)
-            dsp = distant_supervision_parser( 
-                    'distant-supervision/data-chunk/sentence-%02d' % X,
-                    'distant-supervision/data-chunk/labels-%02d' % X,
-                    Y, None, 64 if not args.iflytek else 16  )
-            train = batch_constructor( 
-                dsp, 
-                numericizer1, 
-                numericizer2, 
-                gazetteer = kbp_gazetteer, 
-                alpha = config.word_alpha, 
-                window = config.n_window, 
-                n_label_type = config.n_label_type,
-                language = config.language 
-            )
+        if config.enable_distant_supervision and args.prefetch_chunk:
+            train = prefetch.next()
             logger.info( 'train: ' + str(train) )
+        elif config.enable_distant_supervision:
+            dsp = DistantSupervision( n_epoch )
+            if args.n_stream_sentence > 0:
+                train = batch_constructor_stream( 
+                    dsp, 
+                    numericizer1, 
+                    numericizer2, 
+                    n_sentence = args.n_stream_sentence,
+                    gazetteer = kbp_gazetteer, 
+                    alpha = config.word_alpha, 
+                    fofe_epsilon = config.fofe_epsilon,
+                    fofe_max_length = config.fofe_max_length,
+                    window = config.n_window, 
+                    n_label_type = config.n_label_type,
+                    language = config.language,
+                    feature_choice = config.feature_choice 
+                )
+            else:
+                train = batch_constructor( 
+                    dsp, 
+                    numericizer1, 
+                    numericizer2, 
+                    gazetteer = kbp_gazetteer, 
+                    alpha = config.word_alpha, 
+                    fofe_epsilon = config.fofe_epsilon,
+                    fofe_max_length = config.fofe_max_length,
+                    window = config.n_window, 
+                    n_label_type = config.n_label_type,
+                    language = config.language,
+                    feature_choice = config.feature_choice 
+                )
+                logger.info( 'train: ' + str(train) )
         else:
             train = human
 
         # phar is used to observe training progress
         logger.info( 'epoch %2d, learning-rate: %f' % \
                         (n_epoch + 1, mention_net.config.learning_rate) )
-        total = len(train.positive) + \
-                int(len(train.overlap) * config.overlap_rate) + \
-                int(len(train.disjoint) * config.disjoint_rate)
+        # the size of a stream is not known in advance
+        streamed = isinstance( train, batch_constructor_stream )
+        if streamed:
+            total = None
+        else:
+            total = len(train.positive) + \
+                    int(len(train.overlap) * config.overlap_rate) + \
+                    int(len(train.disjoint) * config.disjoint_rate)
         pbar = tqdm( total = total )
 
         cost, cnt = 0, 0
+        padding, n_padded = 0, 0
             
         for x in ifilter(
             lambda x : len(target(x)) == config.n_batch_size,
@@ -363,7 +470,8 @@ if __name__ == '__main__':
                 True, 
                 config.overlap_rate, 
                 config.disjoint_rate, 
-                config.feature_choice 
+                config.feature_choice,
+                **bucket( train )
             ) 
         ):
             if config.enable_distant_supervision:
@@ -374,6 +482,13 @@ if __name__ == '__main__':
                 x = [ x ]
 
             for example in x:
+                # padding is measured before the model converts the mini-batch
+                if isinstance( example, dict ):
+                    ratio = human.padding_ratio( example )
+                    logger.debug( 'padding ratio %f' % ratio )
+                    padding += ratio
+                    n_padded += 1
+
                 c = mention_net.train( example )
 
                 cost += c * len(target(example))
@@ -381,8 +496,12 @@ if __name__ == '__main__':
             pbar.update( len(target(example)) )
 
         pbar.close()
+        if streamed:
+            logger.info( 'train: ' + str(train) )
         train_cost = cost / cnt 
         logger.info( 'training set iterated, %f' % train_cost )
+        if n_padded > 0:
+            logger.info( 'average padding ratio of %d mini-batches, %f' % (n_padded, padding / n_padded) )
 
         ########################################################################
 
@@ -512,4 +631,7 @@ if __name__ == '__main__':
             mention_net.config.learning_rate *= 0.5 ** ((4./ config.max_iter) if config.drop_rate > 0 else (1./ 2))
         mention_net.config.drop_rate *= 0.5 ** (2./ config.max_iter)
 
+    if config.enable_distant_supervision and args.prefetch_chunk:
+        prefetch.close()
+
     logger.info( 'results are written in kbp-result/kbp-{valid,test}.predicted' )
@@ -33,6 +33,7 @@ INFO "intermediate files are put in ${dir}"
 
 cp -f -R -L ${train_path} ${dir}/kbp
 cp -f -L ${train_path}/../kbp-gaz.pkl ${dir}/kbp-gaz.pkl
+${this_dir}/scripts/compile-gazetteer.py ${dir}/kbp-gaz.pkl ${dir}/kbp-gaz.bin
 train_path=${dir}/kbp
 
 cp -f -R -L ${eval_path} ${dir}/eval
@@ -46,6 +47,7 @@ do
     mkdir -p ${dst}/${language}-train-parsed
     mkdir -p ${dst}/${language}-eval-parsed
     ln -s ${dir}/kbp-gaz.pkl ${dst}/kbp-gaz.pkl
+    ln -s ${dir}/kbp-gaz.bin ${dst}/kbp-gaz.bin
 done
 INFO "folders are created"
 
@@ -77,6 +77,8 @@ if __name__ == '__main__':
         valid = batch_constructor( source,
                                    numericizer1, numericizer2, gazetteer = kbp_gazetteer, 
                                    alpha = config.word_alpha, window = config.n_window, 
+                                   fofe_epsilon = getattr( config, 'fofe_epsilon', 0 ),
+                                   fofe_max_length = getattr( config, 'fofe_max_length', 0 ),
                                    n_label_type = config.n_label_type,
                                    language = config.language )
         logger.info( 'valid: ' + str(valid) )
@@ -90,6 +92,8 @@ if __name__ == '__main__':
         test = batch_constructor(  source,
                                    numericizer1, numericizer2, gazetteer = kbp_gazetteer, 
                                    alpha = config.word_alpha, window = config.n_window, 
+                                   fofe_epsilon = getattr( config, 'fofe_epsilon', 0 ),
+                                   fofe_max_length = getattr( config, 'fofe_max_length', 0 ),
                                    n_label_type = config.n_label_type,
                                    language = config.language )
         logger.info( 'test: ' + str(test) )
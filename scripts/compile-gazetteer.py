@@ -0,0 +1,54 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Filename    : compile-gazetteer.py
+Description : Compile a gazetteer, either a text file read by gazetteer() or a 
+              pickled list of sets like kbp-gaz.pkl, into the binary format of 
+              compiled_gazetteer. The binary file is memory-mapped instead of 
+              being loaded, so that trainers and evaluators running side by side 
+              share one copy of it.
+
+License: MIT License (see ../LICENSE)
+"""
+
+import argparse, logging, cPickle
+from itertools import islice
+
+logger = logging.getLogger( __name__ )
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'in_path', type = str,
+                         help = 'e.g. processed-data/kbp-gaz.pkl or processed-data/kbp-gaz.txt' )
+    parser.add_argument( 'out_path', type = str,
+                         help = 'e.g. processed-data/kbp-gaz.bin' )
+    parser.add_argument( '--mode', type = str, default = 'KBP',
+                         choices = [ 'KBP', 'CoNLL2003' ],
+                         help = 'format of in_path if it is a text file' )
+    args = parser.parse_args()
+    logger.info( str(args) + '\n' )
+
+    from gigaword2feature import *
+
+    try:
+        with open( args.in_path, 'rb' ) as fp:
+            source = cPickle.load( fp )
+        logger.info( 'pickled gazetteer loaded' )
+    except:
+        source = gazetteer( args.in_path, mode = args.mode )
+
+    compile_gazetteer( source, args.out_path )
+
+    # sanity check
+    compiled = compiled_gazetteer( args.out_path )
+    assert len(compiled) == len(source)
+    for k, names in enumerate( source ):
+        assert len(compiled[k]) == len(set( n.decode('utf-8') if isinstance(n, str) else n 
+                                            for n in names ))
+        for name in islice( names, 1000 ):
+            assert name in compiled[k]
+    logger.info( '%s verified' % args.out_path )
@@ -44,33 +44,25 @@ if __name__ == '__main__':
                          help = 'input file, one tokenized sentence per line' )
     parser.add_argument( 'output', type = str,
                          help = 'output file, original sentences followed by offsets and mention types' )
+    parser.add_argument( '--framework', type = str, default = 'numpy', choices = [ 'numpy', 'native' ],
+                         help = 'numpy runs model.npz, exported first if missing or stale, ' + \
+                                'whose agreement export-numpy-model.py --check verifies; ' + \
+                                'native runs the TensorFlow or PyTorch model' )
 
     args = parser.parse_args()
     logger.info( str(args) + '\n' ) 
 
-    from fofe_mention_net import *
+    from fofe_mention_numpy import *
     idx2ner = [ 'PER', 'LOC', 'ORG', 'MISC', 'O' ]
 
-    ########## load model configuration ##########
-
-    # config_path = os.path.join( os.path.dirname(__file__), 
-    #                             'conll2003-model', 
-    #                             'hopeless.config' )
-    config_path = '%s.config' % args.model
-    with open( config_path, 'rb' ) as fp:
-        config = cPickle.load( fp )
-    logger.info( config.__dict__ )
-    logger.info( 'config loaded' )
-
-    ########## load model parameters ##########
+    ########## load model configuration & parameters ##########
 
     # param_path = os.path.join( os.path.dirname(__file__), 
     #                            'conll2003-model',
     #                            'hopeless' )
-    param_path = args.model
-    mention_net = fofe_mention_net( config )
-    mention_net.fromfile( param_path )
-    logger.info( 'model loaded' )
+    config, mention_net = load_mention_net( args.model, args.framework )
+    logger.info( config.__dict__ )
+    logger.info( 'config & model loaded' )
 
     ########## load vocabulary ##########
 
@@ -96,6 +88,8 @@ if __name__ == '__main__':
                               numericizer1, numericizer2, 
                               gazetteer = conll2003_gazetteer, 
                               alpha = config.word_alpha, 
+                              fofe_epsilon = getattr( config, 'fofe_epsilon', 0 ),
+                              fofe_max_length = getattr( config, 'fofe_max_length', 0 ),
                               window = config.n_window, 
                               n_label_type = config.n_label_type )
     logger.info( 'data: ' + str(data) + '\n' )
@@ -107,11 +101,15 @@ if __name__ == '__main__':
         os.makedirs( buf_dir )
     buf_path = os.path.join( buf_dir, 'eval-buffer' )
 
+    n_batch_size = 256 if config.feature_choice & (1 << 9) > 0 else 1024
+    if isinstance( mention_net, numpy_mention_net ):
+        evaluation = mention_net.eval_scan( data, n_batch_size )
+    else:
+        evaluation = ( (example, mention_net.eval( example )) for example in 
+                       data.mini_batch_multi_thread( n_batch_size, False, 1, 1, config.feature_choice ) )
+
     with open( buf_path, 'wb' ) as buff_file:
-        for example in data.mini_batch_multi_thread( 
-                        256 if config.feature_choice & (1 << 9) > 0 else 1024,  
-                        False, 1, 1, config.feature_choice ):
-            _, pi, pv = mention_net.eval( example )
+        for _, (_, pi, pv) in evaluation:
 
             # expcted has gargadge values
             for estimate, probability in zip( pi, pv ):
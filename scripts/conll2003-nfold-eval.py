@@ -15,11 +15,17 @@ if __name__ == '__main__':
     parser.add_argument( 'combined_out', type = str,
                          help = 'average probability' )
     parser.add_argument( '--is_2nd_pass', action = 'store_true', default = False )
+    parser.add_argument( '--framework', type = str, default = 'numpy', choices = [ 'numpy', 'native' ],
+                         help = 'numpy runs basename.npz, exported first if missing or stale, ' + \
+                                'whose agreement export-numpy-model.py --check verifies; ' + \
+                                'native runs the TensorFlow or PyTorch model' )
+    parser.add_argument( '--dataset_cache', type = str, default = None,
+                         help = 'constructed data sets are saved to and loaded from this directory; None means not used' )
 
     args = parser.parse_args()
     logger.info( str(args) + '\n' ) 
 
-    from fofe_mention_net import *
+    from fofe_mention_numpy import *
 
     ########## load gazetteer ##########
 
@@ -28,6 +34,12 @@ if __name__ == '__main__':
     conll2003_gazetteer = gazetteer( gazetteer_path )
     # conll2003_gazetteer = [ set() for _ in xrange(10) ]
 
+    # what testb depends on besides its settings, see --dataset_cache
+    dependency = [ args.testb, gazetteer_path ] + \
+                 [ os.path.join( os.path.dirname(__file__), '../conll2003-model', 
+                                 'reuters256-case-%s.wordlist' % case )
+                   for case in [ 'insensitive', 'sensitive' ] ]
+
     ########## compute probability ##########
 
     algorithm = numpy.zeros( (4,), dtype = numpy.int32 )
@@ -37,11 +49,9 @@ if __name__ == '__main__':
         # basename = os.path.join( os.path.dirname(__file__),
         #                          'conll2003-model', 'split-%d' % i )
         basename = '%s-%d' % (args.basename, i)
-        config = mention_config()
-        with open( '%s.config' % basename, 'rb' ) as fp:
-             config.__dict__.update( cPickle.load( fp ).__dict__ )
+        config, mention_net = load_mention_net( basename, args.framework )
         logger.info( config.__dict__ )
-        logger.info( 'config of split-%d loaded' % i )
+        logger.info( 'config & model of split-%d loaded' % i )
 
 
         ########## load vocabulary ##########
@@ -67,29 +77,40 @@ if __name__ == '__main__':
             assert window == config.n_window, 'inconsistent window'
             threshold += config.threshold
 
-        ########## load network ##########
-
-        mention_net = fofe_mention_net( config )
-        mention_net.fromfile( basename )
-        logger.info( 'model of split-%d loaded' % i )
-
         ########## load testb ##########
 
-        test = batch_constructor( CoNLL2003( args.testb ), 
-                                  numericizer1, numericizer2, 
-                                  gazetteer = conll2003_gazetteer, 
-                                  alpha = config.word_alpha, 
-                                  window = config.n_window,
-                                  is2ndPass = args.is_2nd_pass )
+        # the 5 splits usually share the same settings and thus the same testb
+        test = cached_dataset( args.dataset_cache,
+                               lambda : batch_constructor( CoNLL2003( args.testb ), 
+                                                           numericizer1, numericizer2, 
+                                                           gazetteer = conll2003_gazetteer, 
+                                                           alpha = config.word_alpha, 
+                                                           fofe_epsilon = config.fofe_epsilon,
+                                                           fofe_max_length = config.fofe_max_length,
+                                                           window = config.n_window,
+                                                           is2ndPass = args.is_2nd_pass ),
+                               dependency,
+                               numericizer1, numericizer2,
+                               version = 1,
+                               vocabulary_label_type = nt,
+                               alpha = config.word_alpha, 
+                               fofe_epsilon = config.fofe_epsilon,
+                               fofe_max_length = config.fofe_max_length,
+                               window = config.n_window,
+                               is2ndPass = args.is_2nd_pass )
         logger.info( 'testb loaded' )
 
         ########## compute probability ##########
 
+        n_batch_size = 256 if config.feature_choice & (1 << 9) > 0 else 1024
+        if isinstance( mention_net, numpy_mention_net ):
+            evaluation = mention_net.eval_scan( test, n_batch_size )
+        else:
+            evaluation = ( (example, mention_net.eval( example )) for example in 
+                           test.mini_batch_multi_thread( n_batch_size, False, 1, 1, config.feature_choice ) )
+
         target_i, probability_i = [], []
-        for example in test.mini_batch_multi_thread( 
-                            256 if config.feature_choice & (1 << 9) > 0 else 1024, 
-                            False, 1, 1, config.feature_choice ):
-            _, _, pv = mention_net.eval( example )
+        for example, (_, _, pv) in evaluation:
             for e, p in zip( example[-1], pv ):
                 target_i.append( e )
                 probability_i.append( p )
@@ -0,0 +1,78 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Filename    : export-numpy-model.py
+Description : Export trained models, whatever their backend, to basename.npz,
+              which fofe_mention_numpy runs without TensorFlow or PyTorch.
+              With '--check', the exported model, with and without scanned
+              contexts, is compared against the original one on the 
+              mini-batches of a CoNLL2003-format file.
+
+License: MIT License (see ../LICENSE)
+"""
+
+import numpy, argparse, logging
+
+logger = logging.getLogger( __name__ )
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'basename', type = str, nargs = '+',
+                         help = 'what the trainer saves the model as, e.g. kbp-result/kbp-model' )
+    parser.add_argument( '--check', type = str, default = None,
+                         help = 'a file in CoNLL2003 format whose probabilities are compared' )
+    parser.add_argument( '--wordlist', type = str, default = None,
+                         help = 'wordlist.{-case-insensitive, -case-sensitive}.wordlist ' + \
+                                'numericize --check; basename\'s are used by default' )
+    parser.add_argument( '--tolerance', type = float, default = 1e-4 )
+    args = parser.parse_args()
+
+    from fofe_mention_numpy import *
+
+    n_mismatch = 0
+    for basename in args.basename:
+        config, mention_net = load_mention_net( basename, 'native' )
+        mention_net.tonpz( basename + '.npz' )
+        logger.info( '%s.npz exported' % basename )
+
+        if args.check is None:
+            continue
+
+        exported = numpy_mention_net( basename + '.npz' )
+        wordlist = args.wordlist or basename
+        numericizer1 = vocabulary( wordlist + '-case-insensitive.wordlist', config.char_alpha, False )
+        numericizer2 = vocabulary( wordlist + '-case-sensitive.wordlist', config.char_alpha, True )
+
+        if config.version > 1:
+            data = batch_constructor_v2( CoNLL2003( args.check ), numericizer1, numericizer2,
+                                         window = config.n_window,
+                                         n_label_type = config.n_label_type )
+        else:
+            data = batch_constructor( CoNLL2003( args.check ), numericizer1, numericizer2,
+                                      alpha = config.word_alpha,
+                                      fofe_epsilon = config.fofe_epsilon,
+                                      fofe_max_length = config.fofe_max_length,
+                                      window = config.n_window,
+                                      n_label_type = config.n_label_type )
+
+        difference = 0
+        for example, (_, (_, _, scanned)) in izip( data.mini_batch( 512, False, 1, 1, config.feature_choice ),
+                                                   exported.eval_scan( data, 512 ) ):
+            # v3's eval modifies the mini-batch in place
+            _, expected = exported.predict( example )
+            _, _, actual = mention_net.eval( example )
+            difference = max( difference, numpy.abs( expected - actual ).max(), 
+                              numpy.abs( scanned - actual ).max() )
+
+        logger.info( '%s: largest difference of probability %e' % (basename, difference) )
+        if difference > args.tolerance:
+            n_mismatch += 1
+
+    if n_mismatch > 0:
+        logger.error( '%d exported models disagree' % n_mismatch )
+        raise SystemExit( 1 )
@@ -0,0 +1,103 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Filename    : fofe-truncation-report.py
+Description : Compare word-level fofe truncated by '--fofe_epsilon' or
+              '--fofe_max_length' against the untruncated one. For each cutoff,
+              non-zeros per row and the relative L1 error of the left/right
+              context features fed to fofe_mention_net are reported, so that
+              a cutoff can be picked before it is evaluated by training.
+
+License: MIT License (see ./LICENSE)
+"""
+
+import numpy, argparse, logging, time
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger( __name__ )
+
+# positions of (values, indices) in what batch_constructor.mini_batch yields
+context_feature = [ ('l1', 0, 2), ('r1', 1, 3), ('l2', 4, 6), ('r2', 5, 7),
+                    ('l3', 9, 11), ('r3', 10, 12), ('l4', 13, 15), ('r4', 14, 16) ]
+
+
+def ToCSR( values, indices, n_row, n_col ):
+    indices = numpy.asarray( indices ).reshape( -1, 2 )
+    return csr_matrix( (values, (indices[:,0], indices[:,1])), shape = (n_row, n_col) )
+
+
+def ContextFeatures( args, numericizer1, numericizer2,
+                     fofe_epsilon = 0, fofe_max_length = 0 ):
+    data = batch_constructor( CoNLL2003( args.data ),
+                              numericizer1, numericizer2,
+                              alpha = args.word_alpha,
+                              fofe_epsilon = fofe_epsilon,
+                              fofe_max_length = fofe_max_length,
+                              window = args.n_window,
+                              n_label_type = args.n_label_type )
+    n_col = max( len(numericizer1), len(numericizer2) ) + args.n_label_type + 1
+    start = time.time()
+    result = dict( (name, []) for name, _, _ in context_feature )
+    for batch in data.mini_batch( args.n_batch_size, False, 1, 1, 1 | 2 | 8 | 16 ):
+        n_row = len( batch[-1] )
+        for name, v, i in context_feature:
+            result[name].append( ToCSR( batch[v], batch[i], n_row, n_col ) )
+    return result, time.time() - start
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( 'word_embedding', type = str,
+                         help = 'word_embedding.{-case-insensitive, -case-sensitive}.wordlist are used' )
+    parser.add_argument( 'data', type = str,
+                         help = 'a file in CoNLL2003 format, e.g. eng.testa' )
+    parser.add_argument( '--word_alpha', type = float, default = 0.5,
+                         help = 'word-level forgetting factor' )
+    parser.add_argument( '--char_alpha', type = float, default = 0.8,
+                         help = 'char-level forgetting factor' )
+    parser.add_argument( '--n_window', type = int, default = 7,
+                         help = 'maximum length of NER candidate' )
+    parser.add_argument( '--n_label_type', type = int, default = 4 )
+    parser.add_argument( '--n_batch_size', type = int, default = 1024 )
+    parser.add_argument( '--fofe_epsilon', type = str, default = '1e-2,1e-3,1e-4,1e-6',
+                         help = 'comma-separated cutoffs to compare' )
+    parser.add_argument( '--fofe_max_length', type = str, default = '4,8,16,32',
+                         help = 'comma-separated cutoffs to compare' )
+
+    args = parser.parse_args()
+    logger.info( str(args) + '\n' )
+
+    from gigaword2feature import *
+
+    numericizer1 = vocabulary( args.word_embedding + '-case-insensitive.wordlist',
+                               args.char_alpha, False )
+    numericizer2 = vocabulary( args.word_embedding + '-case-sensitive.wordlist',
+                               args.char_alpha, True )
+
+    full, full_time = ContextFeatures( args, numericizer1, numericizer2 )
+    logger.info( 'untruncated: %.2f seconds' % full_time )
+
+    cutoff = [ ('epsilon', float(e), 0) for e in args.fofe_epsilon.split(',') if len(e) > 0 ] + \
+             [ ('max_length', 0, int(m)) for m in args.fofe_max_length.split(',') if len(m) > 0 ]
+
+    for kind, epsilon, max_length in cutoff:
+        truncated, truncated_time = ContextFeatures( args, numericizer1, numericizer2,
+                                                     epsilon, max_length )
+        report = []
+        for name, _, _ in context_feature:
+            nnz_full = sum( m.nnz for m in full[name] )
+            nnz_trunc = sum( m.nnz for m in truncated[name] )
+            n_row = sum( m.shape[0] for m in full[name] )
+            row_max = max( [ numpy.diff( m.indptr ).max() for m in truncated[name] if m.nnz > 0 ] or [0] )
+            error = sum( abs( f - t ).sum() for f, t in zip( full[name], truncated[name] ) )
+            total = sum( abs( f ).sum() for f in full[name] )
+            report.append( '%s nnz/row %.2f -> %.2f (max %d), L1 error %.2e' % \
+                           ( name, float(nnz_full) / max(n_row, 1), float(nnz_trunc) / max(n_row, 1),
+                             row_max, error / max(total, 1e-12) ) )
+        logger.info( '%s = %s: %.2f seconds\n    %s' % \
+                     ( kind, epsilon if kind == 'epsilon' else max_length, truncated_time,
+                       '\n    '.join( report ) ) )
@@ -26,11 +26,15 @@ if __name__ == '__main__':
     parser.add_argument( 'out_dir', type = str )
     parser.add_argument( '--2nd_basename', type = str, default = None )
     parser.add_argument( '--nfold', action = 'store_true', default = False )
+    parser.add_argument( '--framework', type = str, default = 'numpy', choices = [ 'numpy', 'native' ],
+                         help = 'numpy runs basename.npz, exported first if missing or stale, ' + \
+                                'whose agreement export-numpy-model.py --check verifies; ' + \
+                                'native runs the TensorFlow or PyTorch model' )
 
     args = parser.parse_args()
     logger.info( str(args) + '\n' )
 
-    from fofe_mention_net import *
+    from fofe_mention_numpy import *
 
     threshold = numpy.zeros( (2,), dtype = numpy.float32 )
     algorithm = {}
@@ -40,9 +44,7 @@ if __name__ == '__main__':
         basename_list = [ '%s-%d' % (args.basename, i) for i in xrange(5) ]
 
     for basename in basename_list:
-        config = mention_config()
-        with open( basename + '.config', 'rb' ) as fp:
-            config.__dict__.update( cPickle.load( fp ).__dict__ )
+        config, mention_net = load_mention_net( basename, args.framework )
         logger.info( config.__dict__ )
         config_list.append( config )
 
@@ -53,13 +55,6 @@ if __name__ == '__main__':
         else:
             algorithm[config.algorithm] = 1
 
-        if config.version == 2:
-            mention_net = fofe_mention_net_v2( config )
-        elif config.version == 3:
-            mention_net = fofe_mention_net_v3( config )
-        else:
-            mention_net = fofe_mention_net( config )
-        mention_net.fromfile( basename )
         mention_net_list.append( mention_net )
 
     if config.language != 'cmn':
@@ -75,13 +70,18 @@ if __name__ == '__main__':
 
     logger.info( 'config, model & vocab loaded' )
 
-    try:
-        pkl_path = "%s.pkl" % args.basename
-        with open( pkl_path, 'rb' ) as fp:
-            kbp_gazetteer = cPickle.load( fp )
-    except:
-        txt_path = "%s.gaz" % args.basename
-        kbp_gazetteer = gazetteer( txt_path, mode = 'KBP' )
+    bin_path = "%s.bin" % args.basename
+    if os.path.exists( bin_path ):
+        kbp_gazetteer = compiled_gazetteer( bin_path, config.language )
+    else:
+        try:
+            pkl_path = "%s.pkl" % args.basename
+            with open( pkl_path, 'rb' ) as fp:
+                kbp_gazetteer = cPickle.load( fp )
+        except:
+            txt_path = "%s.gaz" % args.basename
+            kbp_gazetteer = gazetteer( txt_path, mode = 'KBP' )
+        kbp_gazetteer = gazetteer_index( kbp_gazetteer, config.language )
 
     idx2ner = [ 'PER_NAM', 'ORG_NAM', 'GPE_NAM', 'LOC_NAM', 'FAC_NAM',
                 'PER_NOM', 'ORG_NOM', 'GPE_NOM', 'LOC_NOM', 'FAC_NOM',
@@ -137,15 +137,23 @@ if __name__ == '__main__':
                         numericizer2, 
                         gazetteer = kbp_gazetteer, 
                         alpha = config.word_alpha, 
+                        fofe_epsilon = config.fofe_epsilon,
+                        fofe_max_length = config.fofe_max_length,
                         window = config.n_window, 
                         n_label_type = config.n_label_type,
                         language = config.language 
                     )
                 logger.info( 'data: ' + str(data) )
 
+                # numpy_mention_net scans the contexts of each sentence once
+                if isinstance( mention_net, numpy_mention_net ):
+                    evaluation = mention_net.eval_scan( data, 512 )
+                else:
+                    evaluation = ( (example, mention_net.eval( example )) for example in 
+                                   data.mini_batch_multi_thread( 512, False, 1, 1, config.feature_choice ) )
+
                 prob = []
-                for example in data.mini_batch_multi_thread( 512, False, 1, 1, config.feature_choice ):
-                    _, pi, pv = mention_net.eval( example )
+                for example, (_, pi, pv) in evaluation:
 
                     prob.append(
                         numpy.concatenate(
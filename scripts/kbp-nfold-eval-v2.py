@@ -20,6 +20,8 @@ if __name__ == '__main__':
     parser.add_argument( 'embedding', type = str,
                          help = 'e.g. word2vec/gw256' )
     parser.add_argument( 'combined_out', type = str )
+    parser.add_argument( '--dataset_cache', type = str, default = None,
+                         help = 'constructed data sets are saved to and loaded from this directory; None means not used' )
 
     args = parser.parse_args()
     logger.info( str(args) + '\n' ) 
@@ -31,8 +33,10 @@ if __name__ == '__main__':
     try:
         with open( args.gazetteer, 'rb' ) as fp:
             kbp_gazetteer = cPickle.load( fp )
+        gazetteer_files = [ args.gazetteer ]
     except:
         kbp_gazetteer = [ set() for _ in xrange(16) ]
+        gazetteer_files = []
 
     ########## compute probability ##########
 
@@ -79,14 +83,34 @@ if __name__ == '__main__':
 
         ########## load test set ##########
 
-        test = batch_constructor_v2( 
-            source,
-            numericizer1, 
-            numericizer2, 
-            gazetteer = kbp_gazetteer, 
+        if config.language != 'cmn':
+            wordlist_files = [ args.embedding + '-case-insensitive.wordlist', 
+                               args.embedding + '-case-sensitive.wordlist' ]
+        else:
+            wordlist_files = [ args.embedding + '-char.wordlist', 
+                               args.embedding + \
+                                   ('-avg.wordlist' if config.average else '-word.wordlist') ]
+
+        # the 5 splits usually share the same settings and thus the same test set
+        test = cached_dataset( 
+            args.dataset_cache,
+            lambda : batch_constructor_v2( 
+                source,
+                numericizer1, 
+                numericizer2, 
+                gazetteer = kbp_gazetteer, 
+                window = config.n_window, 
+                n_label_type = config.n_label_type,
+                language = config.language 
+            ),
+            [ args.eval_parsed ] + wordlist_files + gazetteer_files,
+            numericizer1,
+            numericizer2,
+            version = 2,
             window = config.n_window, 
             n_label_type = config.n_label_type,
-            language = config.language 
+            language = config.language,
+            is2ndPass = False
         )
         logger.info( 'test: ' + str(test) )
         logger.info( 'data set loaded' )
@@ -20,6 +20,8 @@ if __name__ == '__main__':
     parser.add_argument( 'embedding', type = str,
                          help = 'e.g. word2vec/gw256' )
     parser.add_argument( 'combined_out', type = str )
+    parser.add_argument( '--dataset_cache', type = str, default = None,
+                         help = 'constructed data sets are saved to and loaded from this directory; None means not used' )
 
     args = parser.parse_args()
     logger.info( str(args) + '\n' ) 
@@ -31,14 +33,19 @@ if __name__ == '__main__':
     try:
         with open( args.gazetteer, 'rb' ) as fp:
             kbp_gazetteer = cPickle.load( fp )
+        gazetteer_files = [ args.gazetteer ]
     except:
         kbp_gazetteer = [ set() for _ in xrange(16) ]
+        gazetteer_files = []
 
     ########## compute probability ##########
 
     threshold = numpy.zeros( (2, ), dtype = numpy.float32 )
     algorithm = {}
 
+    # token indices are memorized across splits
+    cache = token_cache()
+
     for i in xrange(5):
         ########## load config ##########
 
@@ -73,13 +80,15 @@ if __name__ == '__main__':
                 args.embedding + '-case-insensitive.wordlist', 
                 config.char_alpha, 
                 False,
-                n_label_type = nt
+                n_label_type = nt,
+                cache = cache
             )
             numericizer2 = vocabulary( 
                 args.embedding + '-case-sensitive.wordlist', 
                 config.char_alpha, 
                 True,
-                n_label_type = nt
+                n_label_type = nt,
+                cache = cache
             )
         else:
             numericizer1 = chinese_word_vocab( 
@@ -96,29 +105,59 @@ if __name__ == '__main__':
 
         ########## load test set ##########
 
-        if config.version > 1:
-            test = batch_constructor_v2( 
-                source,
-                numericizer1, 
-                numericizer2, 
-                gazetteer = kbp_gazetteer, 
-                window = config.n_window, 
-                n_label_type = config.n_label_type,
-                language = config.language,
-                is_2nd_pass = config.is_2nd_pass
-            )
+        def BuildDataset():
+            if config.version > 1:
+                return batch_constructor_v2( 
+                    source,
+                    numericizer1, 
+                    numericizer2, 
+                    gazetteer = kbp_gazetteer, 
+                    window = config.n_window, 
+                    n_label_type = config.n_label_type,
+                    language = config.language,
+                    is_2nd_pass = config.is_2nd_pass
+                )
+            else:
+                return batch_constructor( 
+                    source,
+                    numericizer1, 
+                    numericizer2, 
+                    gazetteer = kbp_gazetteer, 
+                    alpha = config.word_alpha, 
+                    fofe_epsilon = getattr( config, 'fofe_epsilon', 0 ),
+                    fofe_max_length = getattr( config, 'fofe_max_length', 0 ),
+                    window = config.n_window, 
+                    n_label_type = config.n_label_type,
+                    language = config.language,
+                    is2ndPass = config.is_2nd_pass
+                )
+
+        if config.language != 'cmn':
+            wordlist_files = [ args.embedding + '-case-insensitive.wordlist', 
+                               args.embedding + '-case-sensitive.wordlist' ]
         else:
-            test = batch_constructor( 
-                source,
-                numericizer1, 
-                numericizer2, 
-                gazetteer = kbp_gazetteer, 
-                alpha = config.word_alpha, 
-                window = config.n_window, 
-                n_label_type = config.n_label_type,
-                language = config.language,
-                is2ndPass = config.is_2nd_pass
-            )
+            wordlist_files = [ args.embedding + '-char.wordlist', 
+                               args.embedding + \
+                                   ('-avg.wordlist' if config.average else '-word.wordlist'),
+                               args.embedding + '.wubi' ]
+
+        # the 5 splits usually share the same settings and thus the same test set
+        test = cached_dataset( 
+            args.dataset_cache,
+            BuildDataset,
+            [ args.eval_parsed ] + wordlist_files + gazetteer_files,
+            numericizer1,
+            numericizer2,
+            version = 2 if config.version > 1 else 1,
+            vocabulary_label_type = nt,
+            alpha = config.word_alpha, 
+            fofe_epsilon = getattr( config, 'fofe_epsilon', 0 ),
+            fofe_max_length = getattr( config, 'fofe_max_length', 0 ),
+            window = config.n_window, 
+            n_label_type = config.n_label_type,
+            language = config.language,
+            is2ndPass = config.is_2nd_pass
+        )
         logger.info( 'test: ' + str(test) )
         logger.info( 'data set loaded' )
 
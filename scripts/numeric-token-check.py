@@ -0,0 +1,171 @@
+#!/eecs/research/asr/mingbin/python-workspace/hopeless/bin/python
+
+"""
+Filename    : numeric-token-check.py
+Description : Check that gigaword2feature.numeric_token_class agrees with the
+              regular expressions it replaces, on systematically generated
+              dates, times, numbers and phone numbers, on random strings and
+              optionally on the tokens of a corpus.
+
+License: MIT License (see ../LICENSE)
+"""
+
+import argparse, logging, random, re, itertools
+
+logger = logging.getLogger( __name__ )
+
+
+################################################################################
+# reference implementation, as it used to be in skipgram-trainer.py
+
+date1 = re.compile(
+    r"^(?:(?:31(\/|-|\.)(?:0?[13578]|1[02]|(?:Jan|Mar|May|Jul|Aug|Oct|Dec)))\1|(?:(?:29|30)(\/|-|\.)(?:0?[1,3-9]|1[0-2]|(?:Jan|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec))\2))(?:(?:1[6-9]|[2-9]\d)?\d{2})$|^(?:29(\/|-|\.)(?:0?2|(?:Feb))\3(?:(?:(?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:(?:16|[2468][048]|[3579][26])00))))$|^(?:0?[1-9]|1\d|2[0-8])(\/|-|\.)(?:(?:0?[1-9]|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep))|(?:1[0-2]|(?:Oct|Nov|Dec)))\4(?:(?:1[6-9]|[2-9]\d)?\d{2})$"
+)
+
+date2 = re.compile(
+    r"^(((\d{4}(\/|-|\.)((0[13578](\/|-|\.)|1[02](\/|-|\.))(0[1-9]|[12]\d|3[01])|(0[13456789](\/|-|\.)|1[012](\/|-|\.))(0[1-9]|[12]\d|30)|02(\/|-|\.)(0[1-9]|1\d|2[0-8])))|((([02468][048]|[13579][26])00|\d{2}([13579][26]|0[48]|[2468][048])))(\/|-|\.)02(\/|-|\.)29)){0,10}$"
+)
+
+number = re.compile(
+    r"^(\+|-)?(([1-9]\d{0,2}(,\d{3})*)|([1-9]\d*)|0)(\.\d+)?$"
+)
+
+phone = re.compile(
+    r"^(?:(?:\+?1\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9])\s*\)|([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*(?:#|x\.?|ext\.?|extension)\s*(\d+))?$"
+)
+
+time = re.compile(
+    r"^(?:(?:([01]?\d|2[0-3]):)?([0-5]?\d):)?([0-5]?\d)$"
+)
+
+has_digit = re.compile( r"^.*[0-9].*$" )
+
+
+def RegexClass( token ):
+    if re.match( has_digit, token ):
+        if re.match( number, token ):
+            return u'<numeric-value>'
+        elif re.match( date1, token ) or re.match( date2, token ):
+            return u'<date-value>'
+        elif re.match( time, token ):
+            return u'<time-value>'
+        elif re.match( phone, token ):
+            return u'<phone-value>'
+        else:
+            return u'<contains-digit>'
+    return None
+
+
+################################################################################
+
+
+def Numbers():
+    integer = [ '0', '00', '7', '12', '123', '1234', '1,234', '12,345,678',
+                '1,23', '1234,567', '0,123', '1,2345', '1,', ',123' ]
+    for sign, i, f in itertools.product( [ '', '+', '-', '+-' ], integer,
+                                         [ '', '.', '.5', '.50', '..1', '.5.' ] ):
+        yield sign + i + f
+
+
+def Dates():
+    day = [ str(d) for d in range(33) ] + [ '%02d' % d for d in range(10) ] + [ '' ]
+    month = [ str(m) for m in range(14) ] + [ '%02d' % m for m in range(10) ] + \
+            [ ',', '0,', 'Foo', '' ] + \
+            [ m for m in 'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split() ] + \
+            [ m.lower() for m in 'Jan Feb Dec'.split() ]
+    year = [ '', '9', '96', '00', '04', '999', '1599', '1600', '1604', '1700', '1900',
+             '2000', '2004', '2100', '1200', '0800', '0400', '3200', '1616', '16000' ]
+    for d, m, y in itertools.product( day, month, year ):
+        for s1, s2 in [ ('/', '/'), ('-', '-'), ('.', '.'), ('/', '-'), ('-', '') ]:
+            yield d + s1 + m + s2 + y
+
+    year = [ '0000', '1900', '1996', '2000', '2001', '2004', '1204', '1200', '12a4' ]
+    month = [ '%02d' % m for m in range(14) ] + [ '1', '2' ]
+    day = [ '%02d' % d for d in range(33) ] + [ '1', '9' ]
+    valid = []
+    for y, m, d in itertools.product( year, month, day ):
+        for s1, s2 in [ ('-', '-'), ('/', '.'), ('.', '/'), ('-', ':') ]:
+            date = y + s1 + m + s2 + d
+            if re.match( date2, date ):
+                valid.append( date )
+            yield date
+    for i in range( 2000 ):
+        yield ''.join( random.choice( valid ) for _ in range( random.randint( 2, 11 ) ) )
+        yield ''.join( random.choice( valid ) for _ in range( 3 ) ) + '1'
+
+
+def Times():
+    part = [ '0', '9', '00', '09', '19', '23', '24', '29', '59', '60', '99', '123', '', 'a' ]
+    for n in range( 1, 5 ):
+        for p in itertools.product( part, repeat = n ):
+            yield ':'.join( p )
+
+
+def Phones():
+    country = [ '', '1', '+1', '+2', '1 ', '1-', '1 - ', '+1.', '+', '11' ]
+    area = [ '', '212', '(212)', '( 212 )', '(911)', '(212', '212)', '112',
+             '291', '290', '911', '201', '(201)' ]
+    separator = [ '', '-', ' ', '.', '- ', '--', '\t.' ]
+    exchange = [ '555', '511', '211', '155', '591', '510', '901', '911', '55' ]
+    line = [ '1234', '123', '12345' ]
+    extension = [ '', '#12', ' x12', 'x.5', 'ext3', 'ext.3', 'extension 44',
+                  ' ext', 'x', 'X1', ' ', 'exten5', 'ext..3' ]
+    for c, a, s1, e, s2, l, x in itertools.product( country, area, separator,
+                                                    exchange, separator, line, extension ):
+        yield c + a + s1 + e + s2 + l + x
+
+
+def Randoms( n ):
+    alphabet = '0123456789' * 3 + '/-.,:+()# \txXetnsioJanFebDc'
+    for _ in xrange( n ):
+        yield ''.join( random.choice( alphabet ) for _ in range( random.randint( 1, 16 ) ) )
+
+
+def Corpus( filename ):
+    with open( filename, 'rb' ) as fp:
+        for line in fp:
+            for token in line.split():
+                yield token
+                yield token.lower()
+
+
+
+if __name__ == '__main__':
+    logging.basicConfig( format = '%(asctime)s : %(levelname)s : %(message)s',
+                         level = logging.INFO )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--corpus', type = str, default = None,
+                         help = 'additionally check every token of this file, one sentence per line' )
+    parser.add_argument( '--n_random', type = int, default = 1000000,
+                         help = 'number of random strings to check' )
+    parser.add_argument( '--seed', type = int, default = 2016 )
+    args = parser.parse_args()
+
+    from gigaword2feature import numeric_token_class
+
+    random.seed( args.seed )
+    source = [ ('number', Numbers()), ('date', Dates()), ('time', Times()),
+               ('phone', Phones()), ('random', Randoms( args.n_random )) ]
+    if args.corpus is not None:
+        source.append( ('corpus', Corpus( args.corpus )) )
+
+    n_mismatch = 0
+    for name, tokens in source:
+        n_token, count = 0, {}
+        for token in tokens:
+            expected = RegexClass( token )
+            n_token += 1
+            count[expected] = count.get( expected, 0 ) + 1
+            if numeric_token_class( token ) != expected:
+                n_mismatch += 1
+                if n_mismatch <= 32:
+                    logger.error( '%r: expected %s, got %s' % \
+                                  ( token, expected, numeric_token_class( token ) ) )
+        logger.info( '%-6s %8d tokens checked, %s' % (name, n_token,
+                     ', '.join( '%s: %d' % kv for kv in sorted( count.items() ) )) )
+
+    if n_mismatch > 0:
+        logger.error( '%d mismatches' % n_mismatch )
+        raise SystemExit( 1 )
+    logger.info( 'numeric_token_class agrees with the regular expressions' )
@@ -28,31 +28,12 @@ from hanziconv import HanziConv
 logger = logging.getLogger()
 
 
-__date1 = re.compile(
-    r"^(?:(?:31(\/|-|\.)(?:0?[13578]|1[02]|(?:Jan|Mar|May|Jul|Aug|Oct|Dec)))\1|(?:(?:29|30)(\/|-|\.)(?:0?[1,3-9]|1[0-2]|(?:Jan|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec))\2))(?:(?:1[6-9]|[2-9]\d)?\d{2})$|^(?:29(\/|-|\.)(?:0?2|(?:Feb))\3(?:(?:(?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:(?:16|[2468][048]|[3579][26])00))))$|^(?:0?[1-9]|1\d|2[0-8])(\/|-|\.)(?:(?:0?[1-9]|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep))|(?:1[0-2]|(?:Oct|Nov|Dec)))\4(?:(?:1[6-9]|[2-9]\d)?\d{2})$".encode('utf8')
-)
-
-__date2 = re.compile(
-    r"^(((\d{4}(\/|-|\.)((0[13578](\/|-|\.)|1[02](\/|-|\.))(0[1-9]|[12]\d|3[01])|(0[13456789](\/|-|\.)|1[012](\/|-|\.))(0[1-9]|[12]\d|30)|02(\/|-|\.)(0[1-9]|1\d|2[0-8])))|((([02468][048]|[13579][26])00|\d{2}([13579][26]|0[48]|[2468][048])))(\/|-|\.)02(\/|-|\.)29)){0,10}$".encode('utf8')
-)
-
-__number = re.compile(
-    r"^(\+|-)?(([1-9]\d{0,2}(,\d{3})*)|([1-9]\d*)|0)(\.\d+)?$".encode('utf8')
-)
-
-__phone = re.compile(
-    r"^(?:(?:\+?1\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9])\s*\)|([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*(?:#|x\.?|ext\.?|extension)\s*(\d+))?$".encode('utf8')
-)
-
-__time = re.compile(
-    r"^(?:(?:([01]?\d|2[0-3]):)?([0-5]?\d):)?([0-5]?\d)$".encode('utf8')
-)
+# the same token classes as the feature extractor, see gigaword2feature.pyx
+from gigaword2feature import numeric_token_class
 
 
 __has_digit_but_no_letter = re.compile( r"^(?=[^A-Za-z]+$).*[0-9].*$".encode('utf8') )
 
-__has_digit = re.compile( r"^.*[0-9].*$".encode('utf8') )
-
 
 
 def sentence_eng( filename, case_sensitive = False ):
@@ -84,19 +65,11 @@ def sentence_eng( filename, case_sensitive = False ):
                 else:
                     s = line.strip().split()
                 for i in xrange(len(s)):
-                    if re.match( __has_digit, s[i] ):
-                        if re.match( __number, s[i] ):
-                            s[i] = u'<numeric-value>'
-                        elif re.match( __date1, s[i] ) or re.match( __date2, s[i] ):
-                            s[i] = u'<date-value>'
-                        elif re.match( __time, s[i] ):
-                            s[i] = u'<time-value>'
-                        elif re.match( __phone, s[i] ):
-                            s[i] = u'<phone-value>'
-                        # elif re.match( __digit_without_letter, s[i] ):
-                        #     s[i] = '<digit_without_letter>'
-                        else:
-                            s[i] = u'<contains-digit>'
+                    # one of <numeric-value>, <date-value>, <time-value>, 
+                    # <phone-value> and <contains-digit> if s[i] has a digit
+                    token_class = numeric_token_class( s[i] )
+                    if token_class is not None:
+                        s[i] = token_class
                 yield s
 
 
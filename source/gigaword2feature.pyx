@@ -13,22 +13,30 @@ cimport cython, numpy
 from libcpp.string cimport string
 from libcpp.vector cimport vector
 from libcpp.map cimport map as ordered_map
+from libcpp.list cimport list as linked_list
+from libcpp.unordered_map cimport unordered_map
+from libcpp.utility cimport pair
+from libc.string cimport strncmp
 from cython.operator cimport dereference, preincrement
+from cpython.ref cimport PyObject
 
 cdef extern from "<algorithm>" namespace "std" nogil:
     void reverse[Iter] ( Iter first, Iter last ) 
+    void sort[Iter] ( Iter first, Iter last ) 
+
+cdef extern from "<math.h>" nogil:
+    float powf( float base, float exponent )
 
-cdef extern from "<regex>" namespace "std" nogil:
-    cdef cppclass regex:
-        regex( string& s ) except +
-    bint regex_match( string& s, regex& r )
 
 from scipy.sparse import csr_matrix
-from Queue import Queue
-from threading import Thread
+from Queue import Queue, Full
+from threading import Thread, Event
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from itertools import izip, islice, imap, combinations, chain
 from hanziconv import HanziConv
-import numpy, re, random, logging, codecs, copy
+import numpy, re, random, logging, codecs, copy, os, mmap, time
+import multiprocessing, tempfile, shutil, traceback, json, hashlib
 
 logger = logging.getLogger()
 
@@ -226,6 +234,372 @@ def gazetteer( filename, mode = 'CoNLL2003' ):
 ################################################################################
 
 
+cdef class gazetteer_index:
+    """
+    Token-level trie over the names of a gazetteer. A name is a path of pieces, 
+    i.e. the space-separated words of an English/Spanish name or the 
+    characters of a Chinese one, and each node keeps a bitmask of the types 
+    whose names end there. All window-bounded spans of a sentence are then 
+    matched by walking the trie from each position instead of joining every 
+    span into a string and probing each type's set. 
+    """
+    cdef dict symbol
+    cdef unordered_map[long long, int] child
+    cdef vector[int] mask
+    cdef readonly int n_type
+    cdef readonly str language
+
+    def __init__( self, gazetteer, language = 'eng' ):
+        """
+        Parameters
+        ----------
+            gazetteer : list of set
+                what gazetteer() returns, gazetteer[i] contains the known NER of the ith mention type
+
+            language : str
+                either 'eng', 'cmn' or 'spa'
+        """
+        assert language in { 'eng', 'cmn', 'spa' }
+        cdef int node, s
+        cdef long long key
+        self.language = language
+        self.n_type = len(gazetteer)
+        self.symbol = {}
+        self.mask.push_back( 0 )
+
+        for k, names in enumerate( gazetteer ):
+            for name in names:
+                node = 0
+                for piece in self.pieces( name ):
+                    s = self.symbol.setdefault( piece, len(self.symbol) )
+                    key = (<long long>node << 32) | s
+                    if self.child.find( key ) == self.child.end():
+                        self.child[key] = self.mask.size()
+                        self.mask.push_back( 0 )
+                    node = self.child[key]
+                self.mask[node] |= 1 << k
+
+        logger.info( 'gazetteer index: %d types, %d nodes, %d distinct pieces' % \
+                     (self.n_type, self.mask.size(), len(self.symbol)) )
+
+
+    def __len__( self ):
+        return self.mask.size()
+
+
+    def pieces( self, name ):
+        # ' '.join( tokens ) of a span splits back into the words of its tokens
+        if self.language != 'cmn':
+            return name.split( ' ' )
+        else:
+            return name
+
+
+    def token_pieces( self, token ):
+        if self.language != 'cmn':
+            return token.split( ' ' )
+        else:
+            return token[:token.find(u'|iNCML|')]
+
+
+    def match( self, sentence, int window ):
+        """
+        Parameters
+        ----------
+            sentence : list of str
+                tokens of a sentence, 'char|iNCML|word' if language is 'cmn'
+
+            window : int
+                the maximum length of a mention
+
+        Returns
+        -------
+            result : numpy.ndarray
+                int32 array of shape (len(sentence), window), result[i, l - 1] has 
+                bit k set iff u' '.join( sentence[i:i + l] ) (u''.join of the char 
+                parts if language is 'cmn') is in gazetteer[k]
+        """
+        cdef int n = len(sentence)
+        cdef vector[int] piece, offset
+        result = numpy.zeros( (n, max(window, 0)), dtype = numpy.int32 )
+        cdef int[:,:] view = result
+
+        offset.push_back( 0 )
+        for token in sentence:
+            for p in self.token_pieces( token ):
+                piece.push_back( self.symbol.get( p, -1 ) )
+            offset.push_back( piece.size() )
+
+        with nogil:
+            self.walk( n, window, piece, offset, view )
+        return result
+
+
+    cdef void walk( self, int n, int window, vector[int]& piece, 
+                    vector[int]& offset, int[:,:] view ) nogil:
+        cdef int i, l, q, node
+        cdef unordered_map[long long, int].iterator found
+        for i in range( n ):
+            node = 0
+            for l in range( 1, min( window, n - i ) + 1 ):
+                for q in range( offset[i + l - 1], offset[i + l] ):
+                    if piece[q] < 0:
+                        node = -1
+                        break
+                    found = self.child.find( (<long long>node << 32) | piece[q] )
+                    if found == self.child.end():
+                        node = -1
+                        break
+                    node = dereference( found ).second
+                if node < 0:
+                    break
+                view[i, l - 1] = self.mask[node]
+
+################################################################################
+
+
+# layout of a compiled gazetteer, all integers are little-endian
+#     magic                  8 bytes
+#     n_type, n_name         int64 x 2
+#     count                  int64 x n_type, number of names of each type
+#     offset                 int64 x (n_name + 1), names[i] is blob[offset[i]:offset[i + 1]]
+#     mask                   int32 x n_name, bit k is set if names[i] is of the kth type
+#     blob                   utf-8 names in byte order, no separator
+compiled_gazetteer_magic = 'iNCMLgz1'
+
+
+def compile_gazetteer( gazetteer, filename ):
+    """
+    Parameters
+    ----------
+        gazetteer : list of set
+            what gazetteer() returns, gazetteer[i] contains the known NER of the ith mention type
+
+        filename : str
+            where the binary gazetteer is written, see compiled_gazetteer
+    """
+    assert len(gazetteer) <= 31, 'at most 31 mention types in a gazetteer'
+    mask = {}
+    for k, names in enumerate( gazetteer ):
+        for name in names:
+            if isinstance( name, unicode ):
+                name = name.encode( 'utf-8' )
+            mask[name] = mask.get( name, 0 ) | (1 << k)
+    names = sorted( mask )
+    mask = numpy.asarray( [ mask[name] for name in names ], dtype = numpy.int32 )
+    count = [ int(((mask >> k) & 1).sum()) for k in xrange( len(gazetteer) ) ]
+    offset = numpy.zeros( (len(names) + 1,), dtype = numpy.int64 )
+    offset[1:] = numpy.cumsum( [ len(name) for name in names ] )
+
+    with open( filename, 'wb' ) as fp:
+        fp.write( compiled_gazetteer_magic )
+        numpy.asarray( [ len(gazetteer), len(names) ] + count, dtype = '<i8' ).tofile( fp )
+        offset.astype( '<i8' ).tofile( fp )
+        mask.astype( '<i4' ).tofile( fp )
+        fp.write( ''.join( names ) )
+    logger.info( '%d names of %d types compiled into %s' % \
+                 (len(names), len(gazetteer), filename) )
+
+
+
+class compiled_gazetteer_set( object ):
+    """ names of one mention type in a compiled_gazetteer, behaves like a read-only set """
+    def __init__( self, compiled, k ):
+        self.compiled = compiled
+        self.k = k
+
+    def __contains__( self, name ):
+        return (self.compiled.type_mask( name ) >> self.k) & 1 == 1
+
+    def __len__( self ):
+        return self.compiled.count[self.k]
+
+    def __iter__( self ):
+        return self.compiled.names( 1 << self.k )
+
+
+
+cdef class compiled_gazetteer:
+    """
+    Gazetteer written by compile_gazetteer and memory-mapped read-only, so that 
+    loading it costs neither time nor private memory and all processes using 
+    the same file share its pages. It is indexed like the list of sets returned 
+    by gazetteer(), and it matches all window-bounded spans of a sentence like 
+    gazetteer_index. Names are sorted, so a span is matched by narrowing the 
+    range of names that start with it while the span grows token by token. 
+    """
+    cdef object buffer
+    cdef const numpy.int64_t[:] offset
+    cdef const numpy.int32_t[:] mask
+    cdef const unsigned char[:] blob
+    cdef long blob_begin
+    cdef readonly int n_type
+    cdef readonly long n_name
+    cdef readonly tuple count
+    cdef readonly str filename
+    cdef readonly str language
+
+    def __init__( self, filename, language = 'eng' ):
+        """
+        Parameters
+        ----------
+            filename : str
+                path to the output of compile_gazetteer
+
+            language : str
+                either 'eng', 'cmn' or 'spa', how match() joins tokens into a name
+        """
+        assert language in { 'eng', 'cmn', 'spa' }
+        self.filename = filename
+        self.language = language
+        with open( filename, 'rb' ) as fp:
+            if fp.read( len(compiled_gazetteer_magic) ) != compiled_gazetteer_magic:
+                raise ValueError( '%s is not a compiled gazetteer' % filename )
+            self.buffer = mmap.mmap( fp.fileno(), 0, access = mmap.ACCESS_READ )
+
+        pos = len(compiled_gazetteer_magic)
+        self.n_type, self.n_name = numpy.frombuffer( self.buffer, '<i8', 2, pos )
+        pos += 16
+        self.count = tuple( numpy.frombuffer( self.buffer, '<i8', self.n_type, pos ).tolist() )
+        pos += 8 * self.n_type
+        self.offset = numpy.frombuffer( self.buffer, '<i8', self.n_name + 1, pos )
+        pos += 8 * (self.n_name + 1)
+        self.mask = numpy.frombuffer( self.buffer, '<i4', self.n_name, pos )
+        pos += 4 * self.n_name
+        self.blob_begin = pos
+        self.blob = numpy.frombuffer( self.buffer, numpy.uint8, self.offset[self.n_name], pos )
+        logger.info( '%d names of %d types mapped from %s; %s' % \
+                     (self.n_name, self.n_type, filename, str(self.count)) )
+
+
+    def __len__( self ):
+        return self.n_type
+
+
+    def __getitem__( self, k ):
+        if not 0 <= k < self.n_type:
+            raise IndexError( 'gazetteer has %d types' % self.n_type )
+        return compiled_gazetteer_set( self, k )
+
+
+    def __iter__( self ):
+        for k in xrange( self.n_type ):
+            yield compiled_gazetteer_set( self, k )
+
+
+    def names( self, int type_mask = -1 ):
+        """ yields, in byte order, names of any type in type_mask """
+        cdef long i
+        for i in range( self.n_name ):
+            if self.mask[i] & type_mask != 0:
+                yield self.buffer[ self.blob_begin + self.offset[i] : 
+                                   self.blob_begin + self.offset[i + 1] ].decode( 'utf-8' )
+
+
+    def type_mask( self, name ):
+        """ bitmask of the types of name, 0 if it is unknown """
+        if isinstance( name, unicode ):
+            name = name.encode( 'utf-8' )
+        cdef bytes key = name
+        cdef long lo = 0, hi = self.n_name
+        self.narrow( &lo, &hi, 0, key, len(key) )
+        if lo < hi and self.offset[lo + 1] - self.offset[lo] == len(key):
+            return self.mask[lo]
+        return 0
+
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef int compare( self, long i, int depth, const char* s, int n ) nogil:
+        # compare bytes [depth, depth + n) of the ith name with s[:n]; 
+        # a name that ends earlier and agrees so far compares less
+        cdef long begin = self.offset[i] + depth
+        cdef long end = self.offset[i + 1]
+        cdef int q
+        cdef unsigned char a, b
+        for q in range( n ):
+            if begin + q >= end:
+                return -1
+            a, b = self.blob[begin + q], <unsigned char>s[q]
+            if a != b:
+                return -1 if a < b else 1
+        return 0
+
+
+    cdef void narrow( self, long* lo, long* hi, int depth, const char* s, int n ) nogil:
+        # names in [lo, hi) agree on their first depth bytes and hence are sorted 
+        # by what follows; keep those whose next n bytes are s[:n]
+        cdef long a = lo[0], b = hi[0], mid
+        while a < b:
+            mid = (a + b) // 2
+            if self.compare( mid, depth, s, n ) < 0:
+                a = mid + 1
+            else:
+                b = mid
+        lo[0] = a
+        b = hi[0]
+        while a < b:
+            mid = (a + b) // 2
+            if self.compare( mid, depth, s, n ) <= 0:
+                a = mid + 1
+            else:
+                b = mid
+        hi[0] = a
+
+
+    def match( self, sentence, int window ):
+        """
+        Parameters
+        ----------
+            sentence : list of str
+                tokens of a sentence, 'char|iNCML|word' if language is 'cmn'
+
+            window : int
+                the maximum length of a mention
+
+        Returns
+        -------
+            result : numpy.ndarray
+                int32 array of shape (len(sentence), window), as gazetteer_index.match
+        """
+        cdef int n = len(sentence)
+        cdef vector[string] token
+        cdef bint spaced = self.language != 'cmn'
+        result = numpy.zeros( (n, max(window, 0)), dtype = numpy.int32 )
+        cdef int[:,:] view = result
+
+        for t in sentence:
+            if self.language == 'cmn':
+                t = t[:t.find(u'|iNCML|')]
+            if isinstance( t, unicode ):
+                t = t.encode( 'utf-8' )
+            token.push_back( t )
+
+        with nogil:
+            self.walk( n, window, token, spaced, view )
+        return result
+
+
+    cdef void walk( self, int n, int window, vector[string]& token, 
+                    bint spaced, int[:,:] view ) nogil:
+        cdef int i, l, depth
+        cdef long lo, hi
+        for i in range( n ):
+            lo, hi, depth = 0, self.n_name, 0
+            for l in range( 1, min( window, n - i ) + 1 ):
+                if spaced and l > 1:
+                    self.narrow( &lo, &hi, depth, ' ', 1 )
+                    depth += 1
+                self.narrow( &lo, &hi, depth, token[i + l - 1].c_str(), token[i + l - 1].size() )
+                depth += token[i + l - 1].size()
+                if lo >= hi:
+                    break
+                if self.offset[lo + 1] - self.offset[lo] == depth:
+                    view[i, l - 1] = self.mask[lo]
+
+################################################################################
+
+
 def CoNLL2003( filename ):
     """
     Parameters
@@ -291,6 +665,467 @@ def prepare_mini_batch( batch_generator, batch_buffer, timeout ):
     batch_buffer.put( None, True, timeout )
 
 
+################################################################################
+
+
+class pooled_tuple( tuple ):
+    """ mini-batch of batch_constructor whose arrays are views of a buffer of a batch_pool """
+
+
+class pooled_dict( dict ):
+    """ mini-batch of batch_constructor_v2 whose arrays are views of a buffer of a batch_pool """
+
+
+class batch_pool( object ):
+    """
+    A few output buffers that mini_batch fills in rotation instead of allocating 
+    new arrays for every mini-batch. A mini-batch yielded this way is a view of 
+    one of the buffers and must be handed back through release() once it is 
+    consumed, e.g. after it is fed to the network; mini_batch waits while all 
+    buffers are in use. With 2 buffers, a background thread fills one while 
+    the other one is consumed. 
+    """
+    def __init__( self, n_buffer = 2 ):
+        """
+        Parameters
+        ----------
+            n_buffer : int
+                number of mini-batches that may be in use at the same time
+        """
+        self.n_buffer = n_buffer
+        self.free = Queue()
+        for _ in xrange( n_buffer ):
+            self.free.put( {} )
+
+
+    def acquire( self ):
+        return self.free.get()
+
+
+    def release( self, batch ):
+        """
+        Parameters
+        ----------
+            batch : pooled_tuple or pooled_dict
+                what mini_batch( ..., pool = self ) yields; none of its arrays 
+                may be used afterwards. Releasing a mini-batch twice is harmless. 
+        """
+        if batch.buffer is not None:
+            self.free.put( batch.buffer )
+            batch.buffer = None
+
+
+def reserve( buffer, key, shape, dtype ):
+    """
+    Returns
+    -------
+        A C-contiguous array of 'shape' that shares memory with buffer[key], 
+        which is reallocated only if it is too small or of another dtype.
+    """
+    size = int( numpy.prod( shape ) )
+    flat = buffer.get( key )
+    if flat is None or flat.shape[0] < size or flat.dtype != numpy.dtype( dtype ):
+        flat = numpy.empty( (max( size, 0 if flat is None else 2 * flat.shape[0] ),), dtype )
+        buffer[key] = flat
+    return flat[:size].reshape( shape )
+
+
+################################################################################
+
+
+def sample_candidate( constructor, bint shuffle_needed = True, float overlap_rate = 0.36, 
+                      float disjoint_rate = 0.08, bint replace = False, int n_copy = 1, 
+                      rng = None ):
+    """
+    Parameters
+    ----------
+        rng : numpy.random.RandomState
+            source of randomness, numpy.random if None
+
+    Returns
+    -------
+        Indices of the examples of 'constructor', a batch_constructor or 
+        batch_constructor_v2, in the order its mini_batch goes through them, 
+        i.e. all positive ones plus sampled overlap and disjoint ones. 
+    """
+    if rng is None:
+        rng = numpy.random
+
+    if n_copy > 1:
+        shuffle_needed = True
+        replace = True
+
+    if len( constructor.disjoint ) > 0: 
+        disjoint = rng.choice( constructor.disjoint,
+                               size = numpy.int32( len(constructor.disjoint) * disjoint_rate * n_copy ),
+                               replace = replace )
+    else:
+        disjoint = numpy.asarray([]).astype( numpy.int32 )
+
+    if len( constructor.overlap ) > 0:
+        overlap = rng.choice( constructor.overlap,
+                              size = numpy.int32( len(constructor.overlap) * overlap_rate * n_copy ),
+                              replace = replace )
+    else:
+        overlap = numpy.asarray([]).astype( numpy.int32 )
+
+    candidate = numpy.concatenate( [ constructor.positive ] * n_copy + [ disjoint, overlap ] )
+
+    if shuffle_needed:
+        rng.shuffle( candidate )
+    else:
+        candidate.sort()
+    return candidate
+
+
+def bucket_candidate( constructor, candidate, int n_batch_size, int bucket_width = 8, 
+                      int context_limit = 64, bint shuffle_needed = True, rng = None ):
+    """
+    Reorder 'candidate', what sample_candidate returns for a batch_constructor_v2, 
+    so that each mini-batch is made of examples whose left and right contexts 
+    fall in the same band of 'bucket_width' words, and is padded to about the 
+    length of its examples instead of the longest context of a random sample. 
+    Examples are shuffled within a band and mini-batches among themselves if 
+    'shuffle_needed', but a partial mini-batch stays last. 
+
+    Parameters
+    ----------
+        rng : numpy.random.RandomState
+            source of randomness, numpy.random if None
+    """
+    if rng is None:
+        rng = numpy.random
+
+    candidate = numpy.asarray( candidate, dtype = numpy.int32 )
+    if shuffle_needed:
+        candidate = candidate[rng.permutation( len(candidate) )]
+
+    # the left context of an example ends at its last word, the right one begins at its first word
+    # either side may be left empty, see 'feature_choice' of batch_constructor_v2
+    length = numpy.fromiter( (max( len(a), len(b) ) for a, b in 
+                                izip( constructor.sentence1, constructor.sentence2 )), 
+                             numpy.int32, len(constructor.sentence1) )
+    n_band = context_limit // bucket_width + 1
+    left = numpy.minimum( constructor.example_end[candidate], context_limit ) // bucket_width
+    right = numpy.minimum( length[constructor.example_sentence_id[candidate]] - 
+                           constructor.example_begin[candidate], context_limit ) // bucket_width
+    candidate = candidate[numpy.argsort( left * n_band + right, kind = 'mergesort' )]
+
+    if shuffle_needed:
+        n_full = len(candidate) // n_batch_size * n_batch_size
+        batches = candidate[:n_full].reshape( -1, n_batch_size )
+        rng.shuffle( batches )
+        candidate = numpy.concatenate( [ batches.ravel(), candidate[n_full:] ] )
+    return candidate
+
+
+def flatten_batch( batch, arrays ):
+    """
+    Append every array of 'batch', a (nested) tuple or dict, to 'arrays' and 
+    return the same structure with arrays replaced by their positions. 
+    """
+    if isinstance( batch, dict ):
+        return dict( (k, flatten_batch( v, arrays )) for k, v in batch.iteritems() )
+    if isinstance( batch, tuple ):
+        return tuple( flatten_batch( v, arrays ) for v in batch )
+    arrays.append( numpy.asarray( batch ) )
+    return len( arrays ) - 1
+
+
+def unflatten_batch( skeleton, arrays ):
+    if isinstance( skeleton, dict ):
+        return dict( (k, unflatten_batch( v, arrays )) for k, v in skeleton.iteritems() )
+    if isinstance( skeleton, tuple ):
+        return tuple( unflatten_batch( v, arrays ) for v in skeleton )
+    return arrays[skeleton]
+
+
+class shared_slot( object ):
+    """
+    A file in shared memory that both a worker of shared_mini_batch and its 
+    parent map. It is grown by the worker whenever a mini-batch does not fit. 
+    """
+    def __init__( self, filename ):
+        self.fp = open( filename, 'w+b' if not os.path.exists( filename ) else 'r+b' )
+        if os.fstat( self.fp.fileno() ).st_size == 0:
+            self.fp.truncate( mmap.PAGESIZE )
+        self.mm = mmap.mmap( self.fp.fileno(), 0 )
+
+
+    def ensure( self, size ):
+        if size > len( self.mm ):
+            self.fp.truncate( max( size, 2 * len( self.mm ) ) )
+        if os.fstat( self.fp.fileno() ).st_size != len( self.mm ):
+            # the old map is never closed, because arrays may still refer to it
+            self.mm = mmap.mmap( self.fp.fileno(), 0 )
+
+
+    def array( self, dtype, shape, offset ):
+        if numpy.prod( shape ) == 0:
+            return numpy.empty( shape, dtype )
+        return numpy.ndarray( shape, dtype, buffer = self.mm, offset = offset )
+
+
+def shared_batch_worker( constructor, candidate, int n_batch_size, kwargs, 
+                         int rank, int n_worker, int seed, directory, result, free ):
+    """
+    Body of worker 'rank' of shared_mini_batch. It prepares mini-batch rank, 
+    rank + n_worker, rank + 2 * n_worker, ... and writes each one to a free slot. 
+    """
+    try:
+        numpy.random.seed( (seed + rank) % (1 << 32) )
+        random.seed( seed + rank )
+        slot = {}
+        for b in xrange( rank, (len(candidate) + n_batch_size - 1) // n_batch_size, n_worker ):
+            batch = next( constructor.mini_batch( n_batch_size, 
+                                                  candidate = candidate[b * n_batch_size: (b + 1) * n_batch_size], 
+                                                  **kwargs ) )
+            arrays = []
+            skeleton = flatten_batch( batch, arrays )
+            layout, size = [], 0
+            for a in arrays:
+                layout.append( (a.dtype.str, a.shape, size) )
+                size += (a.nbytes + 63) // 64 * 64
+
+            s = free.get()
+            if s not in slot:
+                slot[s] = shared_slot( os.path.join( directory, '%d-%d' % (rank, s) ) )
+            slot[s].ensure( size )
+            for a, (dtype, shape, offset) in zip( arrays, layout ):
+                if a.size > 0:
+                    slot[s].array( dtype, shape, offset )[...] = a
+            slot[s].mm.flush()
+            result.put( (s, skeleton, layout) )
+        result.put( None )
+    except:
+        result.put( traceback.format_exc() )
+
+
+def shared_mini_batch( constructor, int n_batch_size, candidate, kwargs, 
+                       int n_worker = 4, int n_slot = 2, pool = None ):
+    """
+    The generator yields the same mini-batches as constructor.mini_batch( 
+    n_batch_size, candidate = candidate, **kwargs ), but they are prepared by 
+    'n_worker' processes. Worker k owns mini-batches k, k + n_worker, ... and 
+    writes each one to one of its 'n_slot' slots in shared memory; mini-batches 
+    are received in order and copied out, so that the slot can be reused. 
+
+    Parameters
+    ----------
+        constructor : batch_constructor or batch_constructor_v2
+            it is inherited by the workers, which are forked
+
+        candidate : numpy.ndarray
+            what sample_candidate returns
+
+        pool : batch_pool
+            if given, mini-batches are copied to its buffers instead of new arrays
+    """
+    directory = tempfile.mkdtemp( prefix = 'mini-batch-', 
+                                  dir = '/dev/shm' if os.path.isdir( '/dev/shm' ) else None )
+    seed = numpy.random.randint( 1 << 30 )
+    result, free, worker, slot = [], [], [], {}
+    try:
+        for rank in xrange( n_worker ):
+            result.append( multiprocessing.Queue() )
+            free.append( multiprocessing.Queue() )
+            for s in xrange( n_slot ):
+                free[rank].put( s )
+            worker.append( multiprocessing.Process( 
+                target = shared_batch_worker,
+                args = ( constructor, candidate, n_batch_size, kwargs, 
+                         rank, n_worker, seed, directory, result[rank], free[rank] ) ) )
+            worker[rank].daemon = True
+            worker[rank].start()
+
+        for b in xrange( (len(candidate) + n_batch_size - 1) // n_batch_size ):
+            rank = b % n_worker
+            message = result[rank].get()
+            if not isinstance( message, tuple ):
+                raise RuntimeError( 'mini-batch worker %d failed\n%s' % (rank, message) )
+            s, skeleton, layout = message
+
+            if (rank, s) not in slot:
+                slot[(rank, s)] = shared_slot( os.path.join( directory, '%d-%d' % (rank, s) ) )
+            shared = slot[(rank, s)]
+            shared.ensure( 0 )
+
+            owner = pool.acquire() if pool is not None else None
+            arrays = []
+            for k, (dtype, shape, offset) in enumerate( layout ):
+                if owner is not None:
+                    arrays.append( reserve( owner, ('copy', k), shape, dtype ) )
+                    arrays[-1][...] = shared.array( dtype, shape, offset )
+                else:
+                    arrays.append( shared.array( dtype, shape, offset ).copy() )
+            free[rank].put( s )
+
+            batch = unflatten_batch( skeleton, arrays )
+            if owner is not None:
+                batch = (pooled_dict if isinstance( batch, dict ) else pooled_tuple)( batch )
+                batch.buffer = owner
+            yield batch
+
+        for rank in xrange( n_worker ):
+            result[rank].get()
+            worker[rank].join()
+    finally:
+        for w in worker:
+            if w.is_alive():
+                w.terminate()
+        # let the feeder threads finish before the pipes are garbage-collected
+        for q in free:
+            q.close()
+            q.join_thread()
+        shutil.rmtree( directory, True )
+
+
+def pooled_copy( batch, owner ):
+    """
+    Returns
+    -------
+        A copy of 'batch', a (nested) tuple or dict of arrays, in 'owner', a 
+        buffer of a batch_pool. 
+    """
+    arrays = []
+    skeleton = flatten_batch( batch, arrays )
+    for k, a in enumerate( arrays ):
+        arrays[k] = reserve( owner, ('copy', k), a.shape, a.dtype )
+        arrays[k][...] = a
+    return unflatten_batch( skeleton, arrays )
+
+
+def thread_pool_mini_batch( task, int n_task, int n_thread ):
+    """
+    The generator yields task( 0 ), task( 1 ), ..., task( n_task - 1 ) in order, 
+    while up to 2 * n_thread of them are run by a pool of 'n_thread' threads. 
+    It only pays off if 'task' releases the GIL for most of its work. 
+    """
+    workers = ThreadPool( n_thread )
+    pending = deque()
+    try:
+        for b in xrange( n_task ):
+            pending.append( workers.apply_async( task, (b,) ) )
+            if len( pending ) >= 2 * n_thread:
+                yield pending.popleft().get()
+        while len( pending ) > 0:
+            yield pending.popleft().get()
+    finally:
+        workers.terminate()
+
+
+class stream_sampler( object ):
+    """
+    An endless stream of full mini-batches of a batch_constructor or 
+    batch_constructor_v2, prepared by one long-lived background thread. 
+    Positive examples and sampled negative ones are drawn pass after pass, but 
+    the examples a pass leaves over are put in front of the next pass instead 
+    of making a smaller mini-batch, so there is no epoch boundary. Up to 
+    'n_prefetch' mini-batches are kept ready, so the next pass is sampled while 
+    the consumer is busy. 
+    """
+    def __init__( self, constructor, int n_batch_size, sample_kwargs, kwargs, 
+                  int n_prefetch = 16, pool = None, timeout = None, int bucket_width = 0 ):
+        """
+        Parameters
+        ----------
+            sample_kwargs : dict
+                keyword arguments of sample_candidate
+
+            kwargs : dict
+                keyword arguments of constructor.mini_batch, e.g. feature_choice
+
+            pool : batch_pool
+                if given, mini-batches are written to its buffers, which must 
+                be released after use
+
+            timeout : float
+                how long next() waits for a mini-batch, forever if None
+
+            bucket_width : int
+                if positive, each pass is ordered by bucket_candidate
+        """
+        self.constructor = constructor
+        self.n_batch_size = n_batch_size
+        self.sample_kwargs = sample_kwargs
+        self.kwargs = kwargs
+        self.pool = pool
+        self.timeout = timeout
+        self.bucket_width = bucket_width
+        # numpy.random is not thread-safe, the thread owns a generator seeded from it
+        self.rng = numpy.random.RandomState( numpy.random.randint( 1 << 30 ) )
+        self.batch_buffer = Queue( maxsize = n_prefetch )
+        self.stopped = Event()
+        self.thread = Thread( target = self.sample )
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def sample( self ):
+        try:
+            leftover = numpy.zeros( 0, dtype = numpy.int32 )
+            while not self.stopped.is_set():
+                candidate = sample_candidate( self.constructor, rng = self.rng, **self.sample_kwargs )
+                if len( candidate ) == 0:
+                    raise ValueError( 'there is no example to sample' )
+                candidate = numpy.concatenate( [ leftover, candidate ] ).astype( numpy.int32 )
+                n_full = len(candidate) // self.n_batch_size * self.n_batch_size
+                if self.bucket_width > 0:
+                    candidate[:n_full] = bucket_candidate( 
+                            self.constructor, candidate[:n_full], self.n_batch_size, self.bucket_width, 
+                            self.kwargs.get( 'context_limit', 64 ), rng = self.rng )
+                for batch in self.constructor.mini_batch( self.n_batch_size, 
+                                                          candidate = candidate[:n_full],
+                                                          pool = self.pool, **self.kwargs ):
+                    if not self.put( (True, batch) ):
+                        return
+                leftover = candidate[n_full:]
+        except:
+            self.put( (False, traceback.format_exc()) )
+
+
+    def put( self, item ):
+        while not self.stopped.is_set():
+            try:
+                self.batch_buffer.put( item, True, 0.1 )
+                return True
+            except Full:
+                pass
+        return False
+
+
+    def __iter__( self ):
+        return self
+
+
+    def next( self, timeout = None ):
+        """
+        Returns
+        -------
+            The next mini-batch, in the same format as constructor.mini_batch. 
+            Queue.Empty is raised if none is ready within 'timeout' seconds. 
+        """
+        if self.stopped.is_set():
+            raise StopIteration
+        succeeded, batch = self.batch_buffer.get( True, self.timeout if timeout is None else timeout )
+        if not succeeded:
+            self.close()
+            raise RuntimeError( 'mini-batch sampler failed\n%s' % batch )
+        return batch
+
+
+    def close( self ):
+        """
+        Stop the background thread. Prefetched mini-batches are dropped and 
+        handed back to the pool if there is one. 
+        """
+        self.stopped.set()
+        while not self.batch_buffer.empty():
+            succeeded, batch = self.batch_buffer.get()
+            if succeeded and self.pool is not None:
+                self.pool.release( batch )
+
+
 ################################################################################
 
 class chinese_char_vocab( object ):
@@ -330,33 +1165,534 @@ class chinese_char_vocab( object ):
 ################################################################################
 
 
+# Single-pass recognizers of numeric tokens. They accept exactly the same
+# strings as the following regular expressions that used to be matched 
+# with std::regex, as long as a token contains neither '\n' nor '\r'. 
+# scripts/numeric-token-check.py verifies the equivalence. 
+#
+# number : ^(\+|-)?(([1-9]\d{0,2}(,\d{3})*)|([1-9]\d*)|0)(\.\d+)?$
+# date 1 : ^(?:(?:31(\/|-|\.)(?:0?[13578]|1[02]|(?:Jan|Mar|May|Jul|Aug|Oct|Dec)))\1|(?:(?:29|30)(\/|-|\.)(?:0?[1,3-9]|1[0-2]|(?:Jan|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec))\2))(?:(?:1[6-9]|[2-9]\d)?\d{2})$|^(?:29(\/|-|\.)(?:0?2|(?:Feb))\3(?:(?:(?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:(?:16|[2468][048]|[3579][26])00))))$|^(?:0?[1-9]|1\d|2[0-8])(\/|-|\.)(?:(?:0?[1-9]|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep))|(?:1[0-2]|(?:Oct|Nov|Dec)))\4(?:(?:1[6-9]|[2-9]\d)?\d{2})$
+# date 2 : ^(((\d{4}(\/|-|\.)((0[13578](\/|-|\.)|1[02](\/|-|\.))(0[1-9]|[12]\d|3[01])|(0[13456789](\/|-|\.)|1[012](\/|-|\.))(0[1-9]|[12]\d|30)|02(\/|-|\.)(0[1-9]|1\d|2[0-8])))|((([02468][048]|[13579][26])00|\d{2}([13579][26]|0[48]|[2468][048])))(\/|-|\.)02(\/|-|\.)29)){0,10}$
+# time   : ^(?:(?:([01]?\d|2[0-3]):)?([0-5]?\d):)?([0-5]?\d)$
+# phone  : ^(?:(?:\+?1\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9])\s*\)|([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*(?:#|x\.?|ext\.?|extension)\s*(\d+))?$
+# digit  : ^.*[0-9].*$
+
+cdef enum:
+    NOT_NUMERIC = 0
+    NUMERIC_VALUE = 1
+    DATE_VALUE = 2
+    TIME_VALUE = 3
+    PHONE_VALUE = 4
+    CONTAINS_DIGIT = 5
+
+numeric_token_name = [ None, u'<numeric-value>', u'<date-value>', 
+                       u'<time-value>', u'<phone-value>', u'<contains-digit>' ]
+
+
+cdef inline bint is_digit( char c ) nogil:
+    return c'0' <= c <= c'9'
+
+
+cdef inline bint is_space( char c ) nogil:
+    return c == c' ' or c'\t' <= c <= c'\r'
+
+
+cdef inline bint is_separator( char c ) nogil:
+    return c == c'/' or c == c'-' or c == c'.'
+
+
+cdef inline bint all_digits( const char* s, int n ) nogil:
+    cdef int i
+    for i in range( n ):
+        if not is_digit( s[i] ):
+            return False
+    return True
+
+
+cdef bint one_of( const char* s, int n, const char* candidates ) nogil:
+    # 'candidates' is a space-separated list of words
+    cdef int i = 0, j
+    while candidates[i] != 0:
+        j = 0
+        while candidates[i + j] != 0 and candidates[i + j] != c' ':
+            j += 1
+        if j == n and strncmp( s, candidates + i, n ) == 0:
+            return True
+        i += j
+        if candidates[i] == c' ':
+            i += 1
+    return False
+
+
+cdef inline bint leap_2_digits( char a, char b ) nogil:
+    # [02468][048]|[13579][26]
+    if (a - c'0') % 2 == 0:
+        return b == c'0' or b == c'4' or b == c'8'
+    else:
+        return b == c'2' or b == c'6'
+
+
+cdef bint match_number( const char* s, int n ) nogil:
+    cdef int i = 0, j
+    if i < n and (s[i] == c'+' or s[i] == c'-'):
+        i += 1
+    if i >= n:
+        return False
+
+    if s[i] == c'0':
+        i += 1
+    elif is_digit( s[i] ):
+        j = i
+        while j < n and is_digit( s[j] ):
+            j += 1
+        # thousands separators only follow a group of at most 3 digits
+        if j < n and s[j] == c',':
+            if j - i > 3:
+                return False
+            while j < n and s[j] == c',':
+                if j + 4 > n or not all_digits( s + j + 1, 3 ):
+                    return False
+                j += 4
+        i = j
+    else:
+        return False
+
+    if i < n and s[i] == c'.':
+        j = i + 1
+        while j < n and is_digit( s[j] ):
+            j += 1
+        if j == i + 1:
+            return False
+        i = j
+    return i == n
+
+
+cdef bint match_time_field( const char* s, int n, bint is_hour ) nogil:
+    # [01]?\d|2[0-3] if 'is_hour' else [0-5]?\d
+    if n == 1:
+        return is_digit( s[0] )
+    if n == 2 and is_digit( s[0] ) and is_digit( s[1] ):
+        if is_hour:
+            return s[0] <= c'1' or (s[0] == c'2' and s[1] <= c'3')
+        else:
+            return s[0] <= c'5'
+    return False
+
+
+cdef bint match_time( const char* s, int n ) nogil:
+    cdef int colon[2]
+    cdef int i, n_colon = 0
+    for i in range( n ):
+        if s[i] == c':':
+            if n_colon == 2:
+                return False
+            colon[n_colon] = i
+            n_colon += 1
+    if n_colon == 0:
+        return match_time_field( s, n, False )
+    elif n_colon == 1:
+        return match_time_field( s, colon[0], False ) and \
+               match_time_field( s + colon[0] + 1, n - colon[0] - 1, False )
+    else:
+        return match_time_field( s, colon[0], True ) and \
+               match_time_field( s + colon[0] + 1, colon[1] - colon[0] - 1, False ) and \
+               match_time_field( s + colon[1] + 1, n - colon[1] - 1, False )
+
+
+cdef inline int skip_space( const char* s, int n, int i ) nogil:
+    while i < n and is_space( s[i] ):
+        i += 1
+    return i
+
+
+cdef inline int skip_phone_separator( const char* s, int n, int i ) nogil:
+    # \s*(?:[.-]\s*)?
+    i = skip_space( s, n, i )
+    if i < n and (s[i] == c'.' or s[i] == c'-'):
+        i = skip_space( s, n, i + 1 )
+    return i
+
+
+cdef inline bint match_area_code( const char* s, int n, int i ) nogil:
+    # [2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]
+    if i + 3 > n or not (c'2' <= s[i] <= c'9') or not is_digit( s[i + 2] ):
+        return False
+    if s[i + 1] == c'1':
+        return s[i + 2] != c'1'
+    return is_digit( s[i + 1] ) and s[i + 1] != c'9'
+
+
+cdef inline bint match_exchange_code( const char* s, int n, int i ) nogil:
+    # [2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2}
+    if i + 3 > n or not (c'2' <= s[i] <= c'9') or not is_digit( s[i + 2] ):
+        return False
+    if s[i + 1] == c'1':
+        return s[i + 2] != c'1'
+    return is_digit( s[i + 1] )
+
+
+cdef bint match_local_phone( const char* s, int n, int i ) nogil:
+    # exchange code, 4-digit number and optional extension, up to the end
+    cdef int j
+    if not match_exchange_code( s, n, i ):
+        return False
+    i = skip_phone_separator( s, n, i + 3 )
+    if i + 4 > n or not all_digits( s + i, 4 ):
+        return False
+    i += 4
+    if i == n:
+        return True
+
+    i = skip_space( s, n, i )
+    if i < n and s[i] == c'#':
+        i += 1
+    elif i < n and s[i] == c'x':
+        i += 1
+        if i < n and s[i] == c'.':
+            i += 1
+    elif i + 9 <= n and strncmp( s + i, 'extension', 9 ) == 0:
+        i += 9
+    elif i + 3 <= n and strncmp( s + i, 'ext', 3 ) == 0:
+        i += 3
+        if i < n and s[i] == c'.':
+            i += 1
+    else:
+        return False
+    i = skip_space( s, n, i )
+    j = i
+    while j < n and is_digit( s[j] ):
+        j += 1
+    return j > i and j == n
+
+
+cdef bint match_phone( const char* s, int n ) nogil:
+    cdef int i = 0
+    cdef bint has_area_code = True
+
+    # optional country code and area code
+    if i < n and s[i] == c'+':
+        i += 1
+        has_area_code = i < n and s[i] == c'1'
+    if has_area_code and i < n and s[i] == c'1':
+        i = skip_phone_separator( s, n, i + 1 )
+    if has_area_code and i < n and s[i] == c'(':
+        i = skip_space( s, n, i + 1 )
+        has_area_code = match_area_code( s, n, i )
+        i = skip_space( s, n, i + 3 )
+        has_area_code = has_area_code and i < n and s[i] == c')'
+        i += 1
+    elif has_area_code:
+        has_area_code = match_area_code( s, n, i )
+        i += 3
+    if has_area_code and match_local_phone( s, n, skip_phone_separator( s, n, i ) ):
+        return True
+
+    return match_local_phone( s, n, 0 )
+
+
+cdef bint match_date_2( const char* s, int n ) nogil:
+    # 0 to 10 concatenated dates of the form yyyy-mm-dd
+    cdef int i, month, day
+    cdef const char* d
+    if n % 10 != 0 or n > 100:
+        return False
+    for i in range( 0, n, 10 ):
+        d = s + i
+        if not all_digits( d, 4 ) or not all_digits( d + 5, 2 ) or not all_digits( d + 8, 2 ) \
+                or not is_separator( d[4] ) or not is_separator( d[7] ):
+            return False
+        month = (d[5] - c'0') * 10 + (d[6] - c'0')
+        day = (d[8] - c'0') * 10 + (d[9] - c'0')
+        if month < 1 or month > 12 or day < 1:
+            return False
+        if month == 2:
+            if day == 29:
+                if d[2] == c'0' and d[3] == c'0':
+                    if not leap_2_digits( d[0], d[1] ):
+                        return False
+                elif not leap_2_digits( d[2], d[3] ):
+                    return False
+            elif day > 28:
+                return False
+        elif month == 4 or month == 6 or month == 9 or month == 11:
+            if day > 30:
+                return False
+        elif day > 31:
+            return False
+    return True
+
+
+cdef inline bint match_year( const char* s, int n ) nogil:
+    # (?:1[6-9]|[2-9]\d)?\d{2}
+    if not all_digits( s, n ):
+        return False
+    return n == 2 or (n == 4 and ((s[0] == c'1' and s[1] >= c'6') or s[0] >= c'2'))
+
+
+cdef inline bint match_leap_year( const char* s, int n ) nogil:
+    # (?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:16|[2468][048]|[3579][26])00
+    if not all_digits( s, n ) or (n != 2 and n != 4):
+        return False
+    if s[n - 2] != c'0' or s[n - 1] != c'0':
+        return leap_2_digits( s[n - 2], s[n - 1] ) and match_year( s, n )
+    return n == 4 and leap_2_digits( s[0], s[1] ) and s[0] != c'0' and \
+           not (s[0] == c'1' and s[1] == c'2')
+
+
+cdef bint match_date_1( const char* s, int n ) nogil:
+    # day, month and year joined by a same separator
+    cdef int i, j
+    cdef const char* month
+    cdef const char* year
+    cdef int n_month, n_year
+
+    i = 0
+    while i < n and not is_separator( s[i] ):
+        i += 1
+    j = i + 1
+    while j < n and not is_separator( s[j] ):
+        j += 1
+    if j >= n or s[i] != s[j]:
+        return False
+    month, n_month = s + i + 1, j - i - 1
+    year, n_year = s + j + 1, n - j - 1
+
+    if one_of( s, i, '31' ):
+        if one_of( month, n_month, '1 3 5 7 8 01 03 05 07 08 10 12 ' 
+                                   'Jan Mar May Jul Aug Oct Dec' ) and \
+                match_year( year, n_year ):
+            return True
+
+    if one_of( s, i, '29 30' ):
+        if one_of( month, n_month, '1 , 3 4 5 6 7 8 9 01 0, 03 04 05 06 07 08 09 10 11 12 '
+                                   'Jan Mar Apr May Jun Jul Aug Sep Oct Nov Dec' ) and \
+                match_year( year, n_year ):
+            return True
+
+    if one_of( s, i, '29' ):
+        if one_of( month, n_month, '2 02 Feb' ) and match_leap_year( year, n_year ):
+            return True
+
+    if one_of( s, i, '1 2 3 4 5 6 7 8 9 01 02 03 04 05 06 07 08 09 '
+                     '10 11 12 13 14 15 16 17 18 19 20 21 22 23 24 25 26 27 28' ):
+        if one_of( month, n_month, '1 2 3 4 5 6 7 8 9 01 02 03 04 05 06 07 08 09 10 11 12 '
+                                   'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec' ) and \
+                match_year( year, n_year ):
+            return True
+
+    return False
+
+
+cdef int numeric_class( const char* s, int n ) nogil:
+    """
+    Returns one of NOT_NUMERIC, NUMERIC_VALUE, DATE_VALUE, TIME_VALUE, 
+    PHONE_VALUE and CONTAINS_DIGIT. 
+    """
+    cdef int i
+    cdef bint has_digit = False
+    for i in range( n ):
+        if s[i] == c'\n' or s[i] == c'\r':
+            return NOT_NUMERIC
+        if is_digit( s[i] ):
+            has_digit = True
+    if not has_digit:
+        return NOT_NUMERIC
+    if match_number( s, n ):
+        return NUMERIC_VALUE
+    if match_date_1( s, n ) or match_date_2( s, n ):
+        return DATE_VALUE
+    if match_time( s, n ):
+        return TIME_VALUE
+    if match_phone( s, n ):
+        return PHONE_VALUE
+    return CONTAINS_DIGIT
+
+
+def numeric_token_class( token ):
+    """
+    Parameters
+    ----------
+        token : str or unicode
+            unicode is encoded in utf-8
+
+    Returns
+    -------
+        one of u'<numeric-value>', u'<date-value>', u'<time-value>', 
+        u'<phone-value>' and u'<contains-digit>' if 'token' contains a digit, 
+        otherwise None
+    """
+    if isinstance( token, unicode ):
+        token = token.encode( 'utf8' )
+    cdef string s = token
+    return numeric_token_name[ numeric_class( s.c_str(), s.size() ) ]
+
+
+
+ctypedef linked_list[pair[string,int]] lru_list
+
+
+cdef class token_cache:
+    """
+    Bounded token-to-index memo with least-recently-used eviction. A single 
+    cache may be shared by several vocabularies, e.g. the case-insensitive 
+    and the case-sensitive one, since each vocabulary prefixes its keys 
+    with a namespace of its own. 
+    """
+    cdef lru_list entries
+    cdef unordered_map[string, lru_list.iterator] position
+    cdef readonly int capacity
+    cdef readonly long hits
+    cdef readonly long misses
+    cdef dict namespaces
+
+    def __cinit__( self, capacity = 1 << 20 ):
+        """
+        Parameters
+        ----------
+            capacity : int
+                maximum number of tokens kept, over all namespaces
+        """
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.namespaces = {}
+
+
+    def __len__( self ):
+        return self.position.size()
+
+
+    def __str__( self ):
+        return '%d/%d tokens, %d hits, %d misses, hit rate %.4f' % \
+               ( self.position.size(), self.capacity, self.hits, self.misses, 
+                 float(self.hits) / max(1, self.hits + self.misses) )
+
+
+    def namespace( self, key ):
+        """
+        Parameters
+        ----------
+            key : hashable
+                identifies a vocabulary, vocabularies loaded the same way
+                (e.g. in different folds) share the same namespace
+
+        Returns
+        -------
+            A prefix, unique to 'key' in this cache, that a vocabulary puts 
+            in front of its keys. 
+        """
+        if key not in self.namespaces:
+            self.namespaces[key] = '%d\t' % len(self.namespaces)
+        return self.namespaces[key]
+
+
+    def clear( self ):
+        self.entries.clear()
+        self.position.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+    cdef bint lookup( self, string& key, int* idx ) nogil:
+        cdef unordered_map[string, lru_list.iterator].iterator found
+        found = self.position.find( key )
+        if found == self.position.end():
+            self.misses += 1
+            return False
+        self.hits += 1
+        idx[0] = dereference( dereference(found).second ).second
+        # move to front
+        self.entries.erase( dereference(found).second )
+        self.entries.push_front( pair[string,int]( key, idx[0] ) )
+        dereference(found).second = self.entries.begin()
+        return True
+
+
+    cdef void insert( self, string& key, int idx ) nogil:
+        if self.capacity <= 0 or self.position.find( key ) != self.position.end():
+            return
+        self.entries.push_front( pair[string,int]( key, idx ) )
+        self.position[key] = self.entries.begin()
+        if <int>self.position.size() > self.capacity:
+            self.position.erase( self.entries.back().first )
+            self.entries.pop_back()
+
+
+
+cdef class token_arena:
+    """
+    Tokens of a sentence joined with space into a single buffer. An English 
+    or Spanish sentence is folded to ASCII and stored once, and is shared by 
+    the processed_sentence of both the case-insensitive and the case-sensitive 
+    vocabulary. 
+    """
+    cdef readonly string joined     # ' '.join( tokens )
+    cdef vector[int] offset         # tokens[i] is joined[offset[i]:offset[i + 1] - 1]
+
+    def __init__( self, sentence, fold = True ):
+        """
+        Parameters
+        ----------
+            sentence : list of str
+            fold : bool
+                if True, a non-ASCII character c is replaced with chr(ord(c) % 32)
+        """
+        cdef string token
+        for i, w in enumerate( sentence ):
+            if fold:
+                w = u''.join( c if ord(c) < 128 else chr(ord(c) % 32) for c in list(w) )
+            token = w
+            if i > 0:
+                self.joined.push_back( ' ' )
+            self.offset.push_back( self.joined.size() )
+            self.joined.append( token )
+        self.offset.push_back( self.joined.size() + 1 )
+
+
+    def __len__( self ):
+        return self.offset.size() - 1
+
+
+    def tokens( self ):
+        """ list of str, the tokens as they are stored """
+        return [ self.joined.substr( self.offset[i], self.offset[i + 1] - self.offset[i] - 1 ) 
+                 for i in xrange( self.offset.size() - 1 ) ]
+
+
+    cdef inline int token_begin( self, int i ) nogil:
+        return self.offset[i]
+
+
+    cdef inline int token_end( self, int i ) nogil:
+        return self.offset[i + 1] - 1
+
+
+    cdef inline void token_at( self, int i, string& token ) nogil:
+        token.assign( self.joined.c_str() + self.offset[i], self.offset[i + 1] - self.offset[i] - 1 )
+
+
+
 cdef class vocabulary( object ):
     cdef dict word2idx
-    cdef dict word2fofe
     cdef readonly float alpha
     cdef bint case_sensitive
     cdef int n_word
     cdef int pad_idx
-    cdef regex* date_pattern_1
-    cdef regex* date_pattern_2
-    cdef regex* number_pattern
-    cdef regex* phone_pattern
-    cdef regex* time_pattern
-    cdef regex* contains_digit
+    cdef token_cache cache
+    cdef string cache_prefix
 
     def __cinit__( self, filename, alpha = 0.7, case_sensitive = False,
-                   n_label_type = 0 ):
+                   n_label_type = 0, token_cache cache = None ):
+        """
+        Parameters
+        ----------
+            cache : token_cache
+                if not None, memorize the index of each token in 'cache', which
+                may be shared with other vocabularies
+        """
         self.word2idx = {}
-        self.word2fofe = {}
         self.alpha = alpha
         self.case_sensitive = case_sensitive
-        self.date_pattern_1 = new regex( r"^(?:(?:31(\/|-|\.)(?:0?[13578]|1[02]|(?:Jan|Mar|May|Jul|Aug|Oct|Dec)))\1|(?:(?:29|30)(\/|-|\.)(?:0?[1,3-9]|1[0-2]|(?:Jan|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec))\2))(?:(?:1[6-9]|[2-9]\d)?\d{2})$|^(?:29(\/|-|\.)(?:0?2|(?:Feb))\3(?:(?:(?:1[6-9]|[2-9]\d)?(?:0[48]|[2468][048]|[13579][26])|(?:(?:16|[2468][048]|[3579][26])00))))$|^(?:0?[1-9]|1\d|2[0-8])(\/|-|\.)(?:(?:0?[1-9]|(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep))|(?:1[0-2]|(?:Oct|Nov|Dec)))\4(?:(?:1[6-9]|[2-9]\d)?\d{2})$" )
-        self.date_pattern_2 = new regex( r"^(((\d{4}(\/|-|\.)((0[13578](\/|-|\.)|1[02](\/|-|\.))(0[1-9]|[12]\d|3[01])|(0[13456789](\/|-|\.)|1[012](\/|-|\.))(0[1-9]|[12]\d|30)|02(\/|-|\.)(0[1-9]|1\d|2[0-8])))|((([02468][048]|[13579][26])00|\d{2}([13579][26]|0[48]|[2468][048])))(\/|-|\.)02(\/|-|\.)29)){0,10}$" )
-        self.number_pattern = new regex( r"^(\+|-)?(([1-9]\d{0,2}(,\d{3})*)|([1-9]\d*)|0)(\.\d+)?$" )
-        self.phone_pattern = new regex( r"^(?:(?:\+?1\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9])\s*\)|([2-9]1[02-9]|[2-9][02-8]1|[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9][02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*(?:#|x\.?|ext\.?|extension)\s*(\d+))?$" )
-        self.time_pattern = new regex( r"^(?:(?:([01]?\d|2[0-3]):)?([0-5]?\d):)?([0-5]?\d)$" )
-        self.contains_digit = new regex( r"^.*[0-9].*$" )
-
         with codecs.open( filename ) as word_file:
             for line in word_file:
                 word = line.strip().split()[0]
@@ -375,85 +1711,152 @@ cdef class vocabulary( object ):
 
         self.pad_idx = self.n_word
 
+        self.cache = cache
+        if self.cache is not None:
+            self.cache_prefix = self.cache.namespace( 
+                    (os.path.abspath(filename), case_sensitive, n_label_type) )
+
 
     def __len__( self ):
         return self.n_word
 
 
     cdef sentence2indices( self, sentence, vector[int]& numeric ):
-        cdef string s
-        cdef int i
+        cdef string s, key
+        cdef int i, idx, token_class
         cdef int n = len( sentence )
         cdef int unk = self.word2idx['<unk>']
         cdef int UNK = self.word2idx.get( '<UNK>', unk )
+        cdef bint use_cache = self.cache is not None
         numeric.resize( n )
         for i, w in enumerate(sentence):
+            if use_cache:
+                key = self.cache_prefix
+                key.append( <string>w )
+                if self.cache.lookup( key, &idx ):
+                    numeric[i] = idx
+                    continue
+
             s = w.lower()
-            if regex_match( s, self.contains_digit[0] ):
-                if regex_match( s, self.number_pattern[0] ):
-                    numeric[i] = self.word2idx.get('<numeric-value>', unk)
-                elif regex_match( s, self.date_pattern_1[0] ) or \
-                                regex_match( w, self.date_pattern_2[0] ):
-                    numeric[i] = self.word2idx.get('<date-value>', unk)
-                elif regex_match( s, self.time_pattern[0] ):
-                    numeric[i] = self.word2idx.get('<time-value>', unk)
-                elif regex_match( s, self.phone_pattern[0] ):
-                    numeric[i] = self.word2idx.get('<phone-value>', unk)
-                else:
-                    numeric[i] = self.word2idx.get('<contains-digit>', unk)
+            token_class = numeric_class( s.c_str(), s.size() )
+            if token_class != NOT_NUMERIC:
+                idx = self.word2idx.get( numeric_token_name[token_class], unk )
             else:
                 if self.case_sensitive:
                     if w == w.lower():
-                        numeric[i] = self.word2idx.get( w, unk )
+                        idx = self.word2idx.get( w, unk )
                     else:
-                        numeric[i] = self.word2idx.get( w, UNK )
+                        idx = self.word2idx.get( w, UNK )
                 else:
-                    numeric[i] = self.word2idx.get( s, unk )
+                    idx = self.word2idx.get( s, unk )
+            numeric[i] = idx
+
+            if use_cache:
+                self.cache.insert( key, idx )
+
 
-    def __dealloc__( self ):
-        del self.date_pattern_1
-        del self.date_pattern_2
-        del self.time_pattern
-        del self.number_pattern
-        del self.phone_pattern
-        del self.contains_digit
+    cdef const float* word_char_fofe( self, string& word, float* fofe ) nogil:
+        """
+        Returns
+        -------
+            'fofe', 256 floats given by the caller, filled with 128 floats of 
+            left fofe followed by 128 floats of right fofe of 'word'. Nothing 
+            of the vocabulary is modified, so several threads may share it. 
+        """
+        cdef int i, c
+        cdef double coeff
+
+        # the coefficients are accumulated in double and rounded to float,
+        # as in the numpy implementation it replaces
+        for i in range( 256 ):
+            fofe[i] = 0
+        coeff = 1
+        for i in reversed( range( word.size() ) ):
+            c = <unsigned char>word[i]
+            fofe[c if c < 128 else 0] += <float>coeff
+            coeff *= <double>self.alpha
+        coeff = 1
+        for i in range( word.size() ):
+            c = <unsigned char>word[i]
+            fofe[128 + (c if c < 128 else 0)] += <float>coeff
+            coeff *= <double>self.alpha
+        return fofe
+
+
+    cdef void phrase_char_fofe( self, token_arena sentence, int begin, int end,
+                                float* left, float* right, float* scratch ) nogil:
+        """
+        Char-level fofe of sentence[begin:end] written to left[:128] and 
+        right[:128]. Each word is scaled by alpha ** len(neighbour) and 
+        the words are not separated by space. 'scratch' is 256 floats 
+        passed to word_char_fofe. 
+        """
+        cdef int i, k
+        cdef float scale
+        cdef const float* fofe
+        cdef string word
+
+        sentence.token_at( begin, word )
+        fofe = self.word_char_fofe( word, scratch )
+        for k in range( 128 ):
+            left[k] = fofe[k]
+        for i in range( begin + 1, end ):
+            scale = powf( self.alpha, <float>(sentence.token_end( i - 1 ) - sentence.token_begin( i - 1 )) )
+            sentence.token_at( i, word )
+            fofe = self.word_char_fofe( word, scratch )
+            for k in range( 128 ):
+                left[k] = left[k] * scale
+                left[k] = left[k] + fofe[k]
+
+        sentence.token_at( end - 1, word )
+        fofe = self.word_char_fofe( word, scratch )
+        for k in range( 128 ):
+            right[k] = fofe[128 + k]
+        for i in range( end - 2, begin - 1, -1 ):
+            scale = powf( self.alpha, <float>(sentence.token_end( i + 1 ) - sentence.token_begin( i + 1 )) )
+            sentence.token_at( i, word )
+            fofe = self.word_char_fofe( word, scratch )
+            for k in range( 128 ):
+                right[k] = right[k] * scale
+                right[k] = right[k] + fofe[128 + k]
+
+
+    cdef void initial_char_fofe( self, token_arena sentence, int begin, int end,
+                                 float* left, float* right, float* scratch ) nogil:
+        """
+        Char-level fofe of the initials of sentence[begin:end] written to 
+        left[:128] and right[:128]. The initial of an empty word is '\\0'.
+        """
+        cdef int i
+        cdef string initial
+        cdef const float* fofe
+        for i in range( begin, end ):
+            if sentence.token_end( i ) > sentence.token_begin( i ):
+                initial.push_back( sentence.joined[sentence.token_begin( i )] )
+            else:
+                initial.push_back( 0 )
+        fofe = self.word_char_fofe( initial, scratch )
+        for i in range( 128 ):
+            left[i] = fofe[i]
+            right[i] = fofe[128 + i]
 
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
     def char_fofe_of_word( self, word ):
-        if len( self.word2fofe ) > 2 * len(self.word2idx):
-            self.word2fofe = {}
-        if word in self.word2fofe:
-            return self.word2fofe[word]
-        else:
-            lfofe, coeff = numpy.zeros((128,), numpy.float32), 1
-            for c in reversed(word):
-                i = ord(c) if 0 < ord(c) < 128 else 0
-                lfofe[i] += numpy.float32(coeff)
-                coeff *= self.alpha
-            rfofe, coeff = numpy.zeros((128,), numpy.float32), 1
-            for c in word:
-                i = ord(c) if 0 < ord(c) < 128 else 0
-                rfofe[i] += numpy.float32(coeff)
-                coeff *= self.alpha
-            self.word2fofe[word] = [lfofe, rfofe]
-            return [lfofe, rfofe]
+        if isinstance( word, unicode ):
+            word = u''.join( c if ord(c) < 128 else u'\0' for c in word ).encode( 'ascii' )
+        cdef numpy.ndarray[float, ndim = 1] fofe = numpy.zeros( (256,), numpy.float32 )
+        self.word_char_fofe( word, &fofe[0] )
+        return [fofe[:128].copy(), fofe[128:].copy()]
 
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
     def char_fofe_of_phrase( self, phrase ):
-        cdef int i, n = len(phrase)
-        fofe = [ self.char_fofe_of_word(w) for w in phrase ]
-        lfofe = fofe[0][0].copy()
-        rfofe = fofe[n - 1][1].copy()
-        for i in range(1, n):
-            lfofe *= self.alpha ** len(phrase[i - 1])
-            lfofe += fofe[i][0]
-        for i in reversed(range(n - 1)):
-            rfofe *= self.alpha ** len(phrase[i + 1])
-            rfofe += fofe[i][1]
+        cdef token_arena words = token_arena( 
+                [ u''.join( c if ord(c) < 128 else u'\0' for c in w ).encode( 'ascii' ) 
+                  if isinstance( w, unicode ) else w for w in phrase ], False )
+        cdef numpy.ndarray[float, ndim = 1] lfofe = numpy.zeros( (128,), numpy.float32 )
+        cdef numpy.ndarray[float, ndim = 1] rfofe = numpy.zeros( (128,), numpy.float32 )
+        cdef numpy.ndarray[float, ndim = 1] scratch = numpy.zeros( (256,), numpy.float32 )
+        self.phrase_char_fofe( words, 0, len(words), &lfofe[0], &rfofe[0], &scratch[0] )
         return lfofe, rfofe
 
 
@@ -527,23 +1930,108 @@ class chinese_word_vocab( vocabulary ):
 ################################################################################
 
 
+cdef struct fofe_node:
+    int token       # word index, or n_word + label of a 1st-pass mention
+    int next        # the position absorbed right before this one, -1 if none
+    int depth       # number of positions absorbed before this one
+    int last        # previous occurrence of 'token' along the chain, -1 if none
+    float value     # weight of 'token' right after this position is absorbed
+
+
+cdef float decayed( float value, int distance, float alpha, 
+                    vector[float]& decay ) nogil:
+    # repeat the multiplications of the eager construction one by one, 
+    # so that the result is bit-wise identical
+    cdef int i
+    if value == 1:
+        return decay[distance]
+    for i in range( distance ):
+        value = value * alpha
+    return value
+
+
+cdef void absorb( vector[fofe_node]& chain, int pos, 
+                  float alpha, vector[float]& decay ) nogil:
+    cdef int j = chain[pos].next
+    chain[pos].depth = 0 if j < 0 else chain[j].depth + 1
+    while j >= 0 and chain[j].token != chain[pos].token:
+        j = chain[j].next
+    chain[pos].last = j
+    if j < 0:
+        chain[pos].value = 1
+    else:
+        chain[pos].value = decayed( chain[j].value, 
+                                    chain[pos].depth - chain[j].depth,
+                                    alpha, decay ) + 1
+
+
+cdef void insert_chain( vector[fofe_node]& chain, int pos, 
+                        float alpha, vector[float]& decay, int window, 
+                        int row_id, vector[int]& indices, vector[float]& values ) nogil:
+    # window >= 0 keeps only the last 'window' positions of the context
+    cdef ordered_map[int,float] fofe
+    cdef ordered_map[int,float].iterator map_itr
+    cdef int j = pos
+    cdef int distance = 0
+    if chain[pos].depth < window:
+        window = -1     # nothing to truncate, keep it exact
+    while j >= 0:
+        if window >= 0:
+            if distance >= window:
+                break
+            if fofe.find( chain[j].token ) == fofe.end():
+                fofe[chain[j].token] = decay[distance]
+            else:
+                fofe[chain[j].token] += decay[distance]
+        elif fofe.find( chain[j].token ) == fofe.end():
+            fofe[chain[j].token] = decayed( chain[j].value, 
+                                            chain[pos].depth - chain[j].depth,
+                                            alpha, decay )
+        j = chain[j].next
+        distance += 1
+
+    map_itr = fofe.begin()
+    while map_itr != fofe.end():
+        values.push_back( dereference(map_itr).second )
+        indices.push_back( row_id )
+        indices.push_back( dereference(map_itr).first )
+        preincrement( map_itr )
+
+
+
 cdef class processed_sentence:
     """
     Any object of this class should not be instantiated outside this module.
     """
     cdef public vector[int] numeric
-    cdef readonly vector[string] sentence
+    cdef readonly token_arena tokens
     cdef readonly vector[vector[int]] left_context_idx
     cdef readonly vector[vector[float]] left_context_data
     cdef readonly vector[vector[int]] right_context_idx
     cdef readonly vector[vector[float]] right_context_data
 
+    # on-demand representation, see 'lazy' in __init__
+    cdef readonly bint lazy
+    cdef readonly float alpha
+    cdef readonly int window    # negative if the context is not truncated
+    cdef vector[fofe_node] left_chain
+    cdef vector[fofe_node] right_chain
+    cdef vector[float] decay
+
+    # char-level tables, built on first use, see prepare_char_table
+    cdef bint has_char_table
+    cdef vector[int] left_bigram        # bigram id of joined[k], joined[k + 1]
+    cdef vector[int] right_bigram       # bigram id of joined[k + 1], joined[k]
+
     def __init__( self, sentence, numericizer, 
-                  a = 0.7, language = 'eng', label1st = None ):
+                  a = 0.7, language = 'eng', label1st = None,
+                  lazy = False, epsilon = 0, max_length = 0, context = True ):
         """
         Parameters
         ----------
-            sentence : list of str
+            sentence : list of str or token_arena
+                a token_arena may be shared with another processed_sentence 
+                of the same English or Spanish sentence
             numericizer : vocabulary
             a : float
                 word-level forgetting factor
@@ -551,23 +2039,37 @@ cdef class processed_sentence:
                 either 'eng', 'cmn' or 'spa'
             label1st : list
                 labels from 1st pass
+            lazy : bool
+                If True, left_context_{idx,data} and right_context_{idx,data}
+                are left empty. Only a table of O(n) entries is kept and the 
+                fofe of a position is computed when it is inserted into a 
+                mini-batch. The features are exactly the same either way.
+            epsilon : float
+                if positive, words whose weight a^distance is less than 
+                epsilon are dropped from the context; implies lazy
+            max_length : int
+                if positive, at most the last max_length words are kept in 
+                the context; implies lazy
+            context : bool
+                If False, no word-level feature can be asked for. The sentence 
+                is kept for its characters only, and 'numeric' and the fofe 
+                are left empty. 
         """
 
         cdef vocabulary vocab
 
         if language != 'cmn':
-            for w in sentence:
-                self.sentence.push_back(  
-                    u''.join( c if ord(c) < 128 else chr(ord(c) % 32) for c in list(w) ) 
-                )
-            vocab = numericizer
-            vocab.sentence2indices( self.sentence, self.numeric )
+            if isinstance( sentence, token_arena ):
+                self.tokens = sentence
+            else:
+                self.tokens = token_arena( sentence )
+            if context:
+                vocab = numericizer
+                vocab.sentence2indices( self.tokens.tokens(), self.numeric )
         else:
-            for w in sentence:
-                self.sentence.push_back(
-                    numericizer.char2wubi( w )
-                )
-            self.numeric = numericizer.sentence2indices( sentence )
+            self.tokens = token_arena( [ numericizer.char2wubi( w ) for w in sentence ], False )
+            if context:
+                self.numeric = numericizer.sentence2indices( sentence )
 
         cdef vector[int] idx_buffer
         cdef vector[float] data_buffer
@@ -592,6 +2094,15 @@ cdef class processed_sentence:
             boe = dict(zip(label1st[0], label1st[2]))
             eoe = dict(zip(label1st[1], label1st[2]))
 
+        self.lazy = lazy or epsilon > 0 or max_length > 0
+        self.alpha = alpha
+        self.window = max_length if max_length > 0 else -1
+        if not context:
+            return
+        if self.lazy:
+            self._build_chain( boe, eoe, n_word, epsilon )
+            return
+
         with nogil: 
             for i in range( n ):
                 if boe.find(i) != boe.end():
@@ -662,105 +2173,723 @@ cdef class processed_sentence:
 
 
 
-    cdef insert_left_fofe( self, int pos, int row_id, 
-                           vector[int]& indices, vector[float]& values ):
-        """ help to construct mini-batch """
-        cdef int n = self.left_context_idx[pos].size()
-        with nogil:
-            for j in range( n ):
-                values.push_back( self.left_context_data[pos][j] )
-                indices.push_back( row_id )
-                indices.push_back( self.left_context_idx[pos][j] )
+    cdef void _build_chain( self, ordered_map[int,int]& boe, 
+                            ordered_map[int,int]& eoe, int n_word, 
+                            float epsilon ) nogil:
+        """
+        Position i of the left chain absorbs one token into the context 
+        found at left_chain[i].next. It is i - 1, except at the end of a 
+        1st-pass mention, where the context is rolled back to where the 
+        mention begins. The right chain is symmetric. 
+        """
+        cdef int i
+        cdef int n = self.numeric.size()
+        cdef int snapshot = -1
+
+        self.decay.resize( n + 1 )
+        self.decay[0] = 1
+        for i in range( n ):
+            self.decay[i + 1] = self.decay[i] * self.alpha
 
+        if epsilon > 0:
+            i = 0
+            while i <= n and self.decay[i] >= epsilon:
+                i += 1
+            if self.window < 0 or i < self.window:
+                self.window = i
 
-    cdef insert_right_fofe( self, int pos, int row_id, 
-                           vector[int]& indices, vector[float]& values ):
+        self.left_chain.resize( n )
+        for i in range( n ):
+            if boe.find(i) != boe.end():
+                snapshot = i - 1
+            if eoe.find(i + 1) == eoe.end():
+                self.left_chain[i].token = self.numeric[i]
+                self.left_chain[i].next = i - 1
+            else:
+                self.left_chain[i].token = n_word + eoe[i + 1]
+                self.left_chain[i].next = snapshot
+            absorb( self.left_chain, i, self.alpha, self.decay )
+
+        snapshot = -1
+        self.right_chain.resize( n )
+        for i in reversed( range( n ) ):
+            if eoe.find(i + 1) != eoe.end():
+                snapshot = i + 1 if i + 1 < n else -1
+            if boe.find(i) == boe.end():
+                self.right_chain[i].token = self.numeric[i]
+                self.right_chain[i].next = i + 1 if i + 1 < n else -1
+            else:
+                self.right_chain[i].token = n_word + boe[i]
+                self.right_chain[i].next = snapshot
+            absorb( self.right_chain, i, self.alpha, self.decay )
+
+
+    cdef void insert_left_fofe( self, int pos, int row_id, 
+                                vector[int]& indices, vector[float]& values ) nogil:
+        """ help to construct mini-batch """
+        cdef int j
+        if self.lazy:
+            insert_chain( self.left_chain, pos, self.alpha, self.decay, 
+                          self.window, row_id, indices, values )
+            return
+        for j in range( self.left_context_idx[pos].size() ):
+            values.push_back( self.left_context_data[pos][j] )
+            indices.push_back( row_id )
+            indices.push_back( self.left_context_idx[pos][j] )
+
+
+    cdef void insert_right_fofe( self, int pos, int row_id, 
+                                 vector[int]& indices, vector[float]& values ) nogil:
         """ help to construct mini-batch """
         cdef int i
-        cdef int n = self.right_context_idx[pos].size()
-        with nogil:
-            for i in range( n ):
-                values.push_back( self.right_context_data[pos][i] )
-                indices.push_back( row_id )
-                indices.push_back( self.right_context_idx[pos][i] )
+        if self.lazy:
+            insert_chain( self.right_chain, pos, self.alpha, self.decay, 
+                          self.window, row_id, indices, values )
+            return
+        for i in range( self.right_context_idx[pos].size() ):
+            values.push_back( self.right_context_data[pos][i] )
+            indices.push_back( row_id )
+            indices.push_back( self.right_context_idx[pos][i] )
+
+
+    cdef void insert_bow( self, int begin_idx, int end_idx,
+                          int row_id, vector[int]& indices ) nogil:
+        """ help to construct mini-batch """
+        cdef int i
+        for i in range( begin_idx, end_idx ):
+            indices.push_back( row_id )
+            indices.push_back( self.numeric[i] )
 
 
-    cdef insert_bow( self, int begin_idx, int end_idx,
-                     int row_id, vector[int]& indices ):
-        """ help to construct mini-batch """
+    @property
+    def sentence( self ):
+        return self.tokens.tokens()
+
+
+    def context_chain( self ):
+        """
+        Returns
+        -------
+            left_token, left_next, right_token, right_next : numpy.ndarray
+                Position i of the left chain absorbs left_token[i] into the
+                context at position left_next[i], an empty one if negative,
+                and the right chain likewise, so that the fofe of every position
+                follows from one scan; see _build_chain. Only a lazy sentence
+                keeps its chains; the left context of an eager one of the 1st
+                pass simply absorbs numeric[i] into that of i - 1.
+        """
+        assert self.lazy, 'only a lazy sentence keeps its chains'
+        cdef int n = self.left_chain.size()
         cdef int i
-        with nogil:
-            for i in range( begin_idx, end_idx ):
-                indices.push_back( row_id )
-                indices.push_back( self.numeric[i] )
+        result = [ numpy.empty( (n,), dtype = numpy.int32 ) for _ in xrange(4) ]
+        cdef int[:] left_token = result[0]
+        cdef int[:] left_next = result[1]
+        cdef int[:] right_token = result[2]
+        cdef int[:] right_next = result[3]
+        for i in range( n ):
+            left_token[i] = self.left_chain[i].token
+            left_next[i] = self.left_chain[i].next
+            right_token[i] = self.right_chain[i].token
+            right_next[i] = self.right_chain[i].next
+        return tuple( result )
+
+
+    cdef prepare_char_table( self ):
+        """
+        Compute the id of every char bigram of 'joined' of the tokens once, so 
+        that the phrase of any span is a slice of it. This is done while holding 
+        the GIL, so that threads sharing this sentence see either nothing or 
+        complete tables. 
+        """
+        cdef int i, c
+        cdef vector[int] char_id
+
+        if self.has_char_table:
+            return
+
+        # printable characters range from 32 (inclusive) to 127 (exclusive), totalling 127 - 32 = 95
+        # anything out of this range is considered OOV
+        for i in range( self.tokens.joined.size() ):
+            c = <int>self.tokens.joined[i]
+            char_id.push_back( c - 32 if 32 <= c < 127 else 95 )
+        for i in range( <int>char_id.size() - 1 ):
+            self.left_bigram.push_back( char_id[i] * 96 + char_id[i + 1] )
+            self.right_bigram.push_back( char_id[i + 1] * 96 + char_id[i] )
+
+        self.has_char_table = True
+
+
+    cdef inline int phrase_begin( self, int begin_idx ) nogil:
+        """ where sentence[begin_idx:] starts in 'joined' """
+        return self.tokens.token_begin( begin_idx )
+
+
+    cdef inline int phrase_end( self, int end_idx ) nogil:
+        """ where sentence[:end_idx] ends in 'joined' """
+        return self.tokens.token_end( end_idx - 1 )
+
+
+    cdef void insert_bigram( self, int begin_idx, int end_idx, int row_id, 
+                             vector[float]& left_values, vector[int]& left_indices,
+                             vector[float]& right_values, vector[int]& right_indices ) nogil:
+        """
+        Bigram char counts of ' '.join( sentence[begin_idx:end_idx] ) and its 
+        reverse, sorted by bigram id. prepare_char_table must have been called. 
+        """
+        cdef int first = self.phrase_begin( begin_idx )
+        cdef int last = self.phrase_end( end_idx ) - 1
+        if last > first:
+            insert_count( self.left_bigram, first, last, row_id, left_values, left_indices )
+            insert_count( self.right_bigram, first, last, row_id, right_values, right_indices )
 
 
 
 ################################################################################
 
 
-cdef class example:
-    cdef readonly int sentence_id
-    cdef readonly int begin_idx
-    cdef readonly int end_idx
-    cdef readonly int label
-    cdef readonly numpy.ndarray gazetteer
+cdef numpy.ndarray int32_array( vector[int]& v ):
+    result = numpy.empty( (v.size(),), dtype = numpy.int32 )
+    cdef int[:] view = result
+    cdef int i
+    for i in range( v.size() ):
+        view[i] = v[i]
+    return result
 
-    def __init__( self, sentence_id, begin_idx, end_idx, label, gazetteer = None ):
-        self.sentence_id = sentence_id
-        self.begin_idx = begin_idx
-        self.end_idx = end_idx
-        self.label = label
-        self.gazetteer = gazetteer
+
+cdef numpy.ndarray uint16_array( vector[unsigned short]& v ):
+    result = numpy.empty( (v.size(),), dtype = numpy.uint16 )
+    cdef unsigned short[:] view = result
+    cdef int i
+    for i in range( v.size() ):
+        view[i] = v[i]
+    return result
+
+
+# copies of mini-batch vectors in the buffer of a batch_pool, or in a dict of 
+# their own, with the dtype and shape of what mini_batch yields
+
+cdef numpy.ndarray pooled_float32( dict buffer, key, vector[float]& v ):
+    result = reserve( buffer, key, (v.size(),), numpy.float32 )
+    cdef float[:] view = result
+    cdef int i
+    for i in range( v.size() ):
+        view[i] = v[i]
+    return result
+
+
+cdef numpy.ndarray pooled_int64( dict buffer, key, vector[int]& v ):
+    result = reserve( buffer, key, (v.size(),), numpy.int64 )
+    cdef numpy.int64_t[:] view = result
+    cdef int i
+    for i in range( v.size() ):
+        view[i] = v[i]
+    return result
+
+
+cdef numpy.ndarray pooled_index( dict buffer, key, vector[int]& v ):
+    result = reserve( buffer, key, (v.size() // 2, 2), numpy.int64 )
+    cdef numpy.int64_t[:,:] view = result
+    cdef int i
+    for i in range( v.size() // 2 ):
+        view[i, 0] = v[2 * i]
+        view[i, 1] = v[2 * i + 1]
+    return result
+
+
+cdef numpy.ndarray pooled_conv( dict buffer, key, vector[vector[int]]& v ):
+    result = reserve( buffer, key, (v.size(), v[0].size() if v.size() > 0 else 0), numpy.int64 )
+    cdef numpy.int64_t[:,:] view = result
+    cdef int i, j
+    for i in range( v.size() ):
+        for j in range( v[i].size() ):
+            view[i, j] = v[i][j]
+    return result
+
+
+cdef tuple pooled_csr( dict buffer, key, vector[int]& v, int n_row ):
+    # v holds (row, column) pairs, whose rows never decrease
+    indptr = reserve( buffer, key + '_indptr', (n_row + 1,), numpy.int32 )
+    indices = reserve( buffer, key, (v.size() // 2,), numpy.int32 )
+    cdef int[:] indptr_view = indptr
+    cdef int[:] indices_view = indices
+    cdef int i
+    cdef int row = 0
+    indptr_view[0] = 0
+    for i in range( v.size() // 2 ):
+        while row < v[2 * i]:
+            row += 1
+            indptr_view[row] = i
+        indices_view[i] = v[2 * i + 1]
+    while row < n_row:
+        row += 1
+        indptr_view[row] = v.size() // 2
+    return (indptr, indices)
+
+
+cdef object pooled_sparse( dict buffer, key, vector[int]& v, int n_row, bint csr ):
+    if csr:
+        return pooled_csr( buffer, key, v, n_row )
+    return pooled_index( buffer, key, v )
+
+
+# positions of the sparse indices in what batch_constructor.mini_batch yields
+sparse_index_position = [ 2, 3, 6, 7, 8, 11, 12, 15, 16, 17, 21, 23 ]
+
+
+def csr_to_coo( index ):
+    """
+    Parameters
+    ----------
+        index : tuple
+            (indptr, indices) of a sparse feature when mini_batch is given 'csr'
+
+    Returns
+    -------
+        The int64 [-1, 2] (row, column) matrix mini_batch yields otherwise, 
+        i.e. what the 'indices' of a TensorFlow SparseTensor is fed. 
+    """
+    indptr, indices = index
+    row = numpy.repeat( numpy.arange( len(indptr) - 1, dtype = numpy.int64 ), numpy.diff( indptr ) )
+    return numpy.column_stack( [ row, indices.astype( numpy.int64 ) ] )
+
+
+def csr_to_scipy( values, index, int n_col ):
+    """
+    Returns
+    -------
+        A float32 scipy.sparse.csr_matrix of a sparse feature when mini_batch is 
+        given 'csr', where 'index' is (indptr, indices) and 'values' are the 
+        matching values, or None for bag-of-words, whose values are all 1. 
+    """
+    indptr, indices = index
+    if values is None:
+        values = numpy.ones( len(indices), dtype = numpy.float32 )
+    result = csr_matrix( (values, indices, indptr), shape = (len(indptr) - 1, n_col), 
+                         dtype = numpy.float32 )
+    # a word may occur more than once in a row, as it does in the (row, column) format
+    result.sum_duplicates()
+    return result
+
+
+def coo_batch( batch ):
+    """
+    Returns
+    -------
+        'batch', what batch_constructor.mini_batch yields, with its sparse 
+        indices in (row, column) format, converted by csr_to_coo if necessary. 
+    """
+    if not isinstance( batch[2], tuple ):
+        return batch
+    batch = list( batch )
+    for k in sparse_index_position:
+        batch[k] = csr_to_coo( batch[k] )
+    return tuple( batch )
         
         
         
 ################################################################################
 
 
-cdef void bigram_char_fofe( string phrase, 
-                            vector[float]& values, vector[int]& indices,
-                            float alpha, int row_id = 0 ) nogil:
-    # printable characters range from 32 (inclusive) to 127 (exclusive), totalling 127 - 32 = 95
-    # anything out of this range is considered OOV
-    cdef int i, c
-    cdef float coef = 1
-    cdef vector[int] char_array
-    cdef ordered_map[int,float] fofe
-    cdef ordered_map[int,float].iterator map_itr
+cdef void insert_count( vector[int]& ids, int first, int last, int row_id,
+                        vector[float]& values, vector[int]& indices ) nogil:
+    # count each id in ids[first:last] and emit them in ascending order
+    cdef int i, n
+    cdef vector[int] buff
+    buff.assign( ids.begin() + first, ids.begin() + last )
+    sort( buff.begin(), buff.end() )
+    i = 0
+    while i < <int>buff.size():
+        n = 1
+        while i + n < <int>buff.size() and buff[i + n] == buff[i]:
+            n += 1
+        indices.push_back( row_id )
+        indices.push_back( buff[i] )
+        values.push_back( n )
+        i += n
 
-    for i in range( phrase.size() ):
-        c = <int>phrase[i];
-        if 32 <= c < 127:
-            char_array.push_back( c - 32 )
-        else:
-            char_array.push_back( 95 )
-        
-    for i in reversed( range( char_array.size() - 1 ) ):
-        c = char_array[i] * 96 + char_array[i + 1]
-        if fofe.find( c ) != fofe.end():
-            fofe[c] += coef
-        else:
-            fofe[c] = coef
 
-    map_itr = fofe.begin()
-    while map_itr != fofe.end():
-        indices.push_back( row_id )
-        indices.push_back( dereference(map_itr).first )
-        values.push_back( dereference(map_itr).second )
-        preincrement( map_itr )
+################################################################################
+
+
+
+cdef enum:
+    POSITIVE_SPAN = 0
+    OVERLAP_SPAN = 1
+    DISJOINT_SPAN = 2
+
+
+cdef void enumerate_span( int n, int window, int n_label_type,
+                          int[:] ner_begin, int[:] ner_end, int[:] ner_label,
+                          vector[int]& span_begin, vector[int]& span_end,
+                          vector[int]& span_label, vector[int]& span_kind ) nogil:
+    """
+    List all spans [i, j) of a sentence of length n with j - i <= window in 
+    the order of (i, j). A span is positive if it is the first mention of 
+    exactly the same boundary, otherwise it is labeled n_label_type and is 
+    either overlap or disjoint. Spans matching a mention whose label is 
+    n_label_type or greater are unsure and skipped. 
+    """
+    cdef int i, j, k, label
+    cdef ordered_map[pair[int,int],int] exact
+    cdef ordered_map[pair[int,int],int].iterator found
+    cdef vector[int] min_begin      # min( ner_begin[k] ) s.t. ner_end[k] > i
+    cdef int n_mention = ner_label.shape[0]
+    cdef int none = 2147483647
+
+    for k in range( n_mention ):
+        if exact.find( pair[int,int]( ner_begin[k], ner_end[k] ) ) == exact.end():
+            exact[pair[int,int]( ner_begin[k], ner_end[k] )] = ner_label[k]
+
+    min_begin.resize( n + 1, none )
+    for k in range( n_mention ):
+        if ner_end[k] > 0 and n > 0:
+            i = min( ner_end[k], n ) - 1
+            min_begin[i] = min( min_begin[i], ner_begin[k] )
+    for i in range( n - 2, -1, -1 ):
+        min_begin[i] = min( min_begin[i], min_begin[i + 1] )
+
+    for i in range( n ):
+        for j in range( i + 1, min( i + window, n ) + 1 ):
+            found = exact.find( pair[int,int]( i, j ) )
+            if found != exact.end():
+                label = dereference( found ).second
+                if label >= n_label_type:
+                    continue
+                span_kind.push_back( POSITIVE_SPAN )
+            else:
+                label = n_label_type
+                if min_begin[i] < j:
+                    span_kind.push_back( OVERLAP_SPAN )
+                else:
+                    span_kind.push_back( DISJOINT_SPAN )
+            span_begin.push_back( i )
+            span_end.push_back( j )
+            span_label.push_back( label )
+
 
 
 ################################################################################
 
 
+cdef class batch_vectors:
+    """
+    What the examples of a mini-batch of batch_constructor are written to 
+    before they are turned into arrays. Each thread of mini_batch_thread_pool 
+    fills one of these on its own. 
+    """
+    cdef vector[float] l1_values    # case-insensitive left context fofe with focus words(s)
+    cdef vector[float] r1_values    
+    cdef vector[int] l1_indices     # case-insensitive right context fofe with focus word(s)
+    cdef vector[int] r1_indices
+    cdef vector[float] l2_values    # case-insensitive left context fofe without focus words(s)
+    cdef vector[float] r2_values    
+    cdef vector[int] l2_indices     # case-insensitive right context fofe without focus word(s)
+    cdef vector[int] r2_indices
+    cdef vector[int] bow1           # case-insensitive bow
+
+    cdef vector[float] l3_values    # case-sensitive left context fofe with focus words(s)
+    cdef vector[float] r3_values    
+    cdef vector[int] l3_indices     # case-sensitive right context fofe with focus word(s)
+    cdef vector[int] r3_indices
+    cdef vector[float] l4_values    # case-sensitive left context fofe without focus words(s)
+    cdef vector[float] r4_values    
+    cdef vector[int] l4_indices     # case-sensitive right context fofe without focus word(s)
+    cdef vector[int] r4_indices     
+    cdef vector[int] bow2           # case-sensitive bow
+
+    cdef vector[vector[int]] conv_idx
+    cdef vector[int] conv_buff
+    cdef int phrase_max_length
+
+    cdef vector[float] lbc_values           # left bigram-char fofe
+    cdef vector[int] lbc_indices
+    cdef vector[float] rbc_values           # right bigram-char fofe
+    cdef vector[int] rbc_indices
+
+    cdef vector[int] label
+    cdef float[:,:] dense                   # char fofe, initial fofe and gazetteer
+    cdef readonly object dense_array
+    cdef vector[float] scratch              # see vocabulary.word_char_fofe
+    cdef readonly int cnt
+
+    def __cinit__( self ):
+        self.phrase_max_length = 10
+        self.scratch.resize( 256 )
+
+
+    def bind( self, dense ):
+        """
+        Parameters
+        ----------
+            dense : numpy.ndarray
+                float32 of (n_batch_size, 513 + n_label_type), all zeros, that 
+                the dense features of the next mini-batch are written to
+        """
+        self.dense_array = dense
+        self.dense = dense
+
+
+    cdef void clear( self ) nogil:
+        self.cnt = 0
+        self.phrase_max_length = 10
+
+        self.l1_values.clear()
+        self.r1_values.clear()
+        self.l1_indices.clear()
+        self.r1_indices.clear()
+        self.l2_values.clear()
+        self.r2_values.clear()
+        self.l2_indices.clear()
+        self.r2_indices.clear()
+        self.bow1.clear()
+
+        self.l3_values.clear()
+        self.r3_values.clear()
+        self.l3_indices.clear()
+        self.r3_indices.clear()
+        self.l4_values.clear()
+        self.r4_values.clear()
+        self.l4_indices.clear()
+        self.r4_indices.clear()
+        self.bow2.clear()
+
+        self.conv_idx.clear()
+        self.label.clear()
+
+        self.lbc_indices.clear()
+        self.lbc_values.clear()
+        self.rbc_indices.clear()
+        self.rbc_values.clear()
+
+
+    def arrays( self, dense, owner = None, bint csr = False ):
+        """
+        Returns
+        -------
+            The tuple batch_constructor.mini_batch yields, whose dense features 
+            are dense[:cnt]. If 'owner', a buffer of a batch_pool, is given, 
+            it is a pooled_tuple backed by 'owner' and 'dense' must be its 
+            'dense' array. Otherwise every array is a copy. If 'csr', sparse 
+            indices are (indptr, indices) pairs instead of (row, column) matrices. 
+        """
+        cdef int k
+        cdef int cnt = self.cnt
+        cdef bint pooled = owner is not None
+
+        with nogil:
+            for k in range( self.conv_idx.size() ):
+                while <int>self.conv_idx[k].size() < self.phrase_max_length:
+                    self.conv_idx[k].push_back( 0 )
+                if self.conv_idx[k].size() > 128:
+                    self.conv_idx[k].resize( 128 )
+
+        # without a pool, the arrays are allocated in a buffer of their own
+        if not pooled:
+            owner = {}
+
+        batch = ( pooled_float32( owner, 'l1_values', self.l1_values ),
+                  pooled_float32( owner, 'r1_values', self.r1_values ),
+                  pooled_sparse( owner, 'l1_indices', self.l1_indices, cnt, csr ),
+                  pooled_sparse( owner, 'r1_indices', self.r1_indices, cnt, csr ),
+                  pooled_float32( owner, 'l2_values', self.l2_values ),
+                  pooled_float32( owner, 'r2_values', self.r2_values ),
+                  pooled_sparse( owner, 'l2_indices', self.l2_indices, cnt, csr ),
+                  pooled_sparse( owner, 'r2_indices', self.r2_indices, cnt, csr ),
+                  pooled_sparse( owner, 'bow1', self.bow1, cnt, csr ),
+                  pooled_float32( owner, 'l3_values', self.l3_values ),
+                  pooled_float32( owner, 'r3_values', self.r3_values ),
+                  pooled_sparse( owner, 'l3_indices', self.l3_indices, cnt, csr ),
+                  pooled_sparse( owner, 'r3_indices', self.r3_indices, cnt, csr ),
+                  pooled_float32( owner, 'l4_values', self.l4_values ),
+                  pooled_float32( owner, 'r4_values', self.r4_values ),
+                  pooled_sparse( owner, 'l4_indices', self.l4_indices, cnt, csr ),
+                  pooled_sparse( owner, 'r4_indices', self.r4_indices, cnt, csr ),
+                  pooled_sparse( owner, 'bow2', self.bow2, cnt, csr ),
+                  dense[:cnt] if pooled else dense[:cnt].copy(),
+                  pooled_conv( owner, 'conv_idx', self.conv_idx ),
+                  pooled_float32( owner, 'lbc_values', self.lbc_values ),
+                  pooled_sparse( owner, 'lbc_indices', self.lbc_indices, cnt, csr ),
+                  pooled_float32( owner, 'rbc_values', self.rbc_values ),
+                  pooled_sparse( owner, 'rbc_indices', self.rbc_indices, cnt, csr ),
+                  pooled_int64( owner, 'label', self.label ) )
+
+        if pooled:
+            batch = pooled_tuple( batch )
+            batch.buffer = owner
+        return batch
+
+
+
+cdef class batch_assembler:
+    """
+    Writes the features of a range of candidates of a batch_constructor to a 
+    batch_vectors without holding the GIL. Sentences are reached through 
+    borrowed pointers, which stay valid as long as this object lives. Several 
+    threads may run it at the same time on different batch_vectors, since 
+    char-level fofe is computed into the scratch of each batch_vectors and the 
+    shared vocabulary is only read. 
+    """
+    cdef list keep                      # the sentence lists the pointers point into
+    cdef vector[PyObject*] sentence1
+    cdef vector[PyObject*] sentence2
+    cdef int[:] example_sentence_id
+    cdef int[:] example_begin
+    cdef int[:] example_end
+    cdef int[:] example_label
+    cdef unsigned short[:] example_gazetteer
+    cdef vocabulary char_numericizer
+    cdef int feature_choice
+    cdef int n_label_type
+    cdef bint has_phrase
+
+    def __init__( self, constructor, int feature_choice ):
+        """
+        Parameters
+        ----------
+            constructor : batch_constructor
+        """
+        cdef processed_sentence sentence
+        self.keep = [ constructor.sentence1, constructor.sentence2 ]
+        for x in constructor.sentence1:
+            self.sentence1.push_back( <PyObject*>x )
+        for x in constructor.sentence2:
+            self.sentence2.push_back( <PyObject*>x )
+        self.example_sentence_id = constructor.example_sentence_id
+        self.example_begin = constructor.example_begin
+        self.example_end = constructor.example_end
+        self.example_label = constructor.example_label
+        self.example_gazetteer = constructor.example_gazetteer
+        self.char_numericizer = constructor.numericizer1
+        self.feature_choice = feature_choice
+        self.n_label_type = constructor.n_label_type
+
+        # the phrase is joined[phrase_begin:phrase_end], which is left empty in Chinese
+        self.has_phrase = constructor.language != 'cmn' and feature_choice & (512 | 1024) > 0
+        if self.has_phrase:
+            for sentence in constructor.sentence1:
+                sentence.prepare_char_table()
+
+
+    def run( self, candidate, int begin, int end, batch_vectors out ):
+        """
+        Append examples candidate[begin:end] to 'out', releasing the GIL. 
+        """
+        cdef int[::1] candidate_view = candidate
+        if end > begin:
+            with nogil:
+                self.assemble( &candidate_view[begin], end - begin, out )
+
+
+    cdef void assemble( self, const int* candidate, int n, batch_vectors out ) nogil:
+        cdef int i, sentence_id
+        for i in range( n ):
+            sentence_id = self.example_sentence_id[candidate[i]]
+            self.assemble_example( <processed_sentence>self.sentence1[sentence_id], 
+                                   <processed_sentence>self.sentence2[sentence_id], 
+                                   candidate[i], out )
+
+
+    cdef void assemble_example( self, processed_sentence sentence, processed_sentence sentence2,
+                                int next_example, batch_vectors out ) nogil:
+        cdef int k, phrase_begin, phrase_end
+        cdef int begin_idx = self.example_begin[next_example]
+        cdef int end_idx = self.example_end[next_example]
+        cdef int feature_choice = self.feature_choice
+        cdef int cnt = out.cnt
+        cdef float* scratch = &out.scratch[0]
+
+        # char-level convolution indices
+        # 1 padding at the begining and the end respectively
+        if feature_choice & 512 > 0:
+            phrase_begin, phrase_end = 0, 0
+            if self.has_phrase:
+                phrase_begin = sentence.phrase_begin( begin_idx )
+                phrase_end = sentence.phrase_end( end_idx )
+            if phrase_end - phrase_begin + 2 > out.phrase_max_length:
+                out.phrase_max_length = phrase_end - phrase_begin + 2
+            out.conv_buff.clear()
+            out.conv_buff.push_back( 0 )
+            for k in range( phrase_begin, phrase_end ):
+                out.conv_buff.push_back( <int>sentence.tokens.joined[k] )
+            out.conv_idx.push_back( out.conv_buff )
+
+        # bigram char-fofe
+        if feature_choice & 1024 > 0 and self.has_phrase:
+            sentence.insert_bigram( begin_idx, end_idx, cnt, 
+                                    out.lbc_values, out.lbc_indices,
+                                    out.rbc_values, out.rbc_indices )
+
+        # character-level fofe of focus word(s), written to dense directly
+
+        if feature_choice & 64 > 0:
+            self.char_numericizer.phrase_char_fofe( sentence.tokens, begin_idx, end_idx,
+                                                    &out.dense[cnt, 0], &out.dense[cnt, 128], 
+                                                    scratch )
+
+        # character-level fofe of initial of focus word(s)
+
+        if feature_choice & 128 > 0:
+            self.char_numericizer.initial_char_fofe( sentence.tokens, begin_idx, end_idx,
+                                                     &out.dense[cnt, 256], &out.dense[cnt, 384], 
+                                                     scratch )
+
+        # gazetteer match
+
+        if feature_choice & 256 > 0:
+            for k in range( self.n_label_type + 1 ):
+                out.dense[cnt, 512 + k] = (self.example_gazetteer[next_example] >> k) & 1
+
+        out.label.push_back( self.example_label[next_example] )
+
+        ########## case-insensitive context with focus ##########
+
+        if feature_choice & 1 > 0:
+            sentence.insert_left_fofe( end_idx - 1, cnt, out.l1_indices, out.l1_values )
+            sentence.insert_right_fofe( begin_idx, cnt, out.r1_indices, out.r1_values )
+
+        ########## case-insensitive context without focus ##########
+
+        if feature_choice & 2 > 0:
+            if begin_idx != 0:
+                sentence.insert_left_fofe( begin_idx - 1, cnt, out.l2_indices, out.l2_values )
+
+            if end_idx != <int>sentence.numeric.size():
+                sentence.insert_right_fofe( end_idx, cnt, out.r2_indices, out.r2_values )
+
+        ########## case-insensitive bow ##########
+
+        if feature_choice & 4 > 0:
+            sentence.insert_bow( begin_idx, end_idx, cnt, out.bow1 )
+
+        ########## case-sensitive context with focus ##########
+
+        if feature_choice & 8 > 0:
+            sentence2.insert_left_fofe( end_idx - 1, cnt, out.l3_indices, out.l3_values )
+            sentence2.insert_right_fofe( begin_idx, cnt, out.r3_indices, out.r3_values )
+
+        ########## case-sensitive context without focus ##########
+
+        if feature_choice & 16 > 0:
+            if begin_idx != 0:
+                sentence2.insert_left_fofe( begin_idx - 1, cnt, out.l4_indices, out.l4_values )
+
+            if end_idx != <int>sentence2.numeric.size():
+                sentence2.insert_right_fofe( end_idx, cnt, out.r4_indices, out.r4_values )
+
+        if feature_choice & 32 > 0:
+            sentence2.insert_bow( begin_idx, end_idx, cnt, out.bow2 )
+
+        out.cnt += 1
+
+
 
 class batch_constructor:
     def __init__( self, parser, 
                   numericizer1, numericizer2,
                   gazetteer = None, window = 7, alpha = 0.7, 
                   n_label_type = 4, language = 'eng',
-                  is2ndPass = False ):
+                  is2ndPass = False, lazy_fofe = False,
+                  fofe_epsilon = 0, fofe_max_length = 0, feature_choice = None ):
         """
         Parameters
         ----------
@@ -773,8 +2902,10 @@ class batch_constructor:
             numericizer2 : vocabulary
                 case-sensitive vocabulary
 
-            gazetteer : list of set
-                Likes of gazetteer, gazetteer[i] contains the known NER of the ith mention type
+            gazetteer : list of set, gazetteer_index or compiled_gazetteer
+                Likes of gazetteer, gazetteer[i] contains the known NER of the ith mention type.
+                A list is indexed on construction; pass a gazetteer_index or a 
+                compiled_gazetteer to share one among several batch_constructors. 
 
             window : int
                 the maximum length of a mention
@@ -788,9 +2919,33 @@ class batch_constructor:
 
             is2ndPass : bool
                 enable 2nd pass if true
+
+            lazy_fofe : bool
+                If true, word-level fofe of a position is computed when a mini-batch 
+                is constructed instead of being stored for every position, which 
+                takes O(n) rather than O(n^2) memory per sentence. 
+
+            fofe_epsilon : float
+                if positive, a word is dropped from word-level fofe when its 
+                weight alpha^distance is less than fofe_epsilon
+
+            fofe_max_length : int
+                if positive, word-level fofe only covers the nearest 
+                fofe_max_length words, including the focus word(s)
+
+            Either cutoff bounds the number of non-zeros per row and implies lazy_fofe.
+
+            feature_choice : int
+                If given, mini_batch can only be asked for these features. Word-level 
+                fofe of a vocabulary none of whose context or bow bits is set is 
+                not built, and the gazetteer is not matched unless 256 is set. 
         """
         assert language in { 'eng', 'cmn', 'spa' }
         self.language = language
+        self.feature_choice = feature_choice
+        self.lazy_fofe = lazy_fofe
+        self.fofe_epsilon = fofe_epsilon
+        self.fofe_max_length = fofe_max_length
 
         # case-insensitive sentence set if language in { 'eng', 'spa' }
         # sequence at char level
@@ -800,10 +2955,21 @@ class batch_constructor:
         # sequence at word level
         self.sentence2 = []
 
-        self.example = []
-        self.positive = []
-        self.overlap = []
-        self.disjoint = []
+        # candidate spans are stored column by column, the ith of them is 
+        # sentence[example_begin[i]:example_end[i]] of the example_sentence_id[i]th 
+        # sentence, labeled example_label[i], and bit k of example_gazetteer[i] is 
+        # set if it is a name of the kth type in the gazetteer
+        self.example_sentence_id = None
+        self.example_begin = None
+        self.example_end = None
+        self.example_label = None
+        self.example_gazetteer = None
+        self.positive = None
+        self.overlap = None
+        self.disjoint = None
+
+        # batch assemblers by feature_choice, built on first use
+        self.assemblers = {}
 
         self.is2ndPass = is2ndPass
 
@@ -812,11 +2978,27 @@ class batch_constructor:
         self.numericizer1 = numericizer1    # case-insensitive / char-level
         self.numericizer2 = numericizer2    # case-sensitive / word-level
 
+        if feature_choice is not None and feature_choice & 256 == 0:
+            gazetteer = None
+        if gazetteer is not None and not isinstance( gazetteer, (gazetteer_index, compiled_gazetteer) ):
+            gazetteer = gazetteer_index( gazetteer, language )
+        assert gazetteer is None or gazetteer.language == language
+        assert gazetteer is None or len(gazetteer) <= 16, 'at most 16 types in a gazetteer'
         self.gazetteer = gazetteer
         self.n_label_type = n_label_type
+        self.window = window
+        self.alpha = alpha
 
-        cdef int i, j, k
-        cdef bint unsure
+        cdef int t, sentence_id
+        cdef bint has_gazetteer = gazetteer is not None
+        # whether the case-insensitive and the case-sensitive word-level features are wanted
+        context1 = feature_choice is None or feature_choice & (1 | 2 | 4) > 0
+        context2 = feature_choice is None or feature_choice & (8 | 16 | 32) > 0
+        cdef int[:,:] gazetteer_view
+        cdef vector[int] span_begin, span_end, span_label, span_kind
+        cdef vector[int] positive, overlap, disjoint
+        cdef vector[int] example_sentence_id, example_begin, example_end, example_label
+        cdef vector[unsigned short] example_gazetteer
 
         for sentence, ner_begin, ner_end, ner_label in parser:
             ner_begin = numpy.asarray(ner_begin, dtype = numpy.int32)
@@ -837,66 +3019,62 @@ class batch_constructor:
             
             label1st_powerset.append( (ner_begin, ner_end, ner_label) )
 
+            if has_gazetteer:
+                gazetteer_view = self.gazetteer.match( sentence, window )
+
             for label1st in label1st_powerset:
-                for i in range( len(sentence) ):
-                    for j in range( i + 1, len(sentence) + 1 ):
-                        unsure, found = False, False
-                        if j - i > window:
-                            break
-                        label = n_label_type
-                        # look for exact match
-                        for k in range(len(ner_label)):
-                            if i == ner_begin[k] and j == ner_end[k]:
-                                label = ner_label[k]
-                                if label < n_label_type:
-                                    self.positive.append( len(self.example) )
-                                else:
-                                    unsure = True
-                                found = True
-                                break
-                        # look for overlap
-                        if not found:
-                            for k in range(len(ner_label)):
-                                if i < ner_end[k] and ner_begin[k] < j:
-                                    label = n_label_type + 1
-                                    self.overlap.append( len(self.example) )
-                                    break
-                        if unsure:
-                            continue
-                        if label == n_label_type:
-                            self.disjoint.append( len(self.example) )
-                        if label == n_label_type + 1:
-                            label = n_label_type
-
-                        gazetteer_match = numpy.zeros( (n_label_type + 1,), dtype = numpy.float32 )
-                        if self.gazetteer is not None:
-                            if language != 'cmn':
-                                name = u' '.join(sentence[i:j])
-                            else:
-                                name = u''.join( w[:w.find(u'|iNCML|')] for w in sentence[i:j] )
-                            for k, g in enumerate(self.gazetteer):
-                                if name in g:
-                                    gazetteer_match[k] = 1
-
-                        self.example.append( example( len(self.sentence1), 
-                                                      i, j, label ,gazetteer_match) )
+                span_begin.clear()
+                span_end.clear()
+                span_label.clear()
+                span_kind.clear()
+                enumerate_span( len(sentence), window, n_label_type,
+                                ner_begin, ner_end, ner_label,
+                                span_begin, span_end, span_label, span_kind )
+
+                sentence_id = len(self.sentence1)
+                with nogil:
+                    for t in range( span_kind.size() ):
+                        if span_kind[t] == POSITIVE_SPAN:
+                            positive.push_back( example_label.size() )
+                        elif span_kind[t] == OVERLAP_SPAN:
+                            overlap.push_back( example_label.size() )
+                        else:
+                            disjoint.push_back( example_label.size() )
+                        example_sentence_id.push_back( sentence_id )
+                        example_begin.push_back( span_begin[t] )
+                        example_end.push_back( span_end[t] )
+                        example_label.push_back( span_label[t] )
+                        if has_gazetteer:
+                            example_gazetteer.push_back( 
+                                gazetteer_view[span_begin[t], span_end[t] - span_begin[t] - 1] )
+                        else:
+                            example_gazetteer.push_back( 0 )
                 
                 if not self.is2ndPass:
                     label1st = None
 
                 if language != 'cmn': 
+                    tokens = token_arena( sentence )
                     self.sentence1.append( processed_sentence( 
-                        sentence, 
+                        tokens, 
                         numericizer1, 
                         alpha, 
                         language,
-                        label1st 
+                        label1st,
+                        lazy_fofe,
+                        fofe_epsilon,
+                        fofe_max_length,
+                        context = context1
                     ) )
                     self.sentence2.append( processed_sentence( 
-                        sentence, numericizer2, 
+                        tokens, numericizer2, 
                         alpha, 
                         language,
-                        label1st 
+                        label1st,
+                        lazy_fofe,
+                        fofe_epsilon,
+                        fofe_max_length,
+                        context = context2
                     ) )
                 else:
                     char_sequence, word_sequence = [], []
@@ -909,19 +3087,32 @@ class batch_constructor:
                         numericizer1,
                         alpha, 
                         language,
-                        label1st 
+                        label1st,
+                        lazy_fofe,
+                        fofe_epsilon,
+                        fofe_max_length,
+                        context = context1
                     ) )
                     self.sentence2.append( processed_sentence( 
                         word_sequence, 
                         numericizer2,
                         alpha, 
                         language,
-                        label1st 
+                        label1st,
+                        lazy_fofe,
+                        fofe_epsilon,
+                        fofe_max_length,
+                        context = context2
                     ) )
 
-        self.positive = numpy.asarray( self.positive, dtype = numpy.int32 )
-        self.overlap = numpy.asarray( self.overlap, dtype = numpy.int32 )
-        self.disjoint = numpy.asarray( self.disjoint, dtype = numpy.int32 )
+        self.example_sentence_id = int32_array( example_sentence_id )
+        self.example_begin = int32_array( example_begin )
+        self.example_end = int32_array( example_end )
+        self.example_label = int32_array( example_label )
+        self.example_gazetteer = uint16_array( example_gazetteer )
+        self.positive = int32_array( positive )
+        self.overlap = int32_array( overlap )
+        self.disjoint = int32_array( disjoint )
 
 
     def __str__( self ):
@@ -935,11 +3126,26 @@ class batch_constructor:
                     self.positive.shape[0], self.overlap.shape[0], self.disjoint.shape[0]) )
 
 
+    def assembler( self, int feature_choice ):
+        """
+        Returns
+        -------
+            The batch_assembler of 'feature_choice', which is built once and 
+            shared by every mini_batch of this object. 
+        """
+        assert self.feature_choice is None or feature_choice & ~self.feature_choice == 0, \
+                'feature_choice %d is asked for, but only %d is prepared' % (feature_choice, self.feature_choice)
+        if feature_choice not in self.assemblers:
+            self.assemblers[feature_choice] = batch_assembler( self, feature_choice )
+        return self.assemblers[feature_choice]
+
+
     @cython.boundscheck(False)
     def mini_batch( self, int n_batch_size, 
                     bint shuffle_needed = True, float overlap_rate = 0.36, 
                     float disjoint_rate = 0.08, int feature_choice = 255, 
-                    bint replace = False, int n_copy = 1  ):
+                    bint replace = False, int n_copy = 1, pool = None, candidate = None, 
+                    bint csr = False ):
         """
         The generator yields mini batches of size 'n_batch_size'. Based on 
         'feature_choice', the following features may be selected:
@@ -972,6 +3178,20 @@ class batch_constructor:
             n_copy : int
                 how many times to chain this iterator
 
+            pool : batch_pool
+                If given, mini-batches are pooled_tuple's written to the buffers 
+                of 'pool', which must be released after use, instead of new arrays.
+
+            candidate : numpy.ndarray
+                If given, examples are taken in this order, e.g. a slice of what 
+                sample_candidate returns, and the sampling arguments are ignored.
+
+            csr : bool
+                If True, the indices of l1 to r4, bow1, bow2 and the bigram-char 
+                features are int32 (indptr, indices) pairs in CSR layout instead 
+                of int64 (row, column) matrices; see csr_to_coo, csr_to_scipy 
+                and coo_batch.
+
         Returns
         -------
             l1_values : 
@@ -979,263 +3199,48 @@ class batch_constructor:
 
 
         """
-        cdef vector[float] l1_values    # case-insensitive left context fofe with focus words(s)
-        cdef vector[float] r1_values    
-        cdef vector[int] l1_indices     # case-insensitive right context fofe with focus word(s)
-        cdef vector[int] r1_indices
-        cdef vector[float] l2_values    # case-insensitive left context fofe without focus words(s)
-        cdef vector[float] r2_values    
-        cdef vector[int] l2_indices     # case-insensitive right context fofe without focus word(s)
-        cdef vector[int] r2_indices
-        cdef vector[int] bow1           # case-insensitive bow
-
-        cdef vector[float] l3_values    # case-sensitive left context fofe with focus words(s)
-        cdef vector[float] r3_values    
-        cdef vector[int] l3_indices     # case-sensitive right context fofe with focus word(s)
-        cdef vector[int] r3_indices
-        cdef vector[float] l4_values    # case-sensitive left context fofe without focus words(s)
-        cdef vector[float] r4_values    
-        cdef vector[int] l4_indices     # case-sensitive right context fofe without focus word(s)
-        cdef vector[int] r4_indices     
-        cdef vector[int] bow2           # case-sensitive bow
-
-        cdef vector[vector[int]] conv_idx
-        cdef vector[int] conv_buff
-        cdef string phrase, reversed_phrase
-        
-        cdef vector[float] lbc_values           # left bigram-char fofe
-        cdef vector[int] lbc_indices
-        
-        cdef vector[float] rbc_values           # right bigram-char fofe
-        cdef vector[int] rbc_indices
-
-        cdef example next_example
-        cdef processed_sentence sentence
-        cdef vector[int] label
-        cdef int i, j, k, begin_idx, end_idx
-        cdef int cnt = 0
-        cdef int n
-        cdef int phrase_max_length = 10
-        cdef float bigram_alpha
+        cdef int n, begin
+        cdef batch_assembler assembler = self.assembler( feature_choice )
+        cdef batch_vectors out = batch_vectors()
 
         # has_char_feature = feature_choice & (64 | 128 | 512 | 1024)
         # assert not has_char_feature or self.language != 'cmn', \
         #         'Chinese is modeled at character level. '
 
-        if n_copy > 1:
-            shuffle_needed = True
-            replace = True
-
-        dense_buffer = numpy.zeros( (n_batch_size, 513 + self.n_label_type), dtype = numpy.float32 )
-
-        if len( self.disjoint ) > 0: 
-            disjoint = numpy.random.choice( self.disjoint,
-                                            size = numpy.int32( len(self.disjoint) * disjoint_rate * n_copy ),
-                                            replace = replace )
-        else:
-            disjoint = numpy.asarray([]).astype( numpy.int32 )
-
-        if len( self.overlap ) > 0:
-            overlap = numpy.random.choice( self.overlap,
-                                           size = numpy.int32( len(self.overlap) * overlap_rate * n_copy ),
-                                           replace = replace )
-        else:
-            overlap = numpy.asarray([]).astype( numpy.int32 )
-
-        candidate = numpy.concatenate( [ self.positive ] * n_copy + [ disjoint, overlap ] )
-
-        if shuffle_needed:
-            numpy.random.shuffle( candidate )
-        else:
-            candidate.sort()
-        n = len(candidate)
-
-        for i in range( n ):
-            next_example = self.example[ candidate[i] ]
-            begin_idx = next_example.begin_idx
-            end_idx = next_example.end_idx
-
-            sentence = self.sentence1[next_example.sentence_id]
-
-            if self.language != 'cmn':
-                phrase = ' '.join( sentence.sentence[begin_idx:end_idx] )
-                reversed_phrase = ' '.join( sentence.sentence[begin_idx:end_idx] )[::-1]
-                bigram_alpha = self.numericizer1.alpha
-
-            with nogil:
-                # char-level convolution indices
-                # 1 padding at the begining and the end respectively
-                if feature_choice & 512 > 0:
-                    if phrase.size() + 2 > phrase_max_length:
-                        phrase_max_length = phrase.size() + 2
-                    conv_buff.clear()
-                    conv_buff.push_back( 0 )
-                    for k in range( phrase.size() ):
-                        conv_buff.push_back( <int>phrase[k] )
-                    conv_idx.push_back( conv_buff )
-                    
-                # bigram char-fofe
-                if feature_choice & 1024 > 0:
-                    bigram_char_fofe( phrase, lbc_values, lbc_indices, bigram_alpha, cnt )
-                    bigram_char_fofe( reversed_phrase, rbc_values, rbc_indices, 
-                                      bigram_alpha, cnt )
-
-            # character-level fofe of focus word(s)
-
-            if feature_choice & 64 > 0:
-                
-                left_c, right_c = self.numericizer1 \
-                                      .char_fofe_of_phrase( sentence.sentence[begin_idx:end_idx] )
-                
-                # left_c, _ = self.numericizer1.char_fofe_of_word(
-                #             ''.join( [ w[0] for w in sentence.sentence[:end_idx] ] ) )
-                # _, right_c = self.numericizer1.char_fofe_of_word(
-                #             ''.join( [ w[0] for w in sentence.sentence[begin_idx:] ] ) )
-                
-                dense_buffer[cnt,:128] = left_c
-                dense_buffer[cnt,128:256] = right_c
-
-            # character-level fofe of initial of focus word(s)
-
-            if feature_choice & 128 > 0:
-                left_init, right_init = self.numericizer1.char_fofe_of_word(
-                            ''.join( [ w[0] for w in sentence.sentence[begin_idx:end_idx] ] ) )
-                dense_buffer[cnt,256:384] = left_init
-                dense_buffer[cnt,384:512] = right_init
-
-            # gazetteer match
-
-            if feature_choice & 256 > 0:
-                dense_buffer[cnt,512:] = next_example.gazetteer
-
-            label.push_back( next_example.label )
-
-            ########## case-insensitive context with focus ##########
-
-            if feature_choice & 1 > 0:
-                sentence.insert_left_fofe( end_idx - 1, cnt, l1_indices, l1_values )
-                sentence.insert_right_fofe( begin_idx, cnt, r1_indices, r1_values )
-
-            ########## case-insensitive context without focus ##########
-
-            if feature_choice & 2 > 0:
-                if begin_idx != 0:
-                    sentence.insert_left_fofe( begin_idx - 1, cnt, l2_indices, l2_values )
-
-                if end_idx != sentence.numeric.size():
-                    sentence.insert_right_fofe( end_idx, cnt, r2_indices, r2_values )
-
-            ########## case-insensitive bow ##########
-
-            if feature_choice & 4 > 0:
-                sentence.insert_bow( begin_idx, end_idx, cnt, bow1 )
-
-            # switch to case-sensitive
-            sentence = self.sentence2[next_example.sentence_id]
-
-            ########## case-sensitive context with focus ##########
-
-            if feature_choice & 8 > 0:
-                sentence.insert_left_fofe( end_idx - 1, cnt, l3_indices, l3_values )
-                sentence.insert_right_fofe( begin_idx, cnt, r3_indices, r3_values )
-
-
-            ########## case-sensitive context without focus ##########
-
-            if feature_choice & 16 > 0:
-                if begin_idx != 0:
-                    sentence.insert_left_fofe( begin_idx - 1, cnt, l4_indices, l4_values )
-
-                if end_idx != sentence.numeric.size():
-                    sentence.insert_right_fofe( end_idx, cnt, r4_indices, r4_values )
-
-            if feature_choice & 32 > 0:
-                sentence.insert_bow( begin_idx, end_idx, cnt, bow2 )
+        if candidate is None:
+            candidate = sample_candidate( self, shuffle_needed, overlap_rate, 
+                                          disjoint_rate, replace, n_copy )
+        candidate = numpy.ascontiguousarray( candidate, dtype = numpy.int32 )
+        n = len(candidate)
 
-            cnt += 1
-            if cnt % n_batch_size == 0 or (i + 1) == len(candidate):
-                with nogil:
-                    if feature_choice & 512 > 0:
-                        for k in range( conv_idx.size() ):
-                            while conv_idx[k].size() < phrase_max_length:
-                                conv_idx[k].push_back( 0 )
-                            if conv_idx[k].size() > 128:
-                                conv_idx[k].resize( 128 )
-
-                # they must be either copied for wrapped by asarray
-                # because of multithreding
-                yield   numpy.asarray( l1_values, dtype = numpy.float32 ),\
-                        numpy.asarray( r1_values, dtype = numpy.float32 ),\
-                        numpy.reshape( l1_indices, [-1, 2] ),\
-                        numpy.reshape( r1_indices, [-1, 2] ),\
-                        numpy.asarray( l2_values, dtype = numpy.float32 ),\
-                        numpy.asarray( r2_values, dtype = numpy.float32 ),\
-                        numpy.reshape( l2_indices, [-1, 2] ),\
-                        numpy.reshape( r2_indices, [-1, 2] ),\
-                        numpy.reshape( bow1, [-1, 2] ),\
-                        numpy.asarray( l3_values, dtype = numpy.float32 ),\
-                        numpy.asarray( r3_values, dtype = numpy.float32 ),\
-                        numpy.reshape( l3_indices, [-1, 2] ),\
-                        numpy.reshape( r3_indices, [-1, 2] ),\
-                        numpy.asarray( l4_values, dtype = numpy.float32 ),\
-                        numpy.asarray( r4_values, dtype = numpy.float32 ),\
-                        numpy.reshape( l4_indices, [-1, 2] ),\
-                        numpy.reshape( r4_indices, [-1, 2] ),\
-                        numpy.reshape( bow2, [-1, 2] ),\
-                        dense_buffer[:cnt].copy(),\
-                        numpy.asarray( conv_idx ) if conv_idx.size() > 0 else numpy.empty((0,0), numpy.int64),\
-                        numpy.asarray( lbc_values, dtype = numpy.float32 ), \
-                        numpy.reshape( lbc_indices, [-1, 2]  ), \
-                        numpy.asarray( rbc_values, dtype = numpy.float32 ), \
-                        numpy.reshape( rbc_indices, [-1, 2]  ), \
-                        numpy.asarray( label )
+        for begin in range( 0, n, n_batch_size ):
+            owner = pool.acquire() if pool is not None else None
+            if owner is not None:
+                dense_buffer = reserve( owner, 'dense', (n_batch_size, 513 + self.n_label_type), 
+                                        numpy.float32 )
+                dense_buffer[:,:] = 0
+            else:
+                dense_buffer = numpy.zeros( (n_batch_size, 513 + self.n_label_type), dtype = numpy.float32 )
+            out.bind( dense_buffer )
 
-                with nogil:
-                    cnt = 0
-                    phrase_max_length = 10
-
-                    l1_values.clear()
-                    r1_values.clear()
-                    l1_indices.clear()
-                    r1_indices.clear()
-                    l2_values.clear()
-                    r2_values.clear()
-                    l2_indices.clear()
-                    r2_indices.clear()
-                    bow1.clear()
-
-                    l3_values.clear()
-                    r3_values.clear()
-                    l3_indices.clear()
-                    r3_indices.clear()
-                    l4_values.clear()
-                    r4_values.clear()
-                    l4_indices.clear()
-                    r4_indices.clear()
-                    bow2.clear()
-
-                    conv_idx.clear()
-                    label.clear()
-
-                    lbc_indices.clear()
-                    lbc_values.clear()
-                    rbc_indices.clear()
-                    rbc_values.clear()
-
-                dense_buffer = numpy.zeros( (n_batch_size, 513 + self.n_label_type), 
-                                            dtype = numpy.float32 )
+            assembler.run( candidate, begin, min( begin + n_batch_size, n ), out )
+            batch = out.arrays( dense_buffer, owner, csr )
+            with nogil:
+                out.clear()
+            yield batch
 
 
     def mini_batch_multi_thread( self, int n_batch_size, 
                                  bint shuffle_needed = True, float overlap_rate = 0.36, 
                                  float disjoint_rate = 0.08, int feature_choice = 255, 
-                                 bint replace = False, float timeout = -1, int n_copy = 1  ):
+                                 bint replace = False, float timeout = -1, int n_copy = 1,
+                                 pool = None, bint csr = False ):
         """
         Same as self.mini_batch except that data preparation is done on the background
         """
         batch_generator = self.mini_batch( n_batch_size, shuffle_needed, 
                                            overlap_rate, disjoint_rate,
-                                           feature_choice, replace )
+                                           feature_choice, replace, pool = pool, csr = csr )
         batch_buffer = Queue( maxsize = 256 )
         t = Thread( target = prepare_mini_batch, 
                     args = ( batch_generator, batch_buffer, timeout if timeout > 0 else None ) )
@@ -1252,16 +3257,83 @@ class batch_constructor:
     def infinite_mini_batch_multi_thread( self, int n_batch_size, 
                                           bint shuffle_needed = True, float overlap_rate = 0.36, 
                                           float disjoint_rate = 0.08, int feature_choice = 255, 
-                                          bint replace = True, float timeout = -1, int n_copy = 10  ):
+                                          bint replace = True, float timeout = -1, int n_copy = 10,
+                                          pool = None, int n_prefetch = 16, bint csr = False ):
         """
-        Same as self.mini_batch_multi_thread except that sampling is done infinitely.
+        Same as self.mini_batch_multi_thread except that sampling is done infinitely 
+        by a stream_sampler, which yields full mini-batches only and never restarts. 
+        Each time the sampler runs short of examples, 'n_copy' passes are sampled. 
         """
-        while True:
-            for next_batch in self.mini_batch_multi_thread( n_batch_size, shuffle_needed, 
-                                                            overlap_rate, disjoint_rate,
-                                                            feature_choice, replace, timeout, n_copy ):
-                if next_batch[-1].shape[0] == n_batch_size:
-                    yield next_batch
+        return stream_sampler( self, n_batch_size, 
+                               { 'shuffle_needed' : shuffle_needed, 
+                                 'overlap_rate' : overlap_rate, 
+                                 'disjoint_rate' : disjoint_rate, 
+                                 'replace' : replace, 
+                                 'n_copy' : n_copy },
+                               { 'feature_choice' : feature_choice, 'csr' : csr },
+                               n_prefetch, pool, timeout if timeout > 0 else None )
+
+
+    def mini_batch_thread_pool( self, int n_batch_size, 
+                                bint shuffle_needed = True, float overlap_rate = 0.36, 
+                                float disjoint_rate = 0.08, int feature_choice = 255, 
+                                bint replace = False, int n_copy = 1, 
+                                int n_thread = 4, pool = None, bint csr = False ):
+        """
+        Same as self.mini_batch except that 'n_thread' threads assemble several 
+        mini-batches at the same time. A mini-batch is assembled without the GIL, 
+        so that the threads really run in parallel, in a single process. 
+        """
+        cdef batch_vectors out
+        cdef batch_assembler assembler = self.assembler( feature_choice )
+        candidate = numpy.ascontiguousarray( 
+                sample_candidate( self, shuffle_needed, overlap_rate, 
+                                  disjoint_rate, replace, n_copy ), 
+                dtype = numpy.int32 )
+        n = len(candidate)
+        shape = (n_batch_size, 513 + self.n_label_type)
+        scratch = []
+
+        def assemble( b ):
+            if len( scratch ) > 0:
+                result = scratch.pop()
+            else:
+                result = batch_vectors()
+                result.bind( numpy.zeros( shape, dtype = numpy.float32 ) )
+            assembler.run( candidate, b * n_batch_size, min( (b + 1) * n_batch_size, n ), result )
+            return result
+
+        for out in thread_pool_mini_batch( assemble, (n + n_batch_size - 1) // n_batch_size, n_thread ):
+            if pool is not None:
+                owner = pool.acquire()
+                dense_buffer = reserve( owner, 'dense', shape, numpy.float32 )
+                dense_buffer[:out.cnt] = out.dense_array[:out.cnt]
+                batch = out.arrays( dense_buffer, owner, csr )
+            else:
+                batch = out.arrays( out.dense_array, None, csr )
+            out.dense_array[:out.cnt] = 0
+            out.clear()
+            scratch.append( out )
+            yield batch
+
+
+    def mini_batch_multi_process( self, int n_batch_size, 
+                                  bint shuffle_needed = True, float overlap_rate = 0.36, 
+                                  float disjoint_rate = 0.08, int feature_choice = 255, 
+                                  bint replace = False, int n_copy = 1, 
+                                  int n_worker = 4, int n_slot = 2, pool = None, 
+                                  bint csr = False ):
+        """
+        Same as self.mini_batch except that data preparation is shared by 'n_worker' 
+        processes, each of which owns every n_worker-th mini-batch of the sampled 
+        candidates. Mini-batches are passed through shared memory and yielded in 
+        order. Given the state of numpy.random, the result does not depend on 'n_worker'. 
+        """
+        candidate = sample_candidate( self, shuffle_needed, overlap_rate, 
+                                      disjoint_rate, replace, n_copy )
+        return shared_mini_batch( self, n_batch_size, candidate, 
+                                  { 'feature_choice' : feature_choice, 'csr' : csr },
+                                  n_worker, n_slot, pool )
 
 
 
@@ -1811,26 +3883,35 @@ def distant_supervision_parser( sentence_file, tag_file,
 
 cdef class processed_sentence_v2:
     cdef readonly vector[int] numeric
-    cdef readonly vector[string] sentence
+    cdef readonly token_arena tokens
     cdef readonly vector[vector[int]] left2nd
     cdef readonly vector[vector[int]] right2nd
     cdef readonly bint is_2nd_pass
 
 
     def __init__( self, sentence, numericizer, 
-                  language = 'eng', label1st = None ):
+                  language = 'eng', label1st = None, context = True ):
+        """
+        If 'context' is False, the sentence is kept for its characters only 
+        and no word-level feature can be asked for; see processed_sentence. 
+        """
         cdef vocabulary vocab
         if language != 'cmn':
-            for w in sentence:
-                self.sentence.push_back(
-                    u''.join( c if ord(c) < 128 else chr(ord(c) % 32) for c in list(w) )
-                )
-            vocab = numericizer
-            vocab.sentence2indices( self.sentence, self.numeric )
+            if isinstance( sentence, token_arena ):
+                self.tokens = sentence
+            else:
+                self.tokens = token_arena( sentence )
+            if context:
+                vocab = numericizer
+                vocab.sentence2indices( self.tokens.tokens(), self.numeric )
         else:
-            self.numeric = numericizer.sentence2indices( sentence )
+            self.tokens = token_arena( [] )
+            if context:
+                self.numeric = numericizer.sentence2indices( sentence )
 
         self.is_2nd_pass = (label1st is not None)
+        if not context:
+            return
 
         cdef ordered_map[int,int] boe
         cdef ordered_map[int,int] eoe
@@ -1878,6 +3959,15 @@ cdef class processed_sentence_v2:
                 reverse( self.right2nd.begin(), self.right2nd.end() )
 
 
+    @property
+    def sentence( self ):
+        return self.tokens.tokens()
+
+
+    def __len__( self ):
+        return self.numeric.size()
+
+
     @cython.boundscheck(False)
     cdef int insert_left( self, int pos, int[:] context ) nogil:
         cdef int i
@@ -1926,15 +4016,268 @@ cdef class processed_sentence_v2:
 
 
 
+cdef class batch_matrices:
+    """
+    The padded matrices a mini-batch of batch_constructor_v2 is written to, 
+    and how much of each one is used. Each thread of mini_batch_thread_pool 
+    fills one of these on its own. 
+    """
+    cdef list arrays
+    cdef int[:,:] lw1v
+    cdef int[:,:] rw1v
+    cdef int[:,:] lw2v
+    cdef int[:,:] rw2v
+    cdef int[:,:] lw3v
+    cdef int[:,:] rw3v
+    cdef int[:,:] lw4v
+    cdef int[:,:] rw4v
+    cdef int[:,:] bow1v
+    cdef int[:,:] bow2v
+    cdef int[:,:] linitv
+    cdef int[:,:] rinitv
+    cdef int[:,:] lcv
+    cdef int[:,:] rcv
+    cdef int[:] label_view
+    cdef float[:,:] gaz_view
+
+    cdef int lw1len
+    cdef int rw1len
+    cdef int lw2len
+    cdef int rw2len
+    cdef int lw3len
+    cdef int rw3len
+    cdef int lw4len
+    cdef int rw4len
+    cdef int bowlen
+    cdef int clen
+    cdef readonly int cnt
+
+    def bind( self, arrays ):
+        """
+        Parameters
+        ----------
+            arrays : list
+                what batch_constructor_v2.output_buffer returns
+        """
+        self.arrays = list( arrays )
+        self.lw1v, self.rw1v, self.lw2v, self.rw2v, \
+        self.lw3v, self.rw3v, self.lw4v, self.rw4v, \
+        self.bow1v, self.bow2v, self.linitv, self.rinitv, \
+        self.lcv, self.rcv, self.label_view, self.gaz_view = arrays
+
+
+    cdef void reset( self, int pad1, int pad2 ) nogil:
+        self.cnt = 0
+        self.lw1len = 1
+        self.rw1len = 1
+        self.lw2len = 1
+        self.rw2len = 1
+        self.lw3len = 1
+        self.rw3len = 1
+        self.lw4len = 1
+        self.rw4len = 1
+        self.bowlen = 1
+        self.clen = 10
+        self.lw1v[:,:] = pad1
+        self.rw1v[:,:] = pad1
+        self.lw2v[:,:] = pad1
+        self.rw2v[:,:] = pad1
+        self.bow1v[:,:] = pad1
+        self.lw3v[:,:] = pad2
+        self.rw3v[:,:] = pad2
+        self.lw4v[:,:] = pad2
+        self.rw4v[:,:] = pad2
+        self.bow2v[:,:] = pad2
+        self.lcv[:,:] = 127
+        self.rcv[:,:] = 127
+        self.linitv[:,:] = 127
+        self.rinitv[:,:] = 127
+        self.gaz_view[:,:] = 0
+
+
+    def batch( self, bint copied = True ):
+        """
+        Returns
+        -------
+            The dict batch_constructor_v2.mini_batch yields, whose arrays are 
+            copies if 'copied' or views of the bound arrays otherwise. 
+        """
+        cdef int cnt = self.cnt
+        lw1, rw1, lw2, rw2, lw3, rw3, lw4, rw4, bow1, bow2, \
+        linit, rinit, lc, rc, label, gaz_buff = self.arrays
+        copy = (lambda x : x.copy()) if copied else (lambda x : x)
+        return {
+            'word' : {
+                'case-insensitive' : {
+                    'left-incl' : copy( lw1[:cnt,:self.lw1len] ),
+                    'right-incl' : copy( rw1[:cnt,:self.rw1len] ),
+                    'left-excl' : copy( lw2[:cnt,:self.lw2len] ),
+                    'right-excl' : copy( rw2[:cnt,:self.rw2len] ),
+                    'bow' : copy( bow1[:cnt,:self.bowlen] )
+                },
+                'case-sensitive' : {
+                    'left-incl' : copy( lw3[:cnt,:self.lw3len] ),
+                    'right-incl' : copy( rw3[:cnt,:self.rw3len] ),
+                    'left-excl' : copy( lw4[:cnt,:self.lw4len] ),
+                    'right-excl' : copy( rw4[:cnt,:self.rw4len] ),
+                    'bow' : copy( bow2[:cnt,:self.bowlen] )
+                }
+            },
+            'char' : {
+                'left' : copy( lc[:cnt,:self.clen] ),
+                'right' : copy( rc[:cnt,:self.clen] ),
+                'left-initial' : copy( linit[:cnt,:self.bowlen] ),
+                'right-initial' : copy( rinit[:cnt,:self.bowlen] )
+            },
+            'gaz' : copy( gaz_buff[:cnt,:] ),
+            'target' : copy( label[:cnt] )
+        }
+
+
+
+cdef class batch_assembler_v2:
+    """
+    Same as batch_assembler, for batch_constructor_v2 and batch_matrices. 
+    """
+    cdef list keep
+    cdef vector[PyObject*] sentence1
+    cdef vector[PyObject*] sentence2
+    cdef int[:] example_sentence_id
+    cdef int[:] example_begin
+    cdef int[:] example_end
+    cdef int[:] example_label
+    cdef unsigned short[:] example_gazetteer
+    cdef int feature_choice
+    cdef bint spaced                    # False in Chinese, which has no char feature
+    cdef readonly int pad1
+    cdef readonly int pad2
+
+    def __init__( self, constructor, int feature_choice ):
+        self.keep = [ constructor.sentence1, constructor.sentence2 ]
+        for x in constructor.sentence1:
+            self.sentence1.push_back( <PyObject*>x )
+        for x in constructor.sentence2:
+            self.sentence2.push_back( <PyObject*>x )
+        self.example_sentence_id = constructor.example_sentence_id
+        self.example_begin = constructor.example_begin
+        self.example_end = constructor.example_end
+        self.example_label = constructor.example_label
+        self.example_gazetteer = constructor.example_gazetteer
+        self.feature_choice = feature_choice
+        self.spaced = constructor.language != 'cmn'
+        self.pad1 = constructor.pad1
+        self.pad2 = constructor.pad2
+
+
+    def run( self, candidate, int begin, int end, batch_matrices out ):
+        """
+        Reset 'out' and write examples candidate[begin:end] to it, releasing the GIL. 
+        """
+        cdef int[::1] candidate_view = candidate
+        with nogil:
+            out.reset( self.pad1, self.pad2 )
+            if end > begin:
+                self.assemble( &candidate_view[begin], end - begin, out )
+
+
+    cdef void assemble( self, const int* candidate, int n, batch_matrices out ) nogil:
+        cdef int i, sentence_id
+        for i in range( n ):
+            sentence_id = self.example_sentence_id[candidate[i]]
+            self.assemble_example( <processed_sentence_v2>self.sentence1[sentence_id], 
+                                   <processed_sentence_v2>self.sentence2[sentence_id], 
+                                   candidate[i], out )
+
+
+    @cython.boundscheck(False)
+    cdef void assemble_example( self, processed_sentence_v2 sentence, processed_sentence_v2 sentence2,
+                                int next_example, batch_matrices out ) nogil:
+        cdef int j, k
+        cdef int begin_idx = self.example_begin[next_example]
+        cdef int end_idx = self.example_end[next_example]
+        cdef int feature_choice = self.feature_choice
+        cdef int cnt = out.cnt
+        cdef const char* joined
+        cdef int first, last, phrase_cpy_len, phrase_length
+
+        if feature_choice & 256 > 0:
+            for k in range( out.gaz_view.shape[1] ):
+                if (self.example_gazetteer[next_example] >> k) & 1:
+                    out.gaz_view[cnt, k] = 1
+
+        if self.spaced:
+            # ' '.join( sentence[begin_idx:end_idx] ) is joined[first:last]
+            joined = sentence.tokens.joined.c_str()
+            first = sentence.tokens.token_begin( begin_idx )
+            last = sentence.tokens.token_end( end_idx - 1 )
+
+            if feature_choice & 128 > 0:
+                # the initial of an empty word is '\0'
+                phrase_length = min( end_idx - begin_idx, out.linitv.shape[1] )
+                for j in range( phrase_length ):
+                    k = begin_idx + j
+                    if sentence.tokens.token_end( k ) > sentence.tokens.token_begin( k ):
+                        out.linitv[cnt, j] = (<unsigned char>joined[sentence.tokens.token_begin( k )]) % 128
+                    else:
+                        out.linitv[cnt, j] = 0
+                    k = end_idx - 1 - j
+                    if sentence.tokens.token_end( k ) > sentence.tokens.token_begin( k ):
+                        out.rinitv[cnt, j] = (<unsigned char>joined[sentence.tokens.token_begin( k )]) % 128
+                    else:
+                        out.rinitv[cnt, j] = 0
+
+            if feature_choice & (512 | 64) > 0:
+                phrase_cpy_len = min( last - first, out.lcv.shape[1] - 2 )
+                for j in range( phrase_cpy_len ):
+                    out.lcv[cnt, 1 + j] = <unsigned char>joined[first + j]
+                if phrase_cpy_len + 2 > out.clen:
+                    out.clen = phrase_cpy_len + 2
+
+                if feature_choice & 64 > 0:
+                    for j in range( phrase_cpy_len ):
+                        out.rcv[cnt, 1 + j] = <unsigned char>joined[last - 1 - j]
+
+        out.label_view[cnt] = self.example_label[next_example]
+
+        if feature_choice & 1 > 0:
+            out.lw1len = max( out.lw1len, sentence.insert_left( end_idx - 1, out.lw1v[cnt] ) )
+            out.rw1len = max( out.rw1len, sentence.insert_right( begin_idx, out.rw1v[cnt] ) )
+
+        if feature_choice & 2 > 0:
+            out.lw2len = max( out.lw2len, sentence.insert_left( begin_idx - 1, out.lw2v[cnt] ) )
+            out.rw2len = max( out.rw2len, sentence.insert_right( end_idx, out.rw2v[cnt] ) )
+
+        if feature_choice & 4 > 0:
+            out.bowlen = max( out.bowlen, sentence.insert_bow( begin_idx, end_idx, out.bow1v[cnt] ) )
+
+        if feature_choice & 8 > 0:
+            out.lw3len = max( out.lw3len, sentence2.insert_left( end_idx - 1, out.lw3v[cnt] ) )
+            out.rw3len = max( out.rw3len, sentence2.insert_right( begin_idx, out.rw3v[cnt] ) )
+
+        if feature_choice & 16 > 0:
+            out.lw4len = max( out.lw4len, sentence2.insert_left( begin_idx - 1, out.lw4v[cnt] ) )
+            out.rw4len = max( out.rw4len, sentence2.insert_right( end_idx, out.rw4v[cnt] ) )
+
+        if feature_choice & 32 > 0:
+            out.bowlen = max( out.bowlen, sentence2.insert_bow( begin_idx, end_idx, out.bow2v[cnt] ) )
+
+        out.cnt += 1
+
+
 
 class batch_constructor_v2:
     def __init__( self, parser, 
                   numericizer1, numericizer2,
                   gazetteer = None, window = 7, 
                   n_label_type = 4, language = 'eng',
-                  is_2nd_pass = False ):
+                  is_2nd_pass = False, feature_choice = None ):
+        """
+        If 'feature_choice' is given, mini_batch can only be asked for these 
+        features and the rest are not prepared; see batch_constructor. 
+        """
         assert language in { 'eng', 'cmn', 'spa' }
         self.language = language
+        self.feature_choice = feature_choice
 
         self.pad1 = numericizer1.padding_index()
         self.pad2 = numericizer2.padding_index()
@@ -1947,10 +4290,21 @@ class batch_constructor_v2:
         # sequence at word level
         self.sentence2 = []
 
-        self.example = []
-        self.positive = []
-        self.overlap = []
-        self.disjoint = []
+        # candidate spans are stored column by column, the ith of them is 
+        # sentence[example_begin[i]:example_end[i]] of the example_sentence_id[i]th 
+        # sentence, labeled example_label[i], and bit k of example_gazetteer[i] is 
+        # set if it is a name of the kth type in the gazetteer
+        self.example_sentence_id = None
+        self.example_begin = None
+        self.example_end = None
+        self.example_label = None
+        self.example_gazetteer = None
+        self.positive = None
+        self.overlap = None
+        self.disjoint = None
+
+        # batch assemblers by feature_choice, built on first use
+        self.assemblers = {}
 
         self.is2ndPass = is_2nd_pass
 
@@ -1959,11 +4313,26 @@ class batch_constructor_v2:
         self.numericizer1 = numericizer1    # case-insensitive / char-level
         self.numericizer2 = numericizer2    # case-sensitive / word-level
 
+        if feature_choice is not None and feature_choice & 256 == 0:
+            gazetteer = None
+        if gazetteer is not None and not isinstance( gazetteer, (gazetteer_index, compiled_gazetteer) ):
+            gazetteer = gazetteer_index( gazetteer, language )
+        assert gazetteer is None or gazetteer.language == language
+        assert gazetteer is None or len(gazetteer) <= 16, 'at most 16 types in a gazetteer'
         self.gazetteer = gazetteer
         self.n_label_type = n_label_type
-
-        cdef int i, j, k
-        cdef bint unsure
+        self.window = window
+
+        cdef int t, sentence_id
+        cdef bint has_gazetteer = gazetteer is not None
+        # whether the case-insensitive and the case-sensitive word-level features are wanted
+        context1 = feature_choice is None or feature_choice & (1 | 2 | 4) > 0
+        context2 = feature_choice is None or feature_choice & (8 | 16 | 32) > 0
+        cdef int[:,:] gazetteer_view
+        cdef vector[int] span_begin, span_end, span_label, span_kind
+        cdef vector[int] positive, overlap, disjoint
+        cdef vector[int] example_sentence_id, example_begin, example_end, example_label
+        cdef vector[unsigned short] example_gazetteer
 
         for sentence, ner_begin, ner_end, ner_label in parser:
             ner_begin = numpy.asarray(ner_begin, dtype = numpy.int32)
@@ -1973,75 +4342,58 @@ class batch_constructor_v2:
             
             label1st_powerset.append( (ner_begin, ner_end, ner_label) )
 
+            if has_gazetteer:
+                gazetteer_view = self.gazetteer.match( sentence, window )
+
             for label1st in label1st_powerset:
-                for i in range( len(sentence) ):
-                    for j in range( i + 1, len(sentence) + 1 ):
-                        unsure, found = False, False
-                        if j - i > window:
-                            break
-                        label = n_label_type
-                        # look for exact match
-                        for k in range(len(ner_label)):
-                            if i == ner_begin[k] and j == ner_end[k]:
-                                label = ner_label[k]
-                                if label < n_label_type:
-                                    self.positive.append( len(self.example) )
-                                else:
-                                    unsure = True
-                                found = True
-                                break
-                        # look for overlap
-                        if not found:
-                            for k in range(len(ner_label)):
-                                if i < ner_end[k] and ner_begin[k] < j:
-                                    label = n_label_type + 1
-                                    self.overlap.append( len(self.example) )
-                                    break
-                        if unsure:
-                            continue
-                        if label == n_label_type:
-                            self.disjoint.append( len(self.example) )
-                        if label == n_label_type + 1:
-                            label = n_label_type
-
-                        gazetteer_match = []
-                        if self.gazetteer is not None:
-                            if language != 'cmn':
-                                name = u' '.join(sentence[i:j])
-                            else:
-                                name = u''.join( w[:w.find(u'|iNCML|')] for w in sentence[i:j] )
-                            for k, g in enumerate(self.gazetteer):
-                                if name in g:
-                                    gazetteer_match.append(k)
-
-                        self.example.append( 
-                            example( 
-                                len(self.sentence1), i, j, label ,
-                                numpy.asarray(
-                                    gazetteer_match,
-                                    dtype = numpy.int32
-                                )
-                            ) 
-                        )
+                span_begin.clear()
+                span_end.clear()
+                span_label.clear()
+                span_kind.clear()
+                enumerate_span( len(sentence), window, n_label_type,
+                                ner_begin, ner_end, ner_label,
+                                span_begin, span_end, span_label, span_kind )
+
+                sentence_id = len(self.sentence1)
+                with nogil:
+                    for t in range( span_kind.size() ):
+                        if span_kind[t] == POSITIVE_SPAN:
+                            positive.push_back( example_label.size() )
+                        elif span_kind[t] == OVERLAP_SPAN:
+                            overlap.push_back( example_label.size() )
+                        else:
+                            disjoint.push_back( example_label.size() )
+                        example_sentence_id.push_back( sentence_id )
+                        example_begin.push_back( span_begin[t] )
+                        example_end.push_back( span_end[t] )
+                        example_label.push_back( span_label[t] )
+                        if has_gazetteer:
+                            example_gazetteer.push_back( 
+                                gazetteer_view[span_begin[t], span_end[t] - span_begin[t] - 1] )
+                        else:
+                            example_gazetteer.push_back( 0 )
                 
                 if not self.is2ndPass:
                     label1st = None
 
                 if language != 'cmn': 
+                    tokens = token_arena( sentence )
                     self.sentence1.append( 
                         processed_sentence_v2( 
-                            sentence, 
+                            tokens, 
                             numericizer1, 
                             language = language,
-                            label1st = label1st
+                            label1st = label1st,
+                            context = context1
                         )
                     )
                     self.sentence2.append( 
                         processed_sentence_v2( 
-                            sentence, 
+                            tokens, 
                             numericizer2, 
                             language = language,
-                            label1st = label1st
+                            label1st = label1st,
+                            context = context2
                         ) 
                     )
                 else:
@@ -2055,7 +4407,8 @@ class batch_constructor_v2:
                             char_sequence, 
                             numericizer1,
                             language = language,
-                            label1st = label1st 
+                            label1st = label1st,
+                            context = context1
                         ) 
                     )
                     self.sentence2.append( 
@@ -2063,13 +4416,32 @@ class batch_constructor_v2:
                             word_sequence, 
                             numericizer2,
                             language = language,
-                            label1st = label1st
+                            label1st = label1st,
+                            context = context2
                         ) 
                     )
 
-        self.positive = numpy.asarray( self.positive, dtype = numpy.int32 )
-        self.overlap = numpy.asarray( self.overlap, dtype = numpy.int32 )
-        self.disjoint = numpy.asarray( self.disjoint, dtype = numpy.int32 )
+        self.example_sentence_id = int32_array( example_sentence_id )
+        self.example_begin = int32_array( example_begin )
+        self.example_end = int32_array( example_end )
+        self.example_label = int32_array( example_label )
+        self.example_gazetteer = uint16_array( example_gazetteer )
+        self.positive = int32_array( positive )
+        self.overlap = int32_array( overlap )
+        self.disjoint = int32_array( disjoint )
+
+
+    def assembler( self, int feature_choice ):
+        """
+        Returns
+        -------
+            The batch_assembler_v2 of 'feature_choice'; see batch_constructor.assembler. 
+        """
+        assert self.feature_choice is None or feature_choice & ~self.feature_choice == 0, \
+                'feature_choice %d is asked for, but only %d is prepared' % (feature_choice, self.feature_choice)
+        if feature_choice not in self.assemblers:
+            self.assemblers[feature_choice] = batch_assembler_v2( self, feature_choice )
+        return self.assemblers[feature_choice]
 
 
     @cython.boundscheck(False)
@@ -2077,250 +4449,80 @@ class batch_constructor_v2:
                     bint shuffle_needed = True, float overlap_rate = 0.36, 
                     float disjoint_rate = 0.08, int feature_choice = 255, 
                     bint replace = False, int n_copy = 1,
-                    int context_limit = 64 ):
-
-        cdef int pad1 = self.pad1
-        cdef int pad2 = self.pad2
-
-        lw1, rw1, lw2, rw2, lw3, rw3, lw4, rw4, \
-        bow1, bow2, linit, rinit = [
-            numpy.ones(
-                (n_batch_size, context_limit),
-                numpy.int32
-            ) * (-1) for _ in xrange(12)
-        ]
-        lc, rc = [
-            numpy.ones( 
-                (n_batch_size, context_limit * 2),
-                numpy.int32
-            ) * 127 for _ in xrange(2)
-        ]
-
-        label = numpy.ndarray(  
-            (n_batch_size,),
-            numpy.int32
-        )
+                    int context_limit = 64, pool = None, candidate = None, 
+                    int bucket_width = 0 ):
+        """
+        If 'pool', a batch_pool, is given, mini-batches are pooled_dict's written 
+        to its buffers, which must be released after use, instead of copies. 
+        If 'candidate' is given, examples are taken in this order instead of being 
+        sampled, e.g. a slice of what sample_candidate returns. 
+        If 'bucket_width' is positive, sampled examples are grouped by context 
+        length with bucket_candidate, so that mini-batches carry less padding. 
+        """
 
-        cdef int[:,:] lw1v = lw1
-        cdef int[:,:] rw1v = rw1
-        cdef int[:,:] lw2v = lw2
-        cdef int[:,:] rw2v = rw2
-        cdef int[:,:] lw3v = lw3
-        cdef int[:,:] rw3v = rw3
-        cdef int[:,:] lw4v = lw4
-        cdef int[:,:] rw4v = rw4
-        cdef int[:,:] bow1v = bow1
-        cdef int[:,:] bow2v = bow2
-        cdef int[:,:] linitv = linit
-        cdef int[:,:] rinitv = rinit
-        cdef int[:,:] lcv = lc
-        cdef int[:,:] rcv = rc
-        cdef int[:] label_view = label
-        lcv[:,:] = 127
-        rcv[:,:] = 127
-        linitv[:,:] = 127
-        rinitv[:,:] = 127
-        lw1v[:,:] = pad1
-        rw1v[:,:] = pad1
-        lw2v[:,:] = pad1
-        rw2v[:,:] = pad1
-        bow1v[:,:] = pad1
-        lw3v[:,:] = pad2
-        rw3v[:,:] = pad2
-        lw4v[:,:] = pad1
-        rw4v[:,:] = pad2
-        bow2v[:,:] = pad2
-
-        cdef int lw1len = 1
-        cdef int rw1len = 1
-        cdef int lw2len = 1
-        cdef int rw2len = 1
-        cdef int lw3len = 1
-        cdef int rw3len = 1
-        cdef int lw4len = 1
-        cdef int rw4len = 1
-        cdef int bowlen = 1
-        cdef int clen = 10
-
-        cdef example next_example
-        cdef processed_sentence_v2 sentence
-        cdef int i, j, k, begin_idx, end_idx
-        cdef int cnt = 0
-        cdef int n
-        cdef string phrase
-        cdef int phrase_cpy_len
-        cdef int phrase_length
-        cdef int [:] phrase_view
-        cdef int [:] initial_view
-
-
-        gaz_buff = numpy.zeros(
-            (n_batch_size, 1 + self.n_label_type),
-            dtype = numpy.float32
-        )
-        cdef float[:,:] gaz_view = gaz_buff
+        cdef int n, begin
+        cdef batch_assembler_v2 assembler = self.assembler( feature_choice )
+        cdef batch_matrices out = batch_matrices()
 
         has_char_feature = feature_choice & (64 | 128 | 512 | 1024)
         assert not has_char_feature or self.language != 'cmn', \
                 'Chinese is modeled at character level. '
 
-        if n_copy > 1:
-            shuffle_needed = True
-            replace = True
-
-        if len( self.disjoint ) > 0: 
-            disjoint = numpy.random.choice( 
-                self.disjoint,
-                size = numpy.int32( len(self.disjoint) * disjoint_rate * n_copy ),
-                replace = replace 
-            )
-        else:
-            disjoint = numpy.asarray([]).astype( numpy.int32 )
-
-        if len( self.overlap ) > 0:
-            overlap = numpy.random.choice( 
-                self.overlap,
-                size = numpy.int32( len(self.overlap) * overlap_rate * n_copy ),
-                replace = replace 
-            )
-        else:
-            overlap = numpy.asarray([]).astype( numpy.int32 )
-
-        candidate = numpy.concatenate( [ self.positive ] * n_copy + [ disjoint, overlap ] )
-
-        if shuffle_needed:
-            numpy.random.shuffle( candidate )
-        else:
-            candidate.sort()
+        if candidate is None:
+            candidate = sample_candidate( self, shuffle_needed, overlap_rate, 
+                                          disjoint_rate, replace, n_copy )
+            if bucket_width > 0:
+                candidate = bucket_candidate( self, candidate, n_batch_size, bucket_width, 
+                                              context_limit, shuffle_needed )
+        candidate = numpy.ascontiguousarray( candidate, dtype = numpy.int32 )
         n = len(candidate)
 
+        for begin in range( 0, n, n_batch_size ):
+            # output buffers are allocated once, or taken from the pool for each mini-batch
+            if begin == 0 or pool is not None:
+                owner = pool.acquire() if pool is not None else {}
+                out.bind( self.output_buffer( owner, n_batch_size, context_limit ) )
 
-        for i in range( n ):
-            next_example = self.example[ candidate[i] ]
-            begin_idx = next_example.begin_idx
-            end_idx = next_example.end_idx
-
-            sentence = self.sentence1[next_example.sentence_id]
-
-            if self.language != 'cmn':
-                phrase = ' '.join( sentence.sentence[begin_idx:end_idx] )
-                phrase_array = numpy.asarray(
-                    [ ord(c) for c in list(phrase) ],
-                    dtype = numpy.int32
-                ) 
-                phrase_view = phrase_array
-
-                init_array = numpy.asarray(
-                    [ ord(c) % 128 for c in list( 
-                        ''.join( [ w[0] for w in sentence.sentence[begin_idx:end_idx] ] ) 
-                    ) ],
-                    dtype = numpy.int32
-                )
-                initial_view = init_array
-
-            if feature_choice & 256 > 0:
-                gaz_buff[cnt][next_example.gazetteer] = 1
-
-            if feature_choice & 128 > 0:
-                phrase_length = end_idx - begin_idx
-                with nogil:
-                    for j in range( phrase_length ):
-                        linitv[cnt][j] = initial_view[j]
-                        rinitv[cnt][j] = initial_view[phrase_length - j - 1]
+            assembler.run( candidate, begin, min( begin + n_batch_size, n ), out )
+            # views of the pooled buffer are handed out as they are
+            batch = out.batch( pool is None )
+            if pool is not None:
+                batch = pooled_dict( batch )
+                batch.buffer = owner
+            yield batch
 
-            with nogil:
-                label_view[cnt] = next_example.label
 
-                if feature_choice & (512 | 64) > 0:
-                    phrase_cpy_len = context_limit * 2 - 2
-                    if phrase_view.shape[0] < phrase_cpy_len:
-                        phrase_cpy_len = phrase_view.shape[0]
-                    lcv[cnt][1: 1 + phrase_cpy_len] = phrase_view[:phrase_cpy_len]
-                    if phrase_cpy_len + 2 > clen:
-                        clen = phrase_cpy_len + 2
+    def output_buffer( self, buffer, int n_batch_size, int context_limit ):
+        """
+        Returns
+        -------
+            The 16 arrays mini_batch writes to, backed by 'buffer', a dict. 
+        """
+        shape = (n_batch_size, context_limit)
+        return [ reserve( buffer, k, shape, numpy.int32 ) for k in xrange(12) ] + \
+               [ reserve( buffer, k, (n_batch_size, context_limit * 2), numpy.int32 ) for k in (12, 13) ] + \
+               [ reserve( buffer, 14, (n_batch_size,), numpy.int32 ),
+                 reserve( buffer, 15, (n_batch_size, 1 + self.n_label_type), numpy.float32 ) ]
 
-                if feature_choice & 64 > 0:
-                    rcv[cnt][1: 1 + phrase_cpy_len] = phrase_view[::-1][:phrase_cpy_len]
-
-            if feature_choice & 1 > 0:
-                lw1len = max( lw1len, sentence.insert_left( end_idx - 1, lw1[cnt] ) )
-                rw1len = max( rw1len, sentence.insert_right( begin_idx, rw1[cnt] ) )
-
-            if feature_choice & 2 > 0:
-                lw2len = max( lw2len, sentence.insert_left( begin_idx - 1, lw2[cnt] ) )
-                rw2len = max( rw2len, sentence.insert_right( end_idx, rw2[cnt] ) )
-
-            if feature_choice & 4 > 0:
-                bowlen = max( bowlen, sentence.insert_bow( begin_idx, end_idx, bow1[cnt] ) )
-
-            sentence = self.sentence2[next_example.sentence_id]
-
-            if feature_choice & 8 > 0:
-                lw3len = max( lw3len, sentence.insert_left( end_idx - 1, lw3[cnt] ) )
-                rw3len = max( rw3len, sentence.insert_right( begin_idx, rw3[cnt] ) )
-
-            if feature_choice & 16 > 0:
-                lw4len = max( lw4len, sentence.insert_left( begin_idx - 1, lw4[cnt] ) )
-                rw4len = max( rw4len, sentence.insert_right( end_idx, rw4[cnt] ) )
-
-            if feature_choice & 32 > 0:
-                bowlen = max( bowlen, sentence.insert_bow( begin_idx, end_idx, bow2[cnt] ) )
-
-            cnt += 1 
-            if cnt % n_batch_size == 0 or (i + 1) == len(candidate):
-                yield {
-                    'word' : {
-                        'case-insensitive' : {
-                            'left-incl' : lw1[:cnt,:lw1len].copy(),
-                            'right-incl' : rw1[:cnt,:rw1len].copy(),
-                            'left-excl' : lw2[:cnt,:lw2len].copy(),
-                            'right-excl' : rw2[:cnt,:rw2len].copy(),
-                            'bow' : bow1[:cnt,:bowlen].copy()
-                        },
-                        'case-sensitive' : {
-                            'left-incl' : lw3[:cnt,:lw3len].copy(),
-                            'right-incl' : rw3[:cnt,:rw3len].copy(),
-                            'left-excl' : lw4[:cnt,:lw4len].copy(),
-                            'right-excl' : rw4[:cnt,:rw4len].copy(),
-                            'bow' : bow2[:cnt,:bowlen].copy()
-                        }
-                    },
-                    'char' : {
-                        'left' : lc[:cnt,:clen].copy(),
-                        'right' : rc[:cnt,:clen].copy(),
-                        'left-initial' : linit[:cnt,:bowlen].copy(),
-                        'right-initial' : rinit[:cnt,:bowlen].copy()
-                    },
-                    'gaz' : gaz_buff[:cnt,:].copy(),
-                    'target' : label[:cnt].copy()
-                }
 
-                with nogil:
-                    lw1len = 1
-                    rw1len = 1
-                    lw2len = 1
-                    rw2len = 1
-                    lw3len = 1
-                    rw3len = 1
-                    lw4len = 1
-                    rw4len = 1
-                    bowlen = 1
-                    clen = 10
-                    cnt = 0
-                    lw1v[:,:] = pad1
-                    rw1v[:,:] = pad1
-                    lw2v[:,:] = pad1
-                    rw2v[:,:] = pad1
-                    bow1v[:,:] = pad1
-                    lw3v[:,:] = pad2
-                    rw3v[:,:] = pad2
-                    lw4v[:,:] = pad2
-                    rw4v[:,:] = pad2
-                    bow2v[:,:] = pad2
-                    lcv[:,:] = 127
-                    rcv[:,:] = 127
-                    linitv[:,:] = 127
-                    rinitv[:,:] = 127
+    def padding_ratio( self, batch ):
+        """
+        Returns
+        -------
+            The fraction of the cells of the word and char matrices of 'batch', 
+            what mini_batch yields, that are padding. Matrices of features not 
+            chosen, which hold nothing but padding, are left out. 
+        """
+        n_pad, n_cell = 0, 0
+        matrices = [ (m, self.pad1) for m in batch['word']['case-insensitive'].itervalues() ] + \
+                   [ (m, self.pad2) for m in batch['word']['case-sensitive'].itervalues() ] + \
+                   [ (m, 127) for m in batch['char'].itervalues() ]
+        for m, pad in matrices:
+            n = numpy.count_nonzero( m == pad )
+            if n < m.size:
+                n_pad += n
+                n_cell += m.size
+        return float( n_pad ) / max( n_cell, 1 )
 
 
     def __str__( self ):
@@ -2337,7 +4539,8 @@ class batch_constructor_v2:
     def mini_batch_multi_thread( self, int n_batch_size, 
                                  bint shuffle_needed = True, float overlap_rate = 0.36, 
                                  float disjoint_rate = 0.08, int feature_choice = 255, 
-                                 bint replace = False, float timeout = -1, int n_copy = 1  ):
+                                 bint replace = False, float timeout = -1, int n_copy = 1,
+                                 pool = None, int bucket_width = 0 ):
         """
         Same as self.mini_batch except that data preparation is done on the background
         """
@@ -2347,7 +4550,9 @@ class batch_constructor_v2:
             overlap_rate, 
             disjoint_rate,
             feature_choice, 
-            replace 
+            replace,
+            pool = pool,
+            bucket_width = bucket_width
         )
 
         batch_buffer = Queue( maxsize = 256 )
@@ -2363,24 +4568,820 @@ class batch_constructor_v2:
                 break
 
 
+    def mini_batch_thread_pool( self, int n_batch_size, 
+                                bint shuffle_needed = True, float overlap_rate = 0.36, 
+                                float disjoint_rate = 0.08, int feature_choice = 255, 
+                                bint replace = False, int n_copy = 1, int context_limit = 64,
+                                int n_thread = 4, pool = None, int bucket_width = 0 ):
+        """
+        Same as self.mini_batch except that 'n_thread' threads assemble several 
+        mini-batches at the same time; see batch_constructor.mini_batch_thread_pool. 
+        """
+        cdef batch_matrices out
+        cdef batch_assembler_v2 assembler = self.assembler( feature_choice )
+
+        has_char_feature = feature_choice & (64 | 128 | 512 | 1024)
+        assert not has_char_feature or self.language != 'cmn', \
+                'Chinese is modeled at character level. '
+
+        candidate = sample_candidate( self, shuffle_needed, overlap_rate, 
+                                      disjoint_rate, replace, n_copy )
+        if bucket_width > 0:
+            candidate = bucket_candidate( self, candidate, n_batch_size, bucket_width, 
+                                          context_limit, shuffle_needed )
+        candidate = numpy.ascontiguousarray( candidate, dtype = numpy.int32 )
+        n = len(candidate)
+        scratch = []
+
+        def assemble( b ):
+            if len( scratch ) > 0:
+                result = scratch.pop()
+            else:
+                result = batch_matrices()
+                result.bind( self.output_buffer( {}, n_batch_size, context_limit ) )
+            assembler.run( candidate, b * n_batch_size, min( (b + 1) * n_batch_size, n ), result )
+            return result
+
+        for out in thread_pool_mini_batch( assemble, (n + n_batch_size - 1) // n_batch_size, n_thread ):
+            if pool is not None:
+                owner = pool.acquire()
+                batch = pooled_dict( pooled_copy( out.batch( False ), owner ) )
+                batch.buffer = owner
+            else:
+                batch = out.batch( True )
+            scratch.append( out )
+            yield batch
+
+
+    def mini_batch_multi_process( self, int n_batch_size, 
+                                  bint shuffle_needed = True, float overlap_rate = 0.36, 
+                                  float disjoint_rate = 0.08, int feature_choice = 255, 
+                                  bint replace = False, int n_copy = 1, int context_limit = 64,
+                                  int n_worker = 4, int n_slot = 2, pool = None, 
+                                  int bucket_width = 0 ):
+        """
+        Same as self.mini_batch except that data preparation is shared by 'n_worker' 
+        processes; see batch_constructor.mini_batch_multi_process. 
+        """
+        candidate = sample_candidate( self, shuffle_needed, overlap_rate, 
+                                      disjoint_rate, replace, n_copy )
+        if bucket_width > 0:
+            candidate = bucket_candidate( self, candidate, n_batch_size, bucket_width, 
+                                          context_limit, shuffle_needed )
+        return shared_mini_batch( self, n_batch_size, candidate, 
+                                  { 'feature_choice' : feature_choice, 
+                                    'context_limit' : context_limit },
+                                  n_worker, n_slot, pool )
+
+
     def infinite_mini_batch_multi_thread( self, int n_batch_size, 
                                           bint shuffle_needed = True, float overlap_rate = 0.36, 
                                           float disjoint_rate = 0.08, int feature_choice = 255, 
-                                          bint replace = True, float timeout = -1, int n_copy = 10  ):
+                                          bint replace = True, float timeout = -1, int n_copy = 10,
+                                          int context_limit = 64, pool = None, int n_prefetch = 16, 
+                                          int bucket_width = 0 ):
+        """
+        Same as self.mini_batch_multi_thread except that sampling is done infinitely; 
+        see batch_constructor.infinite_mini_batch_multi_thread. 
+        """
+        return stream_sampler( self, n_batch_size, 
+                               { 'shuffle_needed' : shuffle_needed, 
+                                 'overlap_rate' : overlap_rate, 
+                                 'disjoint_rate' : disjoint_rate, 
+                                 'replace' : replace, 
+                                 'n_copy' : n_copy },
+                               { 'feature_choice' : feature_choice, 
+                                 'context_limit' : context_limit },
+                               n_prefetch, pool, timeout if timeout > 0 else None, bucket_width )
+
+
+
+################################################################################
+
+
+class batch_constructor_stream( object ):
+    """
+    Mini-batches of a corpus too large to be held in memory, e.g. a chunk of 
+    machine-labeled data for distant supervision. The parser is consumed 
+    'n_sentence' sentences at a time and each window is made a batch 
+    constructor of its own, whose examples are sampled and shuffled within the 
+    window. Examples that do not fill the last mini-batch of a window are 
+    carried over to the next one together with their sentences, so memory is 
+    bounded by the window regardless of the corpus size, and only the very last 
+    mini-batch may be smaller. The parser is consumed once, so is this object. 
+    """
+    def __init__( self, parser, numericizer1, numericizer2, 
+                  n_sentence = 4096, constructor = batch_constructor, **kwargs ):
+        """
+        Parameters
+        ----------
+            parser : iterable
+                Likes of CoNLL2003, distant_supervision_parser
+
+            n_sentence : int
+                number of sentences read at a time
+
+            constructor : class
+                batch_constructor or batch_constructor_v2, which each window is made
+
+            kwargs :
+                other arguments of 'constructor', e.g. gazetteer, window, alpha
+        """
+        self.parser = iter( parser )
+        self.numericizer1 = numericizer1
+        self.numericizer2 = numericizer2
+        self.n_sentence = n_sentence
+        self.constructor = constructor
+        self.kwargs = kwargs
+        self.n_window = 0
+        self.n_sentence_read = 0
+        self.n_example = 0
+
+
+    def __str__( self ):
+        return '%d sentences in %d windows, %d examples so far' % \
+               (self.n_sentence_read, self.n_window, self.n_example)
+
+
+    def mini_batch( self, int n_batch_size, 
+                    bint shuffle_needed = True, float overlap_rate = 0.36, 
+                    float disjoint_rate = 0.08, int feature_choice = 255, 
+                    bint replace = False, pool = None, **kwargs ):
+        """
+        Same as constructor.mini_batch, window by window. 'kwargs' are passed 
+        to it, e.g. context_limit of batch_constructor_v2. 
+        """
+        carry, carry_offset = [], []
+
+        while True:
+            window = list( islice( self.parser, self.n_sentence ) )
+            if len( window ) == 0 and len( carry ) == 0:
+                break
+            self.n_window += len( window ) > 0
+            self.n_sentence_read += len( window )
+
+            sentences = carry + window
+            data = self.constructor( sentences, self.numericizer1, self.numericizer2, **self.kwargs )
+
+            # examples are enumerated sentence by sentence, so those left over 
+            # are found at the same offsets from the first one of their sentence
+            first = numpy.searchsorted( data.example_sentence_id, numpy.arange( len(sentences) ) )
+            carried = [ first[k] + offset for k, offset in enumerate( carry_offset ) ]
+
+            # only the examples of new sentences are sampled
+            for name in [ 'positive', 'overlap', 'disjoint' ]:
+                example = getattr( data, name )
+                setattr( data, name, example[data.example_sentence_id[example] >= len(carry)] )
+            candidate = numpy.concatenate( carried + 
+                                           [ sample_candidate( data, shuffle_needed, overlap_rate, 
+                                                               disjoint_rate, replace ) ] )
+            candidate = candidate.astype( numpy.int32 )
+            if shuffle_needed:
+                numpy.random.shuffle( candidate )
+
+            # the rest is flushed when there is nothing more to read
+            n_full = len(candidate) // n_batch_size * n_batch_size if len( window ) > 0 else len(candidate)
+            if n_full > 0:
+                for batch in data.mini_batch( n_batch_size, candidate = candidate[:n_full], 
+                                              feature_choice = feature_choice, pool = pool, **kwargs ):
+                    yield batch
+            self.n_example += n_full
+
+            leftover = candidate[n_full:]
+            sentence_id = data.example_sentence_id[leftover]
+            carry, carry_offset = [], []
+            for k in numpy.unique( sentence_id ):
+                carry.append( sentences[k] )
+                carry_offset.append( numpy.sort( leftover[sentence_id == k] ) - first[k] )
+
+
+    def mini_batch_multi_thread( self, int n_batch_size, 
+                                 bint shuffle_needed = True, float overlap_rate = 0.36, 
+                                 float disjoint_rate = 0.08, int feature_choice = 255, 
+                                 bint replace = False, float timeout = -1, pool = None, **kwargs ):
         """
-        Same as self.mini_batch_multi_thread except that sampling is done infinitely.
+        Same as self.mini_batch except that data preparation, including reading and 
+        constructing the next window, is done on the background
         """
+        batch_generator = self.mini_batch( n_batch_size, shuffle_needed, 
+                                           overlap_rate, disjoint_rate,
+                                           feature_choice, replace, pool, **kwargs )
+        batch_buffer = Queue( maxsize = 256 )
+        t = Thread( target = prepare_mini_batch, 
+                    args = ( batch_generator, batch_buffer, timeout if timeout > 0 else None ) )
+        t.daemon = True
+        t.start()
         while True:
-            for next_batch in self.mini_batch_multi_thread( 
-                n_batch_size, shuffle_needed, 
-                overlap_rate, disjoint_rate,
-                feature_choice, 
-                replace, 
-                timeout, 
-                n_copy 
-            ):
-                if next_batch[-1].shape[0] == n_batch_size:
-                    yield next_batch
+            next_batch = batch_buffer.get( True, timeout if timeout > 0 else None )
+            if next_batch is not None:
+                yield next_batch
+            else:
+                break
+
+
+
+################################################################################
+# constructed datasets on disk, see cached_dataset
+
+
+# bumped whenever what save_dataset writes changes, so that old caches are not used
+dataset_format = 1
+
+
+def dataset_key( files, **settings ):
+    """
+    Returns
+    -------
+        A hex digest of the content of 'files', a list of files or directories, 
+        e.g. the corpus, the wordlists and the gazetteer, and of 'settings', 
+        e.g. window and alpha. It names a constructed dataset in cached_dataset. 
+    """
+    digest = hashlib.md5()
+    digest.update( 'format %d\n' % dataset_format )
+    for name in files:
+        if os.path.isdir( name ):
+            paths = sorted( os.path.join( root, f ) for root, _, names in os.walk( name ) for f in names )
+        else:
+            paths = [ name ]
+        for path in paths:
+            digest.update( 'file %s\n' % os.path.relpath( path, name ) )
+            with open( path, 'rb' ) as fp:
+                block = fp.read( 1 << 20 )
+                while len( block ) > 0:
+                    digest.update( block )
+                    block = fp.read( 1 << 20 )
+    for k in sorted( settings ):
+        digest.update( '%s %r\n' % (k, settings[k]) )
+    return digest.hexdigest()
+
+
+cdef numpy.ndarray int64_array( vector[long long]& v ):
+    result = numpy.empty( (v.size(),), dtype = numpy.int64 )
+    cdef numpy.int64_t[:] view = result
+    cdef int i
+    for i in range( v.size() ):
+        view[i] = v[i]
+    return result
+
+
+cdef numpy.ndarray float32_array( vector[float]& v ):
+    result = numpy.empty( (v.size(),), dtype = numpy.float32 )
+    cdef float[:] view = result
+    cdef int i
+    for i in range( v.size() ):
+        view[i] = v[i]
+    return result
+
+
+cdef class sentence_columns:
+    """
+    The processed_sentence's or processed_sentence_v2's of one side of a batch 
+    constructor, laid out column by column. Rows of variable length, i.e. the 
+    tokens of a sentence or the context of a position, are stored back to back, 
+    the ith of them being values[ptr[i]:ptr[i + 1]]. Positions of sentence k 
+    are rows row_ptr[k]:row_ptr[k + 1] of the context, or numeric_ptr[k]:
+    numeric_ptr[k + 1] of the chains if its fofe is lazy. 
+    """
+    cdef bint has_tokens                # False if the tokens are those of the other side
+    cdef string joined
+    cdef vector[long long] joined_ptr
+    cdef vector[int] offset
+    cdef vector[long long] offset_ptr
+    cdef vector[int] numeric
+    cdef vector[long long] numeric_ptr
+    cdef vector[long long] row_ptr
+    cdef vector[int] left_idx
+    cdef vector[float] left_data
+    cdef vector[long long] left_ptr
+    cdef vector[int] right_idx
+    cdef vector[float] right_data
+    cdef vector[long long] right_ptr
+    cdef vector[fofe_node] left_chain
+    cdef vector[fofe_node] right_chain
+    cdef vector[int] window
+
+    def __init__( self, bint has_tokens = True ):
+        self.has_tokens = has_tokens
+        self.joined_ptr.push_back( 0 )
+        self.offset_ptr.push_back( 0 )
+        self.numeric_ptr.push_back( 0 )
+        self.row_ptr.push_back( 0 )
+        self.left_ptr.push_back( 0 )
+        self.right_ptr.push_back( 0 )
+
+
+    cdef void append_common( self, token_arena tokens, vector[int]& numeric ):
+        if self.has_tokens:
+            self.joined.append( tokens.joined )
+            self.joined_ptr.push_back( self.joined.size() )
+            self.offset.insert( self.offset.end(), tokens.offset.begin(), tokens.offset.end() )
+            self.offset_ptr.push_back( self.offset.size() )
+        self.numeric.insert( self.numeric.end(), numeric.begin(), numeric.end() )
+        self.numeric_ptr.push_back( self.numeric.size() )
+
+
+    cdef void append_rows( self, vector[vector[int]]& left, vector[vector[int]]& right ):
+        cdef int i
+        for i in range( left.size() ):
+            self.left_idx.insert( self.left_idx.end(), left[i].begin(), left[i].end() )
+            self.left_ptr.push_back( self.left_idx.size() )
+            self.right_idx.insert( self.right_idx.end(), right[i].begin(), right[i].end() )
+            self.right_ptr.push_back( self.right_idx.size() )
+        self.row_ptr.push_back( self.left_ptr.size() - 1 )
+
+
+    cdef void append( self, processed_sentence sentence ):
+        cdef int i
+        self.append_common( sentence.tokens, sentence.numeric )
+        self.window.push_back( sentence.window )
+        if sentence.lazy:
+            self.left_chain.insert( self.left_chain.end(), 
+                                    sentence.left_chain.begin(), sentence.left_chain.end() )
+            self.right_chain.insert( self.right_chain.end(), 
+                                     sentence.right_chain.begin(), sentence.right_chain.end() )
+            self.row_ptr.push_back( self.row_ptr.back() )
+        else:
+            self.append_rows( sentence.left_context_idx, sentence.right_context_idx )
+            for i in range( sentence.left_context_data.size() ):
+                self.left_data.insert( self.left_data.end(), 
+                                       sentence.left_context_data[i].begin(), 
+                                       sentence.left_context_data[i].end() )
+                self.right_data.insert( self.right_data.end(), 
+                                        sentence.right_context_data[i].begin(), 
+                                        sentence.right_context_data[i].end() )
+
+
+    cdef void append_v2( self, processed_sentence_v2 sentence ):
+        self.append_common( sentence.tokens, sentence.numeric )
+        self.append_rows( sentence.left2nd, sentence.right2nd )
+
+
+    def arrays( self ):
+        """
+        Returns
+        -------
+            A dict of column name to numpy array. 
+        """
+        cdef int i
+        result = { 'numeric' : int32_array( self.numeric ),
+                   'numeric_ptr' : int64_array( self.numeric_ptr ),
+                   'row_ptr' : int64_array( self.row_ptr ),
+                   'left_idx' : int32_array( self.left_idx ),
+                   'left_ptr' : int64_array( self.left_ptr ),
+                   'right_idx' : int32_array( self.right_idx ),
+                   'right_ptr' : int64_array( self.right_ptr ),
+                   'left_data' : float32_array( self.left_data ),
+                   'right_data' : float32_array( self.right_data ),
+                   'window' : int32_array( self.window ) }
+        if self.has_tokens:
+            result['joined'] = numpy.frombuffer( self.joined, dtype = numpy.uint8 ).copy()
+            result['joined_ptr'] = int64_array( self.joined_ptr )
+            result['offset'] = int32_array( self.offset )
+            result['offset_ptr'] = int64_array( self.offset_ptr )
+        result.update( chain_arrays( self.left_chain, 'left_chain_' ) )
+        result.update( chain_arrays( self.right_chain, 'right_chain_' ) )
+        return result
+
+
+cdef dict chain_arrays( vector[fofe_node]& chain, prefix ):
+    """ the fields of the nodes of 'chain', one column each """
+    cdef int i
+    cdef int n = chain.size()
+    result = {}
+    for k in [ 'token', 'next', 'depth', 'last' ]:
+        result[prefix + k] = numpy.empty( (n,), dtype = numpy.int32 )
+    result[prefix + 'value'] = numpy.empty( (n,), dtype = numpy.float32 )
+    cdef int[:] token = result[prefix + 'token']
+    cdef int[:] following = result[prefix + 'next']
+    cdef int[:] depth = result[prefix + 'depth']
+    cdef int[:] last = result[prefix + 'last']
+    cdef float[:] value = result[prefix + 'value']
+    for i in range( n ):
+        token[i] = chain[i].token
+        following[i] = chain[i].next
+        depth[i] = chain[i].depth
+        last[i] = chain[i].last
+        value[i] = chain[i].value
+    return result
+
+
+@cython.boundscheck(False)
+cdef void copy_int( vector[int]& v, int[::1] values, long long begin, long long end ):
+    cdef long long i
+    v.clear()
+    v.reserve( end - begin )
+    for i in range( begin, end ):
+        v.push_back( values[i] )
+
+
+@cython.boundscheck(False)
+cdef void copy_float( vector[float]& v, float[::1] values, long long begin, long long end ):
+    cdef long long i
+    v.clear()
+    v.reserve( end - begin )
+    for i in range( begin, end ):
+        v.push_back( values[i] )
+
+
+@cython.boundscheck(False)
+cdef void copy_chain( vector[fofe_node]& chain, int[::1] token, int[::1] following, 
+                      int[::1] depth, int[::1] last, float[::1] value, 
+                      long long begin, long long end ):
+    """ inverse of chain_arrays """
+    cdef long long i
+    chain.resize( end - begin )
+    for i in range( begin, end ):
+        chain[i - begin].token = token[i]
+        chain[i - begin].next = following[i]
+        chain[i - begin].depth = depth[i]
+        chain[i - begin].last = last[i]
+        chain[i - begin].value = value[i]
+
+
+cdef class sentence_loader:
+    """
+    Rebuilds the sentences of one side of a batch constructor from the columns 
+    sentence_columns wrote, which are memory-mapped. 
+    """
+    cdef unsigned char[::1] joined
+    cdef numpy.int64_t[::1] joined_ptr
+    cdef int[::1] offset
+    cdef numpy.int64_t[::1] offset_ptr
+    cdef int[::1] numeric
+    cdef numpy.int64_t[::1] numeric_ptr
+    cdef numpy.int64_t[::1] row_ptr
+    cdef int[::1] left_idx
+    cdef float[::1] left_data
+    cdef numpy.int64_t[::1] left_ptr
+    cdef int[::1] right_idx
+    cdef float[::1] right_data
+    cdef numpy.int64_t[::1] right_ptr
+    cdef int[::1] window
+    cdef int[::1] left_chain_token
+    cdef int[::1] left_chain_next
+    cdef int[::1] left_chain_depth
+    cdef int[::1] left_chain_last
+    cdef float[::1] left_chain_value
+    cdef int[::1] right_chain_token
+    cdef int[::1] right_chain_next
+    cdef int[::1] right_chain_depth
+    cdef int[::1] right_chain_last
+    cdef float[::1] right_chain_value
+
+    def __init__( self, column, bint has_tokens = True ):
+        """
+        Parameters
+        ----------
+            column : callable
+                column( name ) is the array named 'name' of this side
+        """
+        if has_tokens:
+            self.joined = column( 'joined' )
+            self.joined_ptr = column( 'joined_ptr' )
+            self.offset = column( 'offset' )
+            self.offset_ptr = column( 'offset_ptr' )
+        self.numeric = column( 'numeric' )
+        self.numeric_ptr = column( 'numeric_ptr' )
+        self.row_ptr = column( 'row_ptr' )
+        self.left_idx = column( 'left_idx' )
+        self.left_data = column( 'left_data' )
+        self.left_ptr = column( 'left_ptr' )
+        self.right_idx = column( 'right_idx' )
+        self.right_data = column( 'right_data' )
+        self.right_ptr = column( 'right_ptr' )
+        self.window = column( 'window' )
+        self.left_chain_token = column( 'left_chain_token' )
+        self.left_chain_next = column( 'left_chain_next' )
+        self.left_chain_depth = column( 'left_chain_depth' )
+        self.left_chain_last = column( 'left_chain_last' )
+        self.left_chain_value = column( 'left_chain_value' )
+        self.right_chain_token = column( 'right_chain_token' )
+        self.right_chain_next = column( 'right_chain_next' )
+        self.right_chain_depth = column( 'right_chain_depth' )
+        self.right_chain_last = column( 'right_chain_last' )
+        self.right_chain_value = column( 'right_chain_value' )
+
+
+    cdef token_arena tokens( self, int k ):
+        cdef token_arena result = token_arena.__new__( token_arena )
+        cdef long long begin = self.joined_ptr[k]
+        cdef long long end = self.joined_ptr[k + 1]
+        if end > begin:
+            result.joined.assign( <char*>&self.joined[begin], end - begin )
+        copy_int( result.offset, self.offset, self.offset_ptr[k], self.offset_ptr[k + 1] )
+        return result
+
+
+    cdef processed_sentence sentence( self, int k, token_arena tokens, float alpha, bint lazy ):
+        cdef processed_sentence result = processed_sentence.__new__( processed_sentence )
+        cdef long long begin = self.numeric_ptr[k]
+        cdef long long end = self.numeric_ptr[k + 1]
+        cdef long long i
+        result.tokens = tokens
+        copy_int( result.numeric, self.numeric, begin, end )
+        result.lazy = lazy
+        result.alpha = alpha
+        result.window = self.window[k]
+        if lazy:
+            # same as _build_chain
+            result.decay.resize( end - begin + 1 )
+            result.decay[0] = 1
+            for i in range( end - begin ):
+                result.decay[i + 1] = result.decay[i] * result.alpha
+            copy_chain( result.left_chain, self.left_chain_token, self.left_chain_next, 
+                        self.left_chain_depth, self.left_chain_last, self.left_chain_value, 
+                        begin, end )
+            copy_chain( result.right_chain, self.right_chain_token, self.right_chain_next, 
+                        self.right_chain_depth, self.right_chain_last, self.right_chain_value, 
+                        begin, end )
+            return result
+
+        result.left_context_idx.resize( self.row_ptr[k + 1] - self.row_ptr[k] )
+        result.left_context_data.resize( self.row_ptr[k + 1] - self.row_ptr[k] )
+        result.right_context_idx.resize( self.row_ptr[k + 1] - self.row_ptr[k] )
+        result.right_context_data.resize( self.row_ptr[k + 1] - self.row_ptr[k] )
+        for i in range( self.row_ptr[k], self.row_ptr[k + 1] ):
+            copy_int( result.left_context_idx[i - self.row_ptr[k]], self.left_idx, 
+                      self.left_ptr[i], self.left_ptr[i + 1] )
+            copy_float( result.left_context_data[i - self.row_ptr[k]], self.left_data, 
+                        self.left_ptr[i], self.left_ptr[i + 1] )
+            copy_int( result.right_context_idx[i - self.row_ptr[k]], self.right_idx, 
+                      self.right_ptr[i], self.right_ptr[i + 1] )
+            copy_float( result.right_context_data[i - self.row_ptr[k]], self.right_data, 
+                        self.right_ptr[i], self.right_ptr[i + 1] )
+        return result
+
+
+    cdef processed_sentence_v2 sentence_v2( self, int k, token_arena tokens, bint is_2nd_pass ):
+        cdef processed_sentence_v2 result = processed_sentence_v2.__new__( processed_sentence_v2 )
+        cdef long long i
+        result.tokens = tokens
+        copy_int( result.numeric, self.numeric, self.numeric_ptr[k], self.numeric_ptr[k + 1] )
+        result.is_2nd_pass = is_2nd_pass
+        result.left2nd.resize( self.row_ptr[k + 1] - self.row_ptr[k] )
+        result.right2nd.resize( self.row_ptr[k + 1] - self.row_ptr[k] )
+        for i in range( self.row_ptr[k], self.row_ptr[k + 1] ):
+            copy_int( result.left2nd[i - self.row_ptr[k]], self.left_idx, 
+                      self.left_ptr[i], self.left_ptr[i + 1] )
+            copy_int( result.right2nd[i - self.row_ptr[k]], self.right_idx, 
+                      self.right_ptr[i], self.right_ptr[i + 1] )
+        return result
+
+
+example_columns = [ 'example_sentence_id', 'example_begin', 'example_end', 'example_label', 
+                    'example_gazetteer', 'positive', 'overlap', 'disjoint' ]
 
 
+def save_dataset( constructor, directory ):
+    """
+    Write 'constructor', a batch_constructor or batch_constructor_v2, to 
+    'directory', one .npy file per column plus meta.json. The files are written 
+    to a temporary directory, which is renamed to 'directory' when complete, so 
+    that a half-written dataset is never loaded. 
+    """
+    cdef sentence_columns side1
+    cdef sentence_columns side2
+    v2 = isinstance( constructor, batch_constructor_v2 )
+    shared = all( a.tokens is b.tokens for a, b in izip( constructor.sentence1, constructor.sentence2 ) )
+    side1, side2 = sentence_columns(), sentence_columns( not shared )
+    for a, b in izip( constructor.sentence1, constructor.sentence2 ):
+        if v2:
+            side1.append_v2( a )
+            side2.append_v2( b )
+        else:
+            side1.append( a )
+            side2.append( b )
+
+    meta = { 'format' : dataset_format, 
+             'version' : 2 if v2 else 1,
+             'n_sentence' : len(constructor.sentence1),
+             'n_word1' : len(constructor.numericizer1),
+             'n_word2' : len(constructor.numericizer2),
+             'shared_tokens' : shared,
+             'language' : constructor.language,
+             'window' : constructor.window,
+             'n_label_type' : constructor.n_label_type,
+             'is2ndPass' : constructor.is2ndPass,
+             'feature_choice' : constructor.feature_choice }
+    if not v2:
+        meta.update( { 'alpha' : constructor.alpha, 
+                       'lazy_fofe' : constructor.lazy_fofe,
+                       'fofe_epsilon' : constructor.fofe_epsilon,
+                       'fofe_max_length' : constructor.fofe_max_length } )
+
+    parent = os.path.dirname( os.path.abspath( directory ) )
+    if not os.path.isdir( parent ):
+        os.makedirs( parent )
+    staging = tempfile.mkdtemp( prefix = '.' + os.path.basename( directory ) + '-', dir = parent )
+    try:
+        for name in example_columns:
+            numpy.save( os.path.join( staging, name + '.npy' ), getattr( constructor, name ) )
+        for prefix, side in [ ('sentence1.', side1), ('sentence2.', side2) ]:
+            for name, array in side.arrays().iteritems():
+                numpy.save( os.path.join( staging, prefix + name + '.npy' ), array )
+        with open( os.path.join( staging, 'meta.json' ), 'wb' ) as fp:
+            json.dump( meta, fp, indent = 4, sort_keys = True )
+        os.rename( staging, directory )
+    except OSError:
+        # another process has saved the same dataset in the meantime
+        if not os.path.exists( os.path.join( directory, 'meta.json' ) ):
+            raise
+    finally:
+        shutil.rmtree( staging, True )
+
+
+def load_dataset( directory, numericizer1, numericizer2 ):
+    """
+    Returns
+    -------
+        The batch_constructor or batch_constructor_v2 save_dataset wrote to 
+        'directory', on top of 'numericizer1' and 'numericizer2', which must be 
+        the vocabularies it was built with. Its candidate columns are memory-mapped 
+        copy-on-write and its gazetteer is None, since it is only used to build it. 
+    """
+    cdef sentence_loader side1
+    cdef sentence_loader side2
+    cdef token_arena tokens1
+    cdef token_arena tokens2
+    cdef int k
+
+    with open( os.path.join( directory, 'meta.json' ), 'rb' ) as fp:
+        meta = json.load( fp )
+    assert meta['format'] == dataset_format, 'dataset of another format in %s' % directory
+    assert meta['n_word1'] == len(numericizer1) and meta['n_word2'] == len(numericizer2), \
+            'dataset in %s is built with other vocabularies' % directory
+
+    column = lambda name : numpy.load( os.path.join( directory, name + '.npy' ), mmap_mode = 'c' )
+    language = str( meta['language'] )
+    if meta['version'] > 1:
+        constructor = batch_constructor_v2( [], numericizer1, numericizer2, 
+                                            window = meta['window'], 
+                                            n_label_type = meta['n_label_type'], 
+                                            language = language, 
+                                            is_2nd_pass = meta['is2ndPass'],
+                                            feature_choice = meta.get( 'feature_choice' ) )
+    else:
+        constructor = batch_constructor( [], numericizer1, numericizer2, 
+                                         window = meta['window'], 
+                                         alpha = meta['alpha'],
+                                         n_label_type = meta['n_label_type'], 
+                                         language = language, 
+                                         is2ndPass = meta['is2ndPass'],
+                                         lazy_fofe = meta['lazy_fofe'],
+                                         fofe_epsilon = meta['fofe_epsilon'],
+                                         fofe_max_length = meta['fofe_max_length'],
+                                         feature_choice = meta.get( 'feature_choice' ) )
+    for name in example_columns:
+        setattr( constructor, name, column( name ) )
+
+    side1 = sentence_loader( lambda name : column( 'sentence1.' + name ) )
+    side2 = sentence_loader( lambda name : column( 'sentence2.' + name ), not meta['shared_tokens'] )
+    lazy = meta['version'] == 1 and \
+           (meta['lazy_fofe'] or meta['fofe_epsilon'] > 0 or meta['fofe_max_length'] > 0)
+    for k in range( meta['n_sentence'] ):
+        tokens1 = side1.tokens( k )
+        tokens2 = tokens1 if meta['shared_tokens'] else side2.tokens( k )
+        if meta['version'] > 1:
+            constructor.sentence1.append( side1.sentence_v2( k, tokens1, meta['is2ndPass'] ) )
+            constructor.sentence2.append( side2.sentence_v2( k, tokens2, meta['is2ndPass'] ) )
+        else:
+            constructor.sentence1.append( side1.sentence( k, tokens1, meta['alpha'], lazy ) )
+            constructor.sentence2.append( side2.sentence( k, tokens2, meta['alpha'], lazy ) )
+    return constructor
+
+
+def cached_dataset( directory, build, files, numericizer1, numericizer2, **settings ):
+    """
+    Parameters
+    ----------
+        directory : str
+            where constructed datasets are kept, nothing is cached if None
+
+        build : callable
+            build() constructs the dataset, a batch_constructor or 
+            batch_constructor_v2, from scratch
+
+        files : list of str
+            the corpus, the wordlists, the gazetteer, etc. the dataset is built from
 
+        settings : 
+            every other argument of the constructor that matters, e.g. window, 
+            alpha and is2ndPass
+
+    Returns
+    -------
+        What a previous run saved as directory/dataset_key( files, **settings ), 
+        or build(), which is saved there for later runs. 
+    """
+    if directory is None:
+        return build()
+    path = os.path.join( directory, dataset_key( files, **settings ) )
+    if os.path.exists( os.path.join( path, 'meta.json' ) ):
+        logger.info( 'loading dataset from %s' % path )
+        return load_dataset( path, numericizer1, numericizer2 )
+    constructor = build()
+    save_dataset( constructor, path )
+    logger.info( 'dataset saved to %s' % path )
+    return constructor
+
+
+def prefetch_chunk_worker( build, int k, directory ):
+    """
+    Body of the process chunk_prefetcher forks for chunk k. The traceback of a 
+    failure is left in directory + '.error' for the parent. 
+    """
+    try:
+        save_dataset( build( k ), directory )
+    except:
+        with open( directory + '.error', 'wb' ) as fp:
+            fp.write( traceback.format_exc() )
+        raise
+
+
+class chunk_prefetcher( object ):
+    """
+    The datasets of chunks 0, 1, ..., n_chunk - 1, e.g. one distant-supervision 
+    chunk per epoch, built one chunk ahead of the trainer. While chunk k is 
+    trained on, build( k + 1 ) runs in a forked process, which saves it with 
+    save_dataset; next() waits for it, memory-maps it with load_dataset and 
+    forks the process of the chunk after. How long the trainer waited is logged 
+    and accumulated in 'wait'. 
+
+    Parameters
+    ----------
+        build : callable
+            build( k ) constructs chunk k, a batch_constructor or 
+            batch_constructor_v2; it is inherited by the process, not pickled
+
+        numericizer1, numericizer2 : vocabulary
+            what build uses
+
+        directory : str
+            where the chunks are staged, a temporary directory is created in it
+    """
+    def __init__( self, build, int n_chunk, numericizer1, numericizer2, directory = None ):
+        self.build = build
+        self.n_chunk = n_chunk
+        self.numericizer1 = numericizer1
+        self.numericizer2 = numericizer2
+        self.directory = tempfile.mkdtemp( prefix = 'chunk-', dir = directory )
+        self.n_ready = 0
+        self.wait = 0.
+        self.worker = None
+        self.start()
+
+
+    def path( self, int k ):
+        return os.path.join( self.directory, '%d' % k )
+
+
+    def start( self ):
+        if self.n_ready < self.n_chunk:
+            self.worker = multiprocessing.Process( target = prefetch_chunk_worker, 
+                                                   args = ( self.build, self.n_ready, 
+                                                            self.path( self.n_ready ) ) )
+            self.worker.daemon = True
+            self.started = time.time()
+            self.worker.start()
+        else:
+            self.worker = None
+
+
+    def __iter__( self ):
+        return self
+
+
+    def next( self ):
+        if self.worker is None:
+            raise StopIteration
+        k, path = self.n_ready, self.path( self.n_ready )
+        begin = time.time()
+        self.worker.join()
+        waited = time.time() - begin
+        self.wait += waited
+        if self.worker.exitcode != 0:
+            message = 'exit code %d' % self.worker.exitcode
+            if os.path.exists( path + '.error' ):
+                with open( path + '.error', 'rb' ) as fp:
+                    message = fp.read()
+            self.worker = None
+            raise RuntimeError( 'chunk %d cannot be built\n%s' % (k, message) )
+
+        constructor = load_dataset( path, self.numericizer1, self.numericizer2 )
+        # the files stay mapped after they are unlinked
+        shutil.rmtree( path, True )
+        logger.info( 'chunk %d ready %.2f seconds after it was started, ' % \
+                     (k, time.time() - self.started) + 
+                     'trainer waited %.2f seconds (%.2f in total)' % (waited, self.wait) )
+
+        self.n_ready += 1
+        self.start()
+        return constructor
+
+
+    def close( self ):
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.terminate()
+            self.worker.join()
+        self.worker = None
+        shutil.rmtree( self.directory, True )